@@ -6,7 +6,6 @@ Author
 License
     GPL v3.0
 """
-import time
 import logging
 import numpy as np
 import copy
@@ -16,6 +15,7 @@ from obspy import UTCDateTime, Catalog
 from obspy.core.event import Event
 
 from rt_eqcorrscan.event_trigger.listener import _Listener, event_time
+from rt_eqcorrscan.streaming.clock import WallClock
 from rt_eqcorrscan.database.database_manager import (
     TemplateBank, remove_unreferenced)
 from rt_eqcorrscan.event_trigger.triggers import magnitude_rate_trigger_func
@@ -131,6 +131,9 @@ class CatalogListener(_Listener):
     waveform_client
         Client with at least a `get_waveforms` and `get_waveforms_bulk` method.
         If this is None (default) then the `client` will be used.
+    clock
+        Clock to time queries with, see `rt_eqcorrscan.streaming.clock`.
+        Defaults to wall-clock time.
     """
     busy = False
     _test_start_step = 0  # Number of seconds prior to `now` used for testing.
@@ -144,6 +147,7 @@ class CatalogListener(_Listener):
         interval: float = 10,
         keep: float = 86400,
         waveform_client=None,
+        clock=None,
     ):
         self.client = client
         self.waveform_client = waveform_client or client
@@ -158,7 +162,8 @@ class CatalogListener(_Listener):
         self.threads = []
         self.triggered_events = Catalog()
         self.busy = False
-        self.previous_time = UTCDateTime.now()
+        self.clock = clock or WallClock()
+        self.previous_time = self.clock.now()
 
     def __repr__(self):
         """
@@ -249,7 +254,7 @@ class CatalogListener(_Listener):
         self.previous_time -= self._test_start_step
         template_kwargs = template_kwargs or dict()
         while self.busy:
-            now = UTCDateTime.now() - self._test_start_step
+            now = self.clock.now() - self._test_start_step
             # Remove old events from dict
             self._remove_old_events(now)
             Logger.debug("Checking for new events between {0} and {1}".format(
@@ -266,7 +271,7 @@ class CatalogListener(_Listener):
                         "Could not download data between {0} and {1}".format(
                             self.previous_time, now))
                     Logger.error(e)
-                time.sleep(self.interval)
+                self.clock.sleep(self.interval)
                 continue
             if new_events is not None:
                 Logger.info("{0} new events between {1} and {2}".format(
@@ -314,7 +319,7 @@ class CatalogListener(_Listener):
                     Logger.debug("Old events current state: {0}".format(
                         self.old_events))
             self.previous_time = now
-            time.sleep(self.interval)
+            self.clock.sleep(self.interval)
 
 
 if __name__ == "__main__":
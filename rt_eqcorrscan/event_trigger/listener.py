@@ -22,11 +22,15 @@ class _Listener(ABC):
     """
     Abstract base class for listener objects - anything to be used by the
     Reactor should fit in this scope.
+
+    Listeners with a `clock` (see `rt_eqcorrscan.streaming.clock`) attach
+    the threads started by `background_run` to it.
     """
     busy = False
 
     threads = []
     client = None
+    clock = None
 
     @abstractmethod
     def run(self, *args, **kwargs):
@@ -37,6 +41,8 @@ class _Listener(ABC):
         listening_thread = threading.Thread(
             target=self.run, args=args, kwargs=kwargs, name="ListeningThread")
         listening_thread.daemon = True
+        if self.clock is not None:
+            self.clock.attach(listening_thread)
         listening_thread.start()
         self.threads.append(listening_thread)
         Logger.info("Started listening to {0}".format(self.client.base_url))
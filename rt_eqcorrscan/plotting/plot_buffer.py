@@ -200,7 +200,8 @@ def define_plot(
         will be real-time
     """
     # Set up the data source
-    stream = rt_client.get_stream().copy().split().detrend()
+    stream, cursor = rt_client.read_since()
+    stream = stream.split().detrend()
     if lowcut and highcut:
         stream.filter("bandpass", freqmin=lowcut, freqmax=highcut)
         title = "Streaming data: {0}-{1} Hz bandpass".format(lowcut, highcut)
@@ -386,10 +387,18 @@ def define_plot(
     previous_timestamps = {
         channel: stream.select(id=channel)[0].stats.endtime
         for channel in channels}
-    
+    # Only new data are read and filtered, with enough older data for the
+    # filter to settle. A highpass removes the trend that differs between
+    # reads, but without one the trend is fitted over the whole plot window,
+    # as when the whole buffer was read, so that reads join without steps.
+    filter_pad = 10. / (lowcut or highcut) if (lowcut or highcut) else 0.
+    read_pad = filter_pad if lowcut else max(plot_length, filter_pad)
+
     def update():
         Logger.debug("Plot updating")
-        _stream = rt_client.get_stream().split().detrend()
+        _stream, _cursor = rt_client.read_since(cursor, pad=read_pad)
+        cursor.update(_cursor)
+        _stream = _stream.split().detrend()
         if lowcut and highcut:
             _stream.filter("bandpass", freqmin=lowcut, freqmax=highcut)
         elif lowcut:
@@ -404,18 +413,17 @@ def define_plot(
             except IndexError:
                 Logger.debug("No channel for {0}".format(_channel))
                 continue
-            new_samples = int(_tr.stats.sampling_rate * (
-                    previous_timestamps[_channel] - _tr.stats.endtime))
-            if new_samples == 0:
+            if _tr.stats.endtime <= previous_timestamps[_channel]:
+                # Back-filled data older than the plot are not shown
                 Logger.debug("No new data for {0}".format(_channel))
                 continue
             _new_data = _tr.slice(
-                starttime=previous_timestamps[_channel])
+                starttime=previous_timestamps[_channel] + _tr.stats.delta)
             new_times = np.arange(
                 _new_data.stats.starttime.datetime,
                 (_tr.stats.endtime + _tr.stats.delta).datetime,
                 step=dt.timedelta(seconds=_tr.stats.delta))
-            new_data = {'time': new_times[1:], 'data': _new_data.data[1:]}
+            new_data = {'time': new_times, 'data': _new_data.data}
             Logger.debug("Channl: {0}\tNew times: {1}\t New data: {2}".format(
                 _tr.id, new_data["time"].shape, new_data["data"].shape))
             trace_sources[_channel].stream(
@@ -436,10 +444,7 @@ def define_plot(
         if not offline:
             now = dt.datetime.utcnow()
         else:
-            try:
-                now = max([tr.stats.endtime for tr in _stream]).datetime
-            except ValueError:
-                return
+            now = max(previous_timestamps.values()).datetime
         trace_plots[0].x_range.start = now - dt.timedelta(seconds=plot_length)
         trace_plots[0].x_range.end = now
         _update_template_alphas(
@@ -7,7 +7,6 @@ License
     GPL v3.0
 """
 import logging
-import time
 import gc
 
 from collections import Counter
@@ -29,6 +28,8 @@ from rt_eqcorrscan.rt_match_filter import RealTimeTribe
 from rt_eqcorrscan.event_trigger.catalog_listener import CatalogListener
 from rt_eqcorrscan.event_trigger.listener import event_time
 from rt_eqcorrscan.streaming.streaming import _StreamingClient
+from rt_eqcorrscan.streaming.clock import WallClock
+from rt_eqcorrscan.streaming.buffers import SharedBuffer
 from rt_eqcorrscan.config import Notifier
 
 
@@ -52,7 +53,10 @@ class Reactor(object):
     client
         An obspy or obsplus client that supports event and station queries.
     rt_client
-        A client that supports real-time data streaming.
+        A client that supports real-time data streaming. If the client has a
+        SharedBuffer then the reactor streams data into it and real-time
+        tribes read from the shared buffer rather than each streaming their
+        own copy of the data.
     listener
         Listener for checking current earthquake activity
     trigger_func:
@@ -74,6 +78,13 @@ class Reactor(object):
         in `real_time_tribe_kwargs`.
     notifier
         Notifier that will send messages about triggers.
+    clock
+        Clock to time the reactor and real-time tribes with, see
+        `rt_eqcorrscan.streaming.clock`. Defaults to the clock of the
+        rt_client if it has one, otherwise wall-clock time. The listener
+        keeps its own clock, give it the same clock to simulate with a
+        `VirtualClock`. Tribes run in the background are run in separate
+        processes, each with its own copy of the clock.
 
     Notes
     -----
@@ -114,6 +125,7 @@ class Reactor(object):
         real_time_tribe_kwargs: dict,
         plot_kwargs: dict,
         notifier: Notifier = None,
+        clock=None,
     ):
         self.client = client
         self.rt_client = rt_client
@@ -125,6 +137,7 @@ class Reactor(object):
         self.plot_kwargs = plot_kwargs
         self.listener_kwargs = listener_kwargs
         self.notifier = notifier or Notifier()
+        self.clock = clock or self.rt_client.clock or WallClock()
         # Time-keepers
         self._run_start = None
         self.up_time = 0
@@ -161,8 +174,12 @@ class Reactor(object):
             Maximum back-fill length for new templates being added to already
             running tribes. Units: seconds
         """
+        # Keep time with the clock before starting the clients
+        self.clock.attach()
+        if self._shares_buffer:
+            self._start_shared_streaming()
         self.listener.background_run(**self.listener_kwargs)
-        self._run_start = UTCDateTime.now()
+        self._run_start = self.clock.now()
         # Query the catalog in the listener every so often and check
         while True:
             Logger.debug(self.listener)
@@ -200,13 +217,33 @@ class Reactor(object):
                         level=5)
                     self.triggered_events.append(trigger_event)
                     self.background_spin_up(trigger_event)
-            self.set_up_time(UTCDateTime.now())
+            self.set_up_time(self.clock.now())
             if max_run_length and self.up_time >= max_run_length:
                 Logger.info("Times up: Stopping")
                 self.stop()
                 break
             gc.collect()
-            time.sleep(self.sleep_step)
+            self.clock.sleep(self.sleep_step)
+
+    @property
+    def _shares_buffer(self) -> bool:
+        """ Whether the reactor streams data for the real-time tribes. """
+        buffer = self.rt_client.buffer
+        return isinstance(buffer, SharedBuffer) and not buffer.read_only
+
+    def _start_shared_streaming(self) -> None:
+        """ Stream all the channels of the shared buffer. """
+        if not self.rt_client.started:
+            self.rt_client.start()
+        if self.rt_client.can_add_streams:
+            for seed_id in self.rt_client.buffer.seed_ids:
+                net, sta, _, chan = seed_id.split('.')
+                self.rt_client.select_stream(
+                    net=net, station=sta, selector=chan)
+        if not self.rt_client.busy:
+            self.rt_client.background_run()
+        Logger.info("Streaming data into shared buffer {0}".format(
+            self.rt_client.buffer.name))
 
     def background_spin_up(
         self,
@@ -231,10 +268,14 @@ class Reactor(object):
 
     def stop(self) -> None:
         """Stop all the processes."""
+        # Stop keeping time with the clock so that threads can be joined
+        self.clock.detach()
         for event_id in self.running_tribes.keys():
             self.stop_tribe(event_id)
         for detecting_thread in self.detecting_processes:
             detecting_thread.join()
+        if self._shares_buffer:
+            self.rt_client.background_stop()
         self.listener.background_stop()
 
     def spin_up(
@@ -286,10 +327,15 @@ class Reactor(object):
             plot = False
         elif plot:
             self._plotting = triggering_event.resource_id
+        # Start from the data the reactor already holds: copies of Buffers
+        # share memory until either client writes to them. SharedBuffers
+        # are attached by empty copies instead.
+        rt_client = self.rt_client.copy(empty_buffer=isinstance(
+            self.rt_client.buffer, SharedBuffer))
         real_time_tribe = RealTimeTribe(
-            tribe=tribe, inventory=inventory, rt_client=self.rt_client.copy(),
+            tribe=tribe, inventory=inventory, rt_client=rt_client,
             detect_interval=detect_interval, plot=plot,
-            plot_options=self.plot_kwargs,
+            plot_options=self.plot_kwargs, clock=self.clock,
             name=triggering_event.resource_id.id.split('/')[-1])
         Logger.info("Created real-time tribe with inventory:\n{0}".format(
             inventory))
@@ -11,19 +11,22 @@ import traceback
 import os
 import logging
 import copy
-import numpy
 import gc
+import numpy
 
 # from pympler import summary, muppy
 
 from typing import Union, List
 
-from obspy import Stream, UTCDateTime, Inventory
+from obspy import Stream, Trace, UTCDateTime, Inventory
 from matplotlib.figure import Figure
 from multiprocessing import Process
 from eqcorrscan import Tribe, Template, Party, Detection
 
 from rt_eqcorrscan.streaming.streaming import _StreamingClient
+from rt_eqcorrscan.streaming.clock import WallClock
+from rt_eqcorrscan.streaming.buffers import AlignedBuffer
+from rt_eqcorrscan.streaming.processing import ProcessedBuffer
 from rt_eqcorrscan.config.notification import Notifier
 from rt_eqcorrscan.event_trigger.triggers import average_rate
 
@@ -53,6 +56,12 @@ class RealTimeTribe(Tribe):
         Whether to generate the real-time bokeh plot
     plot_options
         Plotting options parsed to `rt_eqcorrscan.plotting.plot_buffer`
+    clock
+        Clock to time detection runs and waits with, see
+        `rt_eqcorrscan.streaming.clock`. Defaults to the clock of the
+        rt_client if it has one, otherwise wall-clock time. Use a
+        `VirtualClock` shared with a simulated client to run simulations
+        as fast as possible.
     
     sleep_step
         Default sleep-step in seconds while waiting for data. Defaults to 1.0
@@ -77,9 +86,11 @@ class RealTimeTribe(Tribe):
         detect_interval: float = 60.,
         plot: bool = True,
         plot_options: dict = None,
+        clock=None,
     ) -> None:
         super().__init__(templates=tribe.templates)
         self.rt_client = rt_client
+        self.clock = clock or self.rt_client.clock or WallClock()
         assert (self.rt_client.buffer_capacity >= max(
             [template.process_length for template in self.templates]))
         assert (self.rt_client.buffer_capacity >= detect_interval)
@@ -233,11 +244,20 @@ class RealTimeTribe(Tribe):
             **plot_options)
         self.plotter.background_run()
 
-    def _wait(self) -> None:
+    def _wait(self, after: dict = None) -> None:
+        """
+        Wait for data from all the expected channels.
+
+        Parameters
+        ----------
+        after
+            End times keyed by seed id: also wait for data after these times.
+        """
         Logger.info("Waiting for data.")
         max_wait = min(self._max_wait_length, self.rt_client.buffer_capacity)
         wait_length = 0.
-        while len(self.rt_client.buffer) < len(self.expected_channels):
+        while (len(self.rt_client.buffer) < len(self.expected_channels) or
+               not self._has_data_after(after or dict())):
             if wait_length >= max_wait:
                 Logger.warning("Starting operation without the full dataset")
                 break
@@ -247,10 +267,69 @@ class RealTimeTribe(Tribe):
                 "expected channels".format(
                     len(self.rt_client.buffer), len(self.expected_channels)))
             wait_length += self.sleep_step
-            time.sleep(self.sleep_step)
+            self.clock.sleep(self.sleep_step)
             pass
         return
 
+    def _has_data_after(self, after: dict) -> bool:
+        """ Whether the buffer has data after the times given by seed id. """
+        for tr in self.rt_client.buffer:
+            if tr.id in after and tr.stats.endtime <= after[tr.id]:
+                return False
+        return True
+
+    def _backfill(
+        self,
+        backfill_client,
+        backfill_to: UTCDateTime = None,
+        checkpoint_ends: dict = None,
+    ) -> None:
+        """
+        Fill the buffer back in time with one bulk request.
+
+        Parameters
+        ----------
+        backfill_client
+            Client to get data from, must have a `get_waveforms_bulk` method.
+        backfill_to
+            Time to backfill the data buffer to.
+        checkpoint_ends
+            End times of data loaded from a checkpoint keyed by seed id. The
+            gaps between these times and the live data are filled.
+        """
+        checkpoint_ends = checkpoint_ends or dict()
+        bulk = []
+        for tr_id in self.expected_channels:
+            try:
+                tr_in_buffer = self.rt_client.buffer.select(id=tr_id)[0]
+            except IndexError:
+                continue
+            starttime = backfill_to
+            endtime = tr_in_buffer.stats.starttime
+            checkpoint_end = checkpoint_ends.get(tr_id)
+            if checkpoint_end is not None:
+                # Older data were loaded from the checkpoint
+                if starttime is None or starttime < checkpoint_end:
+                    starttime = checkpoint_end
+                endtime = tr_in_buffer.stats.endtime
+            if starttime is None or starttime >= endtime:
+                continue
+            bulk.append((*tr_id.split('.'), starttime, endtime))
+        if len(bulk) == 0:
+            return
+        try:
+            st = backfill_client.get_waveforms_bulk(bulk).merge()
+        except Exception as e:
+            Logger.error("Could not back fill due to: {0}".format(e))
+            return
+        Logger.debug("Downloaded backfill: {0}".format(st))
+        for tr in st:
+            # Not live packets: keep them out of the ingest metrics
+            self.rt_client.on_data(tr, record=False)
+        self.rt_client.flush()
+        Logger.debug("Stream in buffer is now: {0}".format(
+            self.rt_client.buffer))
+
     def _bg_run(self, *args, **kwargs):
         while self.busy:
             self.run(*args, **kwargs)
@@ -330,7 +409,7 @@ class RealTimeTribe(Tribe):
         if isinstance(templates, list):
             templates = Tribe(templates)
         # Get the stream
-        endtime = endtime or UTCDateTime.now()
+        endtime = endtime or self.clock.now()
         if maximum_backfill is not None:
             starttime = endtime - maximum_backfill
         else:
@@ -339,6 +418,9 @@ class RealTimeTribe(Tribe):
             return
         bulk = [tuple(chan.split('.').extend([starttime, endtime]))
                 for chan in self.expected_channels]
+        if self.rt_client.archiver is not None:
+            # Make sure that held data are in the wavebank
+            self.rt_client.archiver.flush()
         st = self.rt_client.wavebank.get_waveforms_bulk(bulk)
         Logger.debug("Additional templates to be run: \n{0} "
                      "templates".format(len(templates)))
@@ -357,9 +439,12 @@ class RealTimeTribe(Tribe):
 
     def stop(self) -> None:
         """ Stop the real-time system. """
+        # Stop keeping time with the clock so that threads can be joined
+        self.clock.detach()
         if self.plotter is not None:  # pragma: no cover
             self.plotter.background_stop()
-        self.rt_client.background_stop()
+        if not self.rt_client.reads_shared_buffer:
+            self.rt_client.background_stop()
         self.busy = False
         self._running = False
         if self._detecting_thread is not None:
@@ -378,6 +463,9 @@ class RealTimeTribe(Tribe):
         minimum_rate: float = None,
         backfill_to: UTCDateTime = None,
         backfill_client=None,
+        checkpoint_path: str = None,
+        checkpoint_interval: float = 600.,
+        incremental_processing: bool = False,
         **kwargs
     ) -> Party:
         """
@@ -419,7 +507,28 @@ class RealTimeTribe(Tribe):
         backfill_to
             Time to backfill the data buffer to.
         backfill_client
-            Client to use to backfill the data buffer.
+            Client to use to backfill the data buffer. All channels are
+            requested together using `get_waveforms_bulk`.
+        checkpoint_path
+            Directory to save the data buffer to. If a checkpoint is already
+            there it is loaded before streaming starts, and the gap between
+            the checkpoint and the live data is back-filled if a
+            `backfill_client` is given. Not used when reading a shared buffer.
+        checkpoint_interval
+            Seconds between saving checkpoints. A checkpoint is also saved
+            when the run stops.
+        incremental_processing
+            Whether to filter and resample data as they arrive, see
+            `ProcessedBuffer`, rather than processing the whole window for
+            every detection. Requires all templates to be processed the
+            same way, and not reading from a shared buffer. Falls back to
+            processing every detection if the sampling-rate of a channel is
+            not an integer multiple of the templates'. Detections are
+            only approximately the same as processing each window: data are
+            not detrended, the filter starts from the first sample rather
+            than from rest, and data are decimated rather than Fourier
+            resampled. Correlations differ most near the start of the data
+            and after gaps.
 
         Returns
         -------
@@ -431,49 +540,66 @@ class RealTimeTribe(Tribe):
                 Logger.info("EQcorrscan plotting disabled")
         except KeyError:
             pass
-        run_start = UTCDateTime.now()
+        # Keep time with the clock from the start, so that virtual time
+        # does not pass while setting up
+        self.clock.attach()
+        run_start = self.clock.now()
         detection_iteration = 0  # Counter for number of detection loops run
         if not self.busy:
             self.busy = True
         detect_directory = detect_directory.format(name=self.name)
         if not os.path.isdir(detect_directory):
             os.makedirs(detect_directory)
-        if not self.rt_client.started:
-            self.rt_client.start()
-        if self.rt_client.can_add_streams:
-            for tr_id in self.expected_channels:
-                self.rt_client.select_stream(
-                    net=tr_id.split('.')[0], station=tr_id.split('.')[1],
-                    selector=tr_id.split('.')[3])
+        processed_buffer = None
+        if incremental_processing:
+            processed_buffer = self._processed_buffer()
+        if processed_buffer is not None:
+            # Attached first so that checkpointed and back-filled data are
+            # processed
+            self.rt_client.processed_buffer = processed_buffer
+            kwargs.update(pre_processed=True)
+        checkpoint_ends = dict()
+        if checkpoint_path and self.rt_client.reads_shared_buffer:
+            Logger.warning("Cannot checkpoint a shared buffer from a reader")
+            checkpoint_path = None
+        elif checkpoint_path:
+            try:
+                self.rt_client.load_checkpoint(checkpoint_path)
+            except FileNotFoundError:
+                Logger.info("No checkpoint found in {0}".format(
+                    checkpoint_path))
+            else:
+                checkpoint_ends = {
+                    tr.id: tr.stats.endtime for tr in self.rt_client.buffer}
+        last_checkpoint = self.clock.now()
+        if self.rt_client.reads_shared_buffer:
+            Logger.info("Reading data from shared buffer {0}".format(
+                self.rt_client.buffer.name))
         else:
-            Logger.warning("Client already in streaming mode,"
-                           " cannot add channels")
-        if not self.rt_client.busy:
-            self.rt_client.background_run()
-            Logger.info("Started real-time streaming")
-        else:
-            Logger.info("Real-time streaming already running")
+            if not self.rt_client.started:
+                self.rt_client.start()
+            if self.rt_client.can_add_streams:
+                for tr_id in self.expected_channels:
+                    self.rt_client.select_stream(
+                        net=tr_id.split('.')[0], station=tr_id.split('.')[1],
+                        selector=tr_id.split('.')[3])
+            else:
+                Logger.warning("Client already in streaming mode,"
+                               " cannot add channels")
+            if not self.rt_client.busy:
+                self.rt_client.background_run()
+                Logger.info("Started real-time streaming")
+            else:
+                Logger.info("Real-time streaming already running")
         Logger.info("Detection will use the following data: {0}".format(
             self.expected_channels))
-        if backfill_client and backfill_to:
-            self._wait()
-            for tr_id in self.expected_channels:
-                try:
-                    tr_in_buffer = self.rt_client.buffer.select(id=tr_id)[0]
-                except IndexError:
-                    continue
-                endtime = tr_in_buffer.stats.starttime
-                try:
-                    tr = backfill_client.get_waveforms(
-                        *tr_id.split('.'), starttime=backfill_to,
-                        endtime=endtime).merge()[0]
-                except Exception as e:
-                    Logger.error("Could not back fill due to: {0}".format(e))
-                    continue
-                Logger.debug("Downloaded backfill: {0}".format(tr))
-                self.rt_client.on_data(tr)
-                Logger.debug("Stream in buffer is now: {0}".format(
-                    self.rt_client.buffer))
+        if self.rt_client.reads_shared_buffer and backfill_to:
+            Logger.warning("Cannot back fill a shared buffer from a reader")
+        elif backfill_client and (backfill_to or checkpoint_ends):
+            # Live data are needed to know where the gaps end
+            self._wait(after=checkpoint_ends)
+            self._backfill(backfill_client, backfill_to=backfill_to,
+                           checkpoint_ends=checkpoint_ends)
         if self.plot:  # pragma: no cover
             # Set up plotting thread
             self._plot()
@@ -484,28 +610,61 @@ class RealTimeTribe(Tribe):
                 self.rt_client.buffer_length + 5) / self._speed_up
             Logger.info("Sleeping for {0:.2f}s while accumulating data".format(
                 sleep_step))
-            time.sleep(sleep_step)
+            self.clock.sleep(sleep_step)
         first_data = min([tr.stats.starttime
-                          for tr in self.rt_client.get_stream().merge()])
+                          for tr in self.rt_client.get_snapshot().merge()])
+        cursor = None  # Position in the buffer of the last detection run
         try:
             while self.busy:
+                # Release the last detection's data before reading again:
+                # buffers only re-use snapshot memory that is not held.
+                st = new_party = None
                 self._running = True  # Lock tribe
-                start_time = UTCDateTime.now()
-                st = self.rt_client.get_stream().merge()
+                start_time = self.clock.now()
+                # Compare cursors rather than reading the new data
+                last_cursor, cursor = cursor, self.rt_client.cursor
+                if detection_iteration > 0 and cursor == last_cursor:
+                    Logger.info(
+                        "No new data since last detection run, waiting "
+                        "{0:.2f}s".format(self.detect_interval))
+                    self._running = False  # Release lock
+                    self.clock.sleep(self.detect_interval / self._speed_up)
+                    if max_run_length and (
+                            self.clock.now() > run_start + max_run_length):
+                        Logger.info("Hit maximum run time, stopping.")
+                        self.stop()
+                    continue
+                if processed_buffer is not None:
+                    processed_buffer = self._check_processed_buffer(
+                        processed_buffer, kwargs)
+                if processed_buffer is not None:
+                    st = processed_buffer.snapshot().merge()
+                elif isinstance(self.rt_client.buffer, AlignedBuffer):
+                    # Channels share one sample grid: no merge or trim needed.
+                    # For the first run we want to detect in everything we have.
+                    st = self.rt_client.buffer.window(
+                        length=None if detection_iteration == 0
+                        else self.minimum_data_for_detection)
+                else:
+                    # Read-only view: only channels with new data are copied
+                    st = self.rt_client.get_snapshot().merge()
                 if len(st) == 0:
                     Logger.warning("No data")
                     continue
                 # Cope with data that doesn't come
                 last_data = max(tr.stats.endtime for tr in st)
-                if detection_iteration > 0:
+                if detection_iteration > 0 and (
+                        processed_buffer is not None or not isinstance(
+                            self.rt_client.buffer, AlignedBuffer)):
                     # For the first run we want to detect in everything we have.
                     st.trim(
                         starttime=last_data - self.minimum_data_for_detection,
                         endtime=last_data)
-                # Remove short channels
+                # Remove channels without enough data in the window
                 st.traces = [
                     tr for tr in st
-                    if _numpy_len(tr.data) >= (.8 * self.minimum_data_for_detection)]
+                    if _data_length(tr) >= (
+                        .8 * self.minimum_data_for_detection)]
                 Logger.info("Starting detection run")
                 Logger.debug("Using data: \n{0}".format(st.__str__(extended=True)))
                 try:
@@ -526,7 +685,7 @@ class RealTimeTribe(Tribe):
                     Logger.info(
                         "Waiting for {0:.2f}s and hoping this gets "
                         "better".format(self.detect_interval))
-                    time.sleep(self.detect_interval)
+                    self.clock.sleep(self.detect_interval)
                     continue
                 self._handle_detections(
                     new_party, trig_int=trig_int,
@@ -537,7 +696,7 @@ class RealTimeTribe(Tribe):
                 self._remove_old_detections(last_data - keep_detections)
                 Logger.info("Party now contains {0} detections".format(
                     len(self.detections)))
-                run_time = UTCDateTime.now() - start_time
+                run_time = self.clock.now() - start_time
                 Logger.info("Detection took {0:.2f}s".format(run_time))
                 if self.detect_interval <= run_time:
                     Logger.warning(
@@ -548,10 +707,16 @@ class RealTimeTribe(Tribe):
                 Logger.debug("This step took {0:.2f}s total".format(run_time))
                 Logger.info("Waiting {0:.2f}s until next run".format(
                     self.detect_interval - run_time))
+                if checkpoint_path and (self.clock.now() - last_checkpoint
+                                        >= checkpoint_interval):
+                    self._checkpoint(checkpoint_path)
+                    last_checkpoint = self.clock.now()
                 detection_iteration += 1
                 self._running = False  # Release lock
-                time.sleep((self.detect_interval - run_time) / self._speed_up)
-                if max_run_length and UTCDateTime.now() > run_start + max_run_length:
+                self.clock.sleep(
+                    (self.detect_interval - run_time) / self._speed_up)
+                if max_run_length and (
+                        self.clock.now() > run_start + max_run_length):
                     Logger.info("Hit maximum run time, stopping.")
                     self.stop()
                 if minimum_rate and len(self.detections) > 0:
@@ -570,8 +735,61 @@ class RealTimeTribe(Tribe):
                 # summary.print_(sum1)
         finally:
             self.stop()
+            if processed_buffer is not None:
+                self.rt_client.processed_buffer = None
+            if checkpoint_path:
+                self._checkpoint(checkpoint_path)
         return self.party
 
+    def _processed_buffer(self) -> Union[ProcessedBuffer, None]:
+        """ Make a buffer to process data into as they arrive, if possible. """
+        if self.rt_client.reads_shared_buffer:
+            Logger.warning("Cannot process data from a shared buffer as it "
+                           "arrives, processing for each detection")
+            return None
+        parameters = {
+            (template.lowcut, template.highcut, template.filt_order,
+             template.samp_rate) for template in self.templates}
+        if len(parameters) != 1:
+            Logger.warning("Templates are not all processed the same way, "
+                           "processing for each detection")
+            return None
+        lowcut, highcut, filt_order, samp_rate = parameters.pop()
+        # Filtered data must be stored as floats: only keep the raw storage
+        # type if it is a float, e.g. float32 to save memory
+        dtype = getattr(self.rt_client.buffer, "dtype", None)
+        if dtype is not None and not numpy.issubdtype(dtype, numpy.floating):
+            dtype = None
+        return ProcessedBuffer(
+            maxlen=self.rt_client.buffer_capacity, lowcut=lowcut,
+            highcut=highcut, filt_order=filt_order, samp_rate=samp_rate,
+            dtype=dtype)
+
+    def _check_processed_buffer(
+        self,
+        processed_buffer: ProcessedBuffer,
+        kwargs: dict,
+    ) -> Union[ProcessedBuffer, None]:
+        """
+        Fall back to processing for each detection if some channels cannot
+        be processed as they arrive, rather than missing them out.
+        """
+        unprocessed = processed_buffer.unprocessed
+        if len(unprocessed) == 0:
+            return processed_buffer
+        Logger.warning("Cannot process {0} as they arrive, processing for "
+                       "each detection".format(", ".join(unprocessed)))
+        self.rt_client.processed_buffer = None
+        kwargs.pop("pre_processed", None)
+        return None
+
+    def _checkpoint(self, path: str) -> None:
+        """ Save the data buffer, without stopping detection on failure. """
+        try:
+            self.rt_client.checkpoint(path)
+        except Exception as e:
+            Logger.error("Could not checkpoint buffer due to: {0}".format(e))
+
 
 def _write_detection(
     detection: Detection,
@@ -630,25 +848,20 @@ def _write_detection(
     return fig
 
 
-def _numpy_len(arr: Union[numpy.ndarray, numpy.ma.MaskedArray]) -> int:
+def _data_length(tr: Trace) -> float:
     """
-    Convenience function to return the length of a numpy array.
-
-    If arr is a masked array will return the count of the non-masked elements.
+    Length in seconds of the data (not masked) in a trace.
 
     Parameters
     ----------
-    arr
-        Array to get the length of - must be 1D
+    tr
+        Trace to get the length of data in.
 
     Returns
     -------
-        Length of non-masked elements
+        Seconds of data, not including gaps.
     """
-    assert arr.ndim == 1, "Only supports 1D arrays."
-    if numpy.ma.is_masked(arr):
-        return arr.count()
-    return arr.shape[0]
+    return numpy.ma.count(tr.data) / tr.stats.sampling_rate
 
 
 if __name__ == "__main__":
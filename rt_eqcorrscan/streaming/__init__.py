@@ -8,4 +8,9 @@ License
 """
 
 from .seedlink import RealTimeClient
-from .buffers import Buffer
+from .buffers import Buffer, AlignedBuffer, SharedBuffer
+from .processing import ProcessedBuffer
+from .metrics import IngestMetrics
+from .seedlink_server import SeedLinkReplayServer
+from .clock import WallClock, VirtualClock
+from .archiver import WaveBankArchiver
@@ -0,0 +1,236 @@
+"""
+Background archiving of streamed data to a WaveBank.
+
+Author
+    Calum J Chamberlain
+License
+    GPL v3.0
+"""
+import logging
+import queue
+import threading
+import time
+
+from obspy import Stream
+from obsplus import WaveBank
+
+
+Logger = logging.getLogger(__name__)
+
+
+class WaveBankArchiver(object):
+    """
+    Write data to a WaveBank in a background thread.
+
+    Data are queued by `put` without waiting for the disk. The writer thread
+    holds data for each channel and merges them into longer traces, then
+    writes everything held in one `put_waveforms` call, which updates the
+    WaveBank index once for all the files written. The queue is bounded: if
+    the writer falls behind and the queue is full, new data are dropped
+    rather than holding up streaming, and counted in `stats`.
+
+    Parameters
+    ----------
+    wavebank
+        WaveBank to write to.
+    max_queue
+        Largest number of traces waiting to be held by the writer.
+    flush_samples
+        Write held data once any channel holds this many samples.
+    flush_interval
+        Longest time in seconds to hold data before writing them.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from obspy import read
+    >>> st = read()
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     archiver = WaveBankArchiver(WaveBank(path))
+    ...     for second in range(30):
+    ...         archiver.put(st.slice(st[0].stats.starttime + second,
+    ...                               st[0].stats.starttime + second + 0.99))
+    ...     archiver.stop()
+    ...     archived = archiver.wavebank.get_waveforms()
+    >>> print(archived.merge().sort())  # doctest: +NORMALIZE_WHITESPACE
+    3 Trace(s) in Stream:
+    BW.RJOB..EHE | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z \
+| 100.0 Hz, 3000 samples
+    BW.RJOB..EHN | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z \
+| 100.0 Hz, 3000 samples
+    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z \
+| 100.0 Hz, 3000 samples
+    >>> stats = archiver.stats()
+    >>> stats["queued"], stats["written"], stats["flushes"], stats["dropped"]
+    (90, 90, 1, 0)
+    """
+    def __init__(
+        self,
+        wavebank: WaveBank,
+        max_queue: int = 10000,
+        flush_samples: int = 30000,
+        flush_interval: float = 60.,
+    ):
+        self.wavebank = wavebank
+        self.max_queue = max_queue
+        self.flush_samples = flush_samples
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        # Traces and samples held by the writer, keyed by seed id
+        self._held = dict()
+        self._held_samples = dict()
+        self._held_since = None
+        self._counts = dict(queued=0, dropped=0, written=0, flushes=0,
+                            errors=0, write_time=0., max_depth=0)
+
+    def __repr__(self):
+        return ("WaveBankArchiver(wavebank={0}, max_queue={1}, "
+                "flush_samples={2}, flush_interval={3})".format(
+                    self.wavebank, self.max_queue, self.flush_samples,
+                    self.flush_interval))
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self) -> dict:
+        """
+        Summary of archiving.
+
+        Depth is the number of traces waiting in the queue now, held is the
+        number held by the writer. Counts of traces queued, dropped because
+        the queue was full and written, with the number of writes
+        (flushes), the number of writes that failed, and the time spent
+        writing in seconds.
+        """
+        with self._lock:
+            stats = self._counts.copy()
+            stats.update(
+                depth=self._queue.qsize(),
+                held=sum(len(traces) for traces in self._held.values()))
+        stats["mean_write_time"] = (
+            stats["write_time"] / max(stats["flushes"], 1))
+        return stats
+
+    def start(self) -> None:
+        """ Start the writer thread if it is not running. """
+        with self._lock:
+            if self.running:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="WaveBankArchiver")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, st: Stream) -> None:
+        """
+        Queue data to be written, starting the writer thread if needed.
+
+        Traces are not copied and should not be changed after being queued.
+        """
+        self.start()
+        for tr in st:
+            try:
+                self._queue.put_nowait(tr)
+            except queue.Full:
+                with self._lock:
+                    self._counts["dropped"] += 1
+                    dropped = self._counts["dropped"]
+                if dropped == 1 or dropped % 1000 == 0:
+                    Logger.warning(
+                        "Archive queue full, {0} traces dropped".format(
+                            dropped))
+                continue
+            with self._lock:
+                self._counts["queued"] += 1
+                self._counts["max_depth"] = max(
+                    self._counts["max_depth"], self._queue.qsize())
+
+    def flush(self) -> None:
+        """ Write everything queued and held, waiting for it to be written. """
+        if not self.running:
+            return
+        done = threading.Event()
+        self._queue.put((done, False))
+        done.wait()
+
+    def stop(self) -> None:
+        """ Write everything queued and held, and stop the writer thread. """
+        if not self.running:
+            return
+        done = threading.Event()
+        self._queue.put((done, True))
+        done.wait()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            timeout = None
+            if self._held_since is not None:
+                timeout = max(0., self._held_since + self.flush_interval -
+                              time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._write()
+                continue
+            if isinstance(item, tuple):
+                # Flush or stop requested
+                done, stop = item
+                self._write()
+                done.set()
+                if stop:
+                    return
+                continue
+            self._hold(item)
+            if self._held_samples[item.id] >= self.flush_samples:
+                self._write()
+
+    def _hold(self, tr) -> None:
+        with self._lock:
+            self._held.setdefault(tr.id, []).append(tr)
+        self._held_samples[tr.id] = (
+            self._held_samples.get(tr.id, 0) + tr.stats.npts)
+        if self._held_since is None:
+            self._held_since = time.monotonic()
+
+    def _write(self) -> None:
+        """ Merge held data for each channel and write them all at once. """
+        with self._lock:
+            held, self._held = self._held, dict()
+        self._held_samples.clear()
+        self._held_since = None
+        if len(held) == 0:
+            return
+        st, n_traces = Stream(), 0
+        for traces in held.values():
+            n_traces += len(traces)
+            try:
+                st += Stream(traces).merge()
+            except Exception as e:
+                # e.g. a change of sampling-rate: leave it to the bank
+                Logger.debug("Could not merge {0}: {1}".format(
+                    traces[0].id, e))
+                st += Stream(traces)
+        tic = time.perf_counter()
+        try:
+            self.wavebank.put_waveforms(stream=st)
+        except Exception as e:
+            Logger.error("Could not write to wavebank due to: {0}".format(e))
+            with self._lock:
+                self._counts["errors"] += 1
+            return
+        finally:
+            with self._lock:
+                self._counts["write_time"] += time.perf_counter() - tic
+                self._counts["flushes"] += 1
+        with self._lock:
+            self._counts["written"] += n_traces
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
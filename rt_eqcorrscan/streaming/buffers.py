@@ -8,10 +8,23 @@ License
 """
 import logging
 import copy
+import os
+import sys
+import re
+import fnmatch
+import weakref
+import json
+import time
+import itertools
+import bisect
+import threading
 import numpy as np
 
 from typing import Union, List
+from functools import lru_cache, wraps
+from collections import deque
 from collections.abc import Sized
+from multiprocessing import shared_memory, resource_tracker, parent_process
 
 from obspy import Stream, Trace, UTCDateTime
 from obspy.core.trace import Stats
@@ -19,14 +32,39 @@ from obspy.core.util import AttribDict
 
 Logger = logging.getLogger(__name__)
 
+_WILDCARDS = set("*?[")
+# UTCDateTime compares times to the microsecond
+_TIME_TOLERANCE_NS = 1000
+# Name of the json header of a Buffer checkpoint
+_CHECKPOINT_HEADER = "buffer.json"
+# Checkpoint data files, by generation and channel - only these are removed
+_CHECKPOINT_DATA = "buffer.{0}.{1}.npy"
+_CHECKPOINT_DATA_RE = re.compile(r"^buffer\.\d+\.\d+\.npy$")
 
-class BufferStats(AttribDict):
+
+class BufferStats(object):
     """
     Container for header attributes for TraceBuffer.
 
     This is very similar to obspy's Stats, but endtime is fixed and starttime
-    is calculated from other attributes.
+    is calculated from other attributes. Times are kept as integer
+    nanoseconds since the epoch, UTCDateTimes are only made when
+    `starttime` or `endtime` are accessed.
+
+    Examples
+    --------
+    >>> stats = BufferStats(dict(
+    ...     station="GCSZ", sampling_rate=100., npts=101,
+    ...     endtime=UTCDateTime(2015, 9, 26)))
+    >>> print(stats.starttime)
+    2015-09-25T23:59:59.000000Z
+    >>> stats.endtime_ns += 10 ** 9
+    >>> print(stats.endtime)
+    2015-09-26T00:00:01.000000Z
     """
+    __slots__ = (
+        "network", "station", "location", "channel", "_calib",
+        "_sampling_rate", "_delta", "_npts", "_endtime_ns", "_extra")
     readonly = ['starttime']
     defaults = {
         'sampling_rate': 1.0,
@@ -40,65 +78,188 @@ class BufferStats(AttribDict):
         'location': '',
         'channel': '',
     }
+    _keys = ('network', 'station', 'location', 'channel', 'starttime',
+             'endtime', 'sampling_rate', 'delta', 'npts', 'calib')
 
     def __repr__(self):  # pragma: no cover
         return self.__str__()
 
     def __init__(self, header: dict = None):
-        super().__init__(header)
-
-    def __setitem__(self, key, value):
-        # keys which need to refresh derived values
-        if key in ['delta', 'sampling_rate', 'endtime', 'npts']:
-            # ensure correct data type
-            if key == 'delta':
-                key = 'sampling_rate'
-                try:
-                    value = 1.0 / float(value)
-                except ZeroDivisionError:
-                    value = 0.0
-            elif key == 'sampling_rate':
-                value = float(value)
-            elif key == 'endtime':
-                value = UTCDateTime(value)
-            elif key == 'npts':
-                if not isinstance(value, int):
-                    value = int(value)
-            # set current key
-            super().__setitem__(key, value)
-            # set derived value: delta
-            try:
-                delta = 1.0 / float(self.sampling_rate)
-            except ZeroDivisionError:
-                delta = 0
-            self.__dict__['delta'] = delta
-            # set derived value: starttime
-            if self.npts == 0:
-                timediff = 0
-            else:
-                timediff = float(self.npts - 1) * delta
-            self.__dict__['starttime'] = self.endtime - timediff
-            return
+        _set = object.__setattr__
+        _set(self, "network", "")
+        _set(self, "station", "")
+        _set(self, "location", "")
+        _set(self, "channel", "")
+        _set(self, "_calib", 1.0)
+        _set(self, "_sampling_rate", 1.0)
+        _set(self, "_delta", 1.0)
+        _set(self, "_npts", 0)
+        _set(self, "_endtime_ns", 0)
+        _set(self, "_extra", dict())
+        for key, value in dict(header or {}).items():
+            if key not in self.readonly:
+                self[key] = value
+
+    @property
+    def sampling_rate(self) -> float:
+        return self._sampling_rate
+
+    @sampling_rate.setter
+    def sampling_rate(self, value: float):
+        value = float(value)
+        object.__setattr__(self, "_sampling_rate", value)
+        try:
+            object.__setattr__(self, "_delta", 1.0 / value)
+        except ZeroDivisionError:
+            object.__setattr__(self, "_delta", 0)
+
+    @property
+    def delta(self) -> float:
+        return self._delta
+
+    @delta.setter
+    def delta(self, value: float):
+        try:
+            self.sampling_rate = 1.0 / float(value)
+        except ZeroDivisionError:
+            self.sampling_rate = 0.0
+
+    @property
+    def npts(self) -> int:
+        return self._npts
+
+    @npts.setter
+    def npts(self, value: int):
+        object.__setattr__(self, "_npts", int(value))
+
+    @property
+    def calib(self) -> float:
+        return self._calib
+
+    @calib.setter
+    def calib(self, value: float):
         # prevent a calibration factor of 0
-        if key == 'calib' and value == 0:
+        if value == 0:
             Logger.warning('Calibration factor set to 0.0!')
             return
-        # all other keys
-        if isinstance(value, dict):
-            super().__setitem__(key, AttribDict(value))
+        object.__setattr__(self, "_calib", value)
+
+    @property
+    def endtime_ns(self) -> int:
+        """ Time of the last sample in integer nanoseconds. """
+        return self._endtime_ns
+
+    @endtime_ns.setter
+    def endtime_ns(self, value: int):
+        object.__setattr__(self, "_endtime_ns", int(value))
+
+    @property
+    def starttime_ns(self) -> int:
+        """ Time of the first sample in integer nanoseconds. """
+        if self._npts == 0:
+            return self._endtime_ns
+        return self._endtime_ns - self.samples_to_ns(self._npts - 1)
+
+    @property
+    def endtime(self) -> UTCDateTime:
+        return UTCDateTime(ns=self._endtime_ns)
+
+    @endtime.setter
+    def endtime(self, value: UTCDateTime):
+        object.__setattr__(self, "_endtime_ns", UTCDateTime(value).ns)
+
+    @property
+    def starttime(self) -> UTCDateTime:
+        return UTCDateTime(ns=self.starttime_ns)
+
+    def samples_to_ns(self, samples: int) -> int:
+        """ Convert a number of samples to integer nanoseconds. """
+        return int(round(samples * self._delta * 1e9))
+
+    def ns_to_samples(self, ns: int) -> float:
+        """ Convert integer nanoseconds to a fractional number of samples. """
+        return ns * self._sampling_rate / 1e9
+
+    def __getattr__(self, key):
+        # Only called for attributes that are not slots or properties
+        try:
+            return object.__getattribute__(self, "_extra")[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key in self._keys or key == "endtime_ns":
+            if key in self.readonly:
+                raise AttributeError(
+                    'Attribute "{0}" in BufferStats object is read '
+                    'only!'.format(key))
+            object.__setattr__(self, key, value)
+        elif isinstance(value, dict):
+            self._extra[key] = AttribDict(value)
         else:
-            super().__setitem__(key, value)
+            self._extra[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    __setitem__ = __setattr__
+
+    def __delattr__(self, key):
+        del self._extra[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys or key in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self._keys) + len(self._extra)
+
+    def keys(self) -> list:
+        return list(self._keys) + list(self._extra.keys())
+
+    def items(self) -> list:
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BufferStats):
+            return False
+        return self.items() == other.items()
+
+    def __ne__(self, other) -> bool:
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        header = dict(self.items())
+        header["endtime"] = UTCDateTime(ns=self._endtime_ns)
+        return BufferStats, (header, )
 
-    __setattr__ = __setitem__
+    def copy(self):
+        """ Get a deep copy of the stats. """
+        return copy.deepcopy(self)
+
+    def to_dict(self) -> dict:
+        """ Get the stats as a dictionary, e.g. for a Trace header. """
+        return dict(self.items())
 
     def __str__(self):  # pragma: no cover
         """
         Return better readable string representation of BufferStats object.
         """
-        priorized_keys = ['network', 'station', 'location', 'channel',
-                          'starttime', 'endtime', 'sampling_rate', 'delta',
-                          'npts', 'calib']
-        return self._pretty_str(priorized_keys)
+        keys = list(self._keys) + sorted(self._extra.keys())
+        width = max(max(len(key) for key in keys), 16)
+        return "\n".join(
+            "{0}: {1}".format(key.rjust(width), self[key]) for key in keys)
 
     def _repr_pretty_(self, p, cycle):  # pragma: no cover
         p.text(str(self))
@@ -117,6 +278,10 @@ class TraceBuffer(object):
         Standard header info for an Obspy Trace.
     maxlen
         Maximum length of trace in samples.
+    gaps
+        How to keep track of missing data, see `NumpyDeque`.
+    dtype
+        Data-type to store data as, see `NumpyDeque`.
 
     Examples
     --------
@@ -139,14 +304,19 @@ class TraceBuffer(object):
             self,
             data: np.ndarray,
             header: Union[dict, Stats, BufferStats],
-            maxlen: int
+            maxlen: int,
+            gaps: str = "mask",
+            dtype: Union[str, np.dtype] = None,
     ):
         # Take the right-most samples
-        self.data = NumpyDeque(data, maxlen=maxlen)
+        self.data = NumpyDeque(data, maxlen=maxlen, gaps=gaps, dtype=dtype)
         header = copy.deepcopy(header)
         # We need to make sure that starttime is correctly set
         self.stats = BufferStats(header)
-        self.stats.npts = len(self.data.data)
+        self.stats.npts = self.data.maxlen
+        self._writes = _WriteLog()
+        # Ingest and readers can be in different threads
+        self._lock = _SeqLock()
 
     def __repr__(self) -> str:  # pragma: no cover
         return "TraceBuffer(data={0}, header={1}, maxlen={2})".format(
@@ -156,6 +326,11 @@ class TraceBuffer(object):
         """ Length of buffer in samples. """
         return len(self.data)
 
+    @property
+    def nbytes(self) -> int:
+        """ Bytes used to store the data and gaps. """
+        return self.data.nbytes
+
     def __add__(self, other):
         new = self.copy()
         new.add_trace(other)
@@ -170,6 +345,11 @@ class TraceBuffer(object):
         """ Length of buffer in seconds. """
         return self.__len__() * self.stats.delta
 
+    @property
+    def gap_fraction(self) -> float:
+        """ Fraction of the buffer that is missing data. """
+        return self.data.gap_fraction
+
     def get_id(self) -> str:
         """
         Return a SEED compatible identifier of the trace.
@@ -178,8 +358,9 @@ class TraceBuffer(object):
         -------
             The SEED ID of the trace.
         """
-        seed_formatter = "{network}.{station}.{location}.{channel}"
-        return seed_formatter.format(**self.stats)
+        stats = self.stats
+        return "{0}.{1}.{2}.{3}".format(
+            stats.network, stats.station, stats.location, stats.channel)
 
     id = property(get_id)
 
@@ -257,7 +438,7 @@ class TraceBuffer(object):
         >>> print(trace_buffer.stats.endtime)
         2018-01-01T00:00:34.000000Z
         >>> print(trace_buffer.data) # doctest: +NORMALIZE_WHITESPACE
-        NumpyDeque(data=[15 16 17 18 19 -- -- -- -- -- 0 1 2 3 4], maxlen=15)
+        NumpyDeque(data=[14 15 16 17 18 19 -- -- -- -- 0 1 2 3 4], maxlen=15)
 
         Add a trace that starts one sample after the current trace ends
 
@@ -272,10 +453,52 @@ class TraceBuffer(object):
         2018-01-01T00:00:35.000000Z
         >>> trace_buffer.add_trace(trace)
         >>> print(trace_buffer.data) # doctest: +NORMALIZE_WHITESPACE
-        NumpyDeque(data=[-- -- -- -- -- 0 1 2 3 4 0 1 2 3 4], maxlen=15)
+        NumpyDeque(data=[19 -- -- -- -- 0 1 2 3 4 0 1 2 3 4], maxlen=15)
         """
         if isinstance(trace, TraceBuffer):
             trace = trace.trace
+        with self._lock:
+            self._add_trace(trace)
+
+    def resize(self, maxlen: int) -> None:
+        """
+        Change the maximum length of the buffer in place.
+
+        The newest data are kept, see `NumpyDeque.resize`. Safe to call
+        while data are added from another thread. Resizing to the same length
+        does nothing. Cursors from `read_since` taken before resizing stay
+        valid unless data were dropped, in which case they get all the data.
+
+        Parameters
+        ----------
+        maxlen
+            New maximum length in samples.
+
+        Examples
+        --------
+        >>> from obspy import read
+        >>> st = read()
+        >>> trace_buffer = TraceBuffer(
+        ...     data=st[0].data, header=st[0].stats, maxlen=100)
+        >>> trace_buffer.resize(50)
+        >>> trace_buffer.stats.npts
+        50
+        >>> trace_buffer.stats.starttime
+        UTCDateTime(2009, 8, 24, 0, 20, 32, 500000)
+        """
+        with self._lock:
+            if maxlen == self.data.maxlen:
+                return
+            n_valid = len(self.data)
+            self.data.resize(maxlen)
+            self.stats.npts = maxlen
+            if len(self.data) < n_valid:
+                # Written ranges are times, so they only go stale when data
+                # are dropped.
+                self._writes = _WriteLog()
+
+    def _add_trace(self, trace: Trace) -> None:
+        """ Add a trace to the buffer - the write lock must be held. """
         # Check that stats match
         assert self.id == trace.id, "IDs {0} and {1} differ".format(
             self.id, trace.id)
@@ -285,47 +508,49 @@ class TraceBuffer(object):
         assert self.stats.calib == trace.stats.calib, (
             "Calibration factors {0} and {1} differ".format(
                 self.stats.calib, trace.stats.calib))
-        # Remove older data than our minimum starttime - faster to if this.
-        if trace.stats.starttime < self.stats.starttime:
-            trace = trace.slice(starttime=self.stats.starttime)
-            if len(trace) == 0:
-                return
-        # If data are newer in trace than in self.
-        if trace.stats.endtime > self.stats.endtime:
-            # If there is overlap
-            if trace.stats.starttime <= self.stats.endtime:
-                old_data = trace.slice(endtime=self.stats.endtime).data
-                insert_start = -len(old_data)
-                self.data.insert(old_data, insert_start)
-                new_data = trace.slice(
-                    starttime=self.stats.endtime + self.stats.delta).data
-            # If there is a gap - defined as more than 1.5 samples. Coping with
-            # rounding errors in UTCDateTime.
-            elif trace.stats.starttime >= self.stats.endtime + (1.5 * self.stats.delta):
-                new_data = np.empty(
-                    trace.stats.npts +
-                    int(self.stats.sampling_rate *
-                        (trace.stats.starttime - self.stats.endtime)),
-                    dtype=trace.data.dtype)
-                mask = np.ones_like(new_data)
-                new_data[-trace.stats.npts:] = trace.data
-                mask[-trace.stats.npts:] = 0
-                new_data = np.ma.masked_array(new_data, mask=mask)
-            # Otherwise just extend with the new data.
+        stats = self.stats
+        data = trace.data
+        if len(data) == 0:
+            return
+        # Work in samples relative to the last sample in the buffer (0), so
+        # that data are written straight from views of trace.data.
+        start_ns = trace.stats.starttime.ns
+        end_ns = trace.stats.endtime.ns
+        offset = stats.ns_to_samples(start_ns - stats.endtime_ns)
+        first = int(round(offset))
+        shift = offset - first
+        if start_ns - stats.endtime_ns > _TIME_TOLERANCE_NS:
+            # Starts after the buffer: less than 1.5 samples later is
+            # contiguous, coping with rounding errors in time-stamps.
+            first = max(first, 1)
+        last = first + len(data) - 1
+        oldest = 1 - self.data.maxlen
+        # Remove older data than our minimum starttime
+        if last < oldest:
+            return
+        if first < oldest:
+            data = data[oldest - first:]
+            start_ns += stats.samples_to_ns(oldest - first)
+            first = oldest
+        if last > 0:
+            # Data are newer in trace than in self.
+            if first <= 0:
+                # Overwrite the overlap, then extend with the rest
+                self.data.insert(data[:1 - first], first - 1)
+                self.data.extend(data[1 - first:])
             else:
-                new_data = trace.data
-            self.data.extend(new_data)
-            self.stats.endtime = trace.stats.endtime
+                if first > 1:
+                    self.data.extend_masked(first - 1)
+                self.data.extend(data)
+            stats.endtime_ns = end_ns
         else:
             # No new times covered - insert old data into array.
-            insert_start = (trace.stats.starttime -
-                            self.stats.starttime) * self.stats.sampling_rate
             # Cope with small shifts due to sampling time-stamp rounding
-            assert abs(insert_start - int(insert_start)) < .1, \
+            assert abs(shift) < .1, \
                 "Traces are not sampled at the same base time-stamp, {0} != {1}".format(
-                    int(insert_start), insert_start)
-            self.data.insert(trace.data, int(insert_start))
-        self.stats.npts = len(self.data.data)
+                    first - oldest, first - oldest + shift)
+            self.data.insert(data, first - oldest)
+        self._writes.record(start_ns * 1e-9, end_ns * 1e-9)
 
     @property
     def trace(self) -> Trace:
@@ -337,7 +562,76 @@ class TraceBuffer(object):
         A trace with the buffer's data and stats. If there are gaps in the
         buffer they will be masked.
         """
-        return Trace(header=self.stats.__dict__, data=self.data.data.copy())
+        return self._lock.read(lambda: Trace(
+            header=self.stats.to_dict(), data=self.data.data.copy()))
+
+    def snapshot(self) -> Trace:
+        """
+        Get a read-only trace representation of the buffer.
+
+        Unlike `trace`, the data are not copied for every call: the trace
+        shares a read-only array with any other snapshot of the same version
+        of the buffer, and later additions to the buffer do not change it.
+
+        Returns
+        -------
+        A trace with the buffer's data and stats. If there are gaps in the
+        buffer they will be masked.
+        """
+        return self._lock.read(lambda: Trace(
+            header=self.stats.to_dict(), data=self.data.snapshot()))
+
+    @property
+    def cursor(self) -> tuple:
+        """
+        The cursor that `read_since` would return now, without reading any
+        data: compare cursors to check for new data.
+        """
+        return self._lock.read(lambda: self._writes.cursor)
+
+    def read_since(self, cursor: tuple = None, pad: float = 0.) -> tuple:
+        """
+        Get the data added to the buffer since a cursor.
+
+        Parameters
+        ----------
+        cursor
+            Cursor returned by a previous call. If None, or if the cursor is
+            too old, all the data are returned.
+        pad
+            Seconds of data before each new section to include, e.g. to
+            give filters time to settle.
+
+        Returns
+        -------
+        Tuple of (list of traces, cursor). Each trace covers one
+        contiguous section of new data, masked where there are gaps.
+        """
+        return self._lock.read(self._read_since, cursor, pad)
+
+    def _read_since(self, cursor: tuple, pad: float) -> tuple:
+        ranges = self._writes.since(cursor)
+        first = self.stats.starttime_ns * 1e-9
+        if ranges is None:
+            ranges = [(first, self.stats.endtime_ns * 1e-9)]
+        sampling_rate = self.stats.sampling_rate
+        traces = []
+        for start, end in _merge_ranges(ranges, pad, 1.5 / sampling_rate):
+            start = max(0, int(round((start - first) * sampling_rate)))
+            end = min(self.data.maxlen - 1,
+                      int(round((end - first) * sampling_rate)))
+            if end < start:
+                continue
+            data = self.data.read(start, end - start + 1)
+            if np.ma.is_masked(data) and data.mask.all():
+                continue
+            header = {key: self.stats[key] for key in (
+                "network", "station", "location", "channel", "calib")}
+            header.update(
+                sampling_rate=sampling_rate,
+                starttime=self.stats.starttime + start / sampling_rate)
+            traces.append(Trace(data=data, header=header))
+        return traces, self._writes.cursor
 
     def is_full(self, strict=False) -> bool:
         """
@@ -353,51 +647,146 @@ class TraceBuffer(object):
             Whether to check the whole deque (True), or just the start and end
             (False: default).
         """
-        return self.data.is_full(strict=strict)
+        return self._lock.read(self.data.is_full, strict=strict)
 
     def copy(self):
         """
         Generate a copy of the buffer.
 
+        The copy shares memory with this buffer until either of them is
+        written to, see `NumpyDeque.copy`.
+
         Returns
         -------
-        A deepcopy of the tracebuffer.
+        An independent copy of the tracebuffer.
+
+        Examples
+        --------
+        >>> from obspy import read
+        >>> trace_buffer = TraceBuffer(
+        ...     data=read()[0].data, header=read()[0].stats, maxlen=100)
+        >>> trace_copy = trace_buffer.copy()
+        >>> trace_copy.data._data is trace_buffer.data._data
+        True
+        >>> trace_copy.add_trace(read()[0].slice(
+        ...     starttime=trace_buffer.stats.endtime))
+        >>> trace_copy.data._data is trace_buffer.data._data
+        False
         """
-        return TraceBuffer(
-            data=copy.deepcopy(self.data.data),
-            header=copy.deepcopy(self.stats.__dict__),
-            maxlen=copy.deepcopy(self.data.maxlen))
+        new = TraceBuffer.__new__(TraceBuffer)
+        # Copying has to be atomic with respect to writes to the storage
+        with self._lock:
+            new.data = self.data.copy()
+            new.stats = self.stats.copy()
+        new._writes = _WriteLog()
+        new._lock = _SeqLock()
+        return new
+
+
+def _deque_write(method):
+    """
+    Mark a NumpyDeque method as writing to the deque.
+
+    The version of the deque is odd while the write is in progress and
+    changes again once the head, gaps and valid count are all up to date, so
+    snapshots taken part-way through a write are never reused.
+    """
+    @wraps(method)
+    def write(self, *args, **kwargs):
+        if self._version % 2:
+            # Called from another write, which will finish the version
+            return method(self, *args, **kwargs)
+        self._own()
+        self._version += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._version += 1
+    return write
 
 
 class NumpyDeque(object):
     """
     Simple implementation of necessary deque methods for 1D numpy arrays.
 
+    Data are stored in a fixed-size ring: new data overwrite the oldest
+    samples in place and a head pointer tracks the logical start of the
+    deque, so the cost of adding data depends only on the length of the new
+    data, not on maxlen. A contiguous array is only built when `data` is
+    read.
+
     Parameters
     ----------
     data
         Data to initialize the deque with
     maxlen
         Maximum length of the deque.
+    gaps
+        How to keep track of missing data: either "mask" for a boolean mask
+        of the same length as the deque, or "intervals" for a list of the
+        start and end of each gap. Intervals use less memory and are faster
+        when there are few gaps.
+    dtype
+        Data-type to store data as. Data are converted (following numpy
+        casting rules, so floats are truncated to integers) as they are
+        added. Defaults to the type of the first element of `data`.
+
+    Examples
+    --------
+    >>> np_deque = NumpyDeque(data=[0, 1, 2], maxlen=5)
+    >>> np_deque.extend([3, 4, 5, 6])
+    >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+    NumpyDeque(data=[2 3 4 5 6], maxlen=5)
+    >>> np_deque.extendleft([9])
+    >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+    NumpyDeque(data=[9 2 3 4 5], maxlen=5)
+
+    Using gap intervals
+
+    >>> np_deque = NumpyDeque(data=[0, 1, 2], maxlen=5, gaps="intervals")
+    >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+    NumpyDeque(data=[-- -- 0 1 2], maxlen=5)
+    >>> print(np_deque.filled(fill_value=-1))
+    [-1 -1  0  1  2]
+
+    Storing data as 32-bit floats
+
+    >>> np_deque = NumpyDeque(data=np.arange(3.), maxlen=5, dtype="float32")
+    >>> np_deque.dtype
+    dtype('float32')
+    >>> np_deque.nbytes
+    25
     """
+    _gap_types = {"mask": None, "intervals": None}  # Filled below
 
     def __init__(
             self,
             data: Union[list, np.ndarray, np.ma.MaskedArray],
-            maxlen: int
+            maxlen: int,
+            gaps: str = "mask",
+            dtype: Union[str, np.dtype] = None,
     ):
+        assert gaps in self._gap_types, "gaps must be one of {0}".format(
+            list(self._gap_types.keys()))
         self._maxlen = maxlen
-        self._data = np.empty(maxlen, dtype=type(data[0]))
-        length = min(maxlen, len(data))
-        if isinstance(data, np.ma.MaskedArray):
-            mask_value = data.mask
-            data = data.data
-        else:
-            mask_value = np.zeros(length)
-        self._data[-length:] = data[-length:]
-        self._mask = np.zeros_like(self._data, dtype=np.bool)
-        self._mask[0:-length] = np.ones(maxlen - length)
-        self._mask[-length:] = mask_value
+        # The ring is the first maxlen elements of the storage, which is
+        # longer if the deque has been shrunk.
+        self._storage = self._data = np.empty(maxlen, dtype=dtype or getattr(
+            data, "dtype", None) or type(data[0]))
+        # Storage index of the left-most (oldest) element
+        self._head = 0
+        # Missing elements, in storage order
+        self._gaps = self._gap_types[gaps](maxlen)
+        # Running count of unmasked elements
+        self._valid = 0
+        # Odd while writing, used to match snapshots to the data
+        self._version = 0
+        self._snapshot = None
+        # Held by readers while they fill or view the snapshot memory
+        self._snapshot_lock = threading.Lock()
+        # Set while storage is shared with copies of the deque
+        self._share = None
+        self.extend(data)
 
     def __repr__(self):
         data_str = self.data.__str__()
@@ -406,8 +795,21 @@ class NumpyDeque(object):
         return "NumpyDeque(data={0}, maxlen={1})".format(
             data_str, self.maxlen)
 
+    def __getstate__(self):
+        # Spare storage is not copied or pickled
+        state = self.__dict__.copy()
+        state["_storage"] = None
+        state["_share"] = None
+        state["_snapshot_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._storage = self._data
+        self._snapshot_lock = threading.Lock()
+
     def __len__(self):
-        return sum(~self._mask)
+        return self._valid
 
     def __getitem__(self, item):
         return self.data.__getitem__(item)
@@ -416,11 +818,232 @@ class NumpyDeque(object):
     def maxlen(self) -> int:
         return self._maxlen
 
+    @property
+    def gaps(self) -> str:
+        """ How missing data are tracked, "mask" or "intervals". """
+        return self._gaps.name
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes used to store the data and gaps. """
+        return self._storage.nbytes + self._gaps.nbytes
+
+    @property
+    def gap_count(self) -> int:
+        """ Number of masked (missing) elements in the deque. """
+        return self.maxlen - self._valid
+
+    @property
+    def gap_fraction(self) -> float:
+        """ Fraction of the deque that is masked (missing). """
+        return self.gap_count / self.maxlen
+
+    @property
+    def mask(self) -> np.ndarray:
+        """ Boolean array, True where data are missing. """
+        mask = np.empty(self.maxlen, dtype=bool)
+        for dest, source in self._spans(0, self.maxlen):
+            mask[source] = self._gaps.get(dest.start, dest.stop)
+        return mask
+
     @property
     def data(self) -> np.ndarray:
-        if self._mask.sum() > 0:
-            return np.ma.masked_array(self._data, mask=self._mask)
-        return self._data
+        if self._head == 0:
+            data = self._data
+        else:
+            data = np.concatenate(
+                (self._data[self._head:], self._data[:self._head]))
+        if self.gap_count > 0:
+            return np.ma.masked_array(data, mask=self.mask)
+        return data
+
+    def copy(self):
+        """
+        Get a copy-on-write copy of the deque.
+
+        The copy shares storage with this deque: whichever is written to
+        first copies the storage before writing, so copies are cheap and
+        only use more memory once they differ.
+
+        Returns
+        -------
+        An independent copy of the deque.
+
+        Examples
+        --------
+        >>> np_deque = NumpyDeque(data=[0, 1, 2], maxlen=5)
+        >>> np_copy = np_deque.copy()
+        >>> np_copy.extend([3, 4])
+        >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+        NumpyDeque(data=[-- -- 0 1 2], maxlen=5)
+        >>> print(np_copy) # doctest: +NORMALIZE_WHITESPACE
+        NumpyDeque(data=[0 1 2 3 4], maxlen=5)
+        """
+        share = self._share
+        if share is None:
+            share = self._share = _StorageShare()
+        with share.lock:
+            share.count += 1
+        new = NumpyDeque.__new__(NumpyDeque)
+        new.__dict__.update(self.__dict__)
+        # Spare storage and snapshots are not shared
+        new._storage = self._data
+        new._gaps = self._gaps.copy()
+        new._snapshot = None
+        new._snapshot_lock = threading.Lock()
+        return new
+
+    @classmethod
+    def _from_mapped(cls, data: np.ndarray, gap_list: list,
+                     gaps: str = "mask"):
+        """
+        Make a full-length deque that reads from a read-only array, e.g. a
+        memory-mapped file, until it is first written to.
+
+        Parameters
+        ----------
+        data
+            Data of the deque, oldest first. Not copied until the first
+            write.
+        gap_list
+            (start, stop) ranges of missing elements.
+        gaps
+            How to keep track of missing data, see `NumpyDeque`.
+        """
+        maxlen = len(data)
+        new = cls.__new__(cls)
+        new._maxlen = maxlen
+        new._storage = new._data = data
+        new._head = 0
+        new._gaps = cls._gap_types[gaps](maxlen)
+        new._valid = -new._gaps.set(0, maxlen, False)
+        for start, stop in gap_list:
+            new._valid -= new._gaps.set(start, stop, True)
+        new._version = 0
+        new._snapshot = None
+        new._snapshot_lock = threading.Lock()
+        # The array counts as another sharer, so the first write copies it
+        new._share = _StorageShare()
+        new._share.count += 1
+        return new
+
+    def _own(self) -> None:
+        """ Stop sharing storage with copies - called before writing. """
+        share = self._share
+        if share is None:
+            return
+        with share.lock:
+            if share.count > 1:
+                self._storage = self._data = self._data.copy()
+                self._gaps.own()
+            share.count -= 1
+        self._share = None
+
+    def filled(self, fill_value=0) -> np.ndarray:
+        """
+        Get a contiguous copy of the data with gaps filled.
+
+        Parameters
+        ----------
+        fill_value
+            Value to put in the gaps.
+
+        Returns
+        -------
+        Array of the data - never masked.
+        """
+        data = self.read(0, self.maxlen)
+        if isinstance(data, np.ma.MaskedArray):
+            return data.filled(fill_value)
+        return data
+
+    def snapshot(self) -> Union[np.ndarray, np.ma.MaskedArray]:
+        """
+        Get a read-only, contiguous view of the current data.
+
+        The contiguous copy is only made once per version of the deque: later
+        snapshots of unchanged data share the same memory. When the data
+        have changed, the memory of the previous snapshot is re-used if no
+        views of it are still held. Readers take turns to refill the
+        snapshot, and only copies that no write overlapped are re-used.
+
+        Returns
+        -------
+        Read-only array, masked if there are gaps.
+
+        Examples
+        --------
+        >>> np_deque = NumpyDeque(data=[0, 1, 2], maxlen=5)
+        >>> snapshot = np_deque.snapshot()
+        >>> np_deque.extend([3, 4, 5])
+        >>> print(snapshot)
+        [-- -- 0 1 2]
+        >>> print(np_deque.snapshot())
+        [1 2 3 4 5]
+        """
+        with self._snapshot_lock:
+            return self._snapshot_view()
+
+    def _snapshot_view(self) -> Union[np.ndarray, np.ma.MaskedArray]:
+        """ Get a snapshot view, refilling the snapshot if it is stale. """
+        snapshot = self._snapshot
+        version = self._version
+        if snapshot is None or snapshot.version != version:
+            if (snapshot is None or snapshot.held or
+                    snapshot.data.shape != self._data.shape or
+                    snapshot.data.dtype != self._data.dtype):
+                # Readers still hold the old memory, leave it to them.
+                snapshot = _DequeSnapshot(
+                    np.empty_like(self._data),
+                    np.empty(self.maxlen, dtype=bool))
+            snapshot.version = None
+            snapshot.masked = self.gap_count > 0
+            for dest, source in self._spans(0, self.maxlen):
+                snapshot.data[source] = self._data[dest]
+                if snapshot.masked:
+                    snapshot.mask[source] = self._gaps.get(
+                        dest.start, dest.stop)
+            if version % 2 == 0 and self._version == version:
+                # Only reuse copies that no write overlapped
+                snapshot.version = version
+            self._snapshot = snapshot
+        return snapshot.view()
+
+    def read(self, start: int,
+             length: int) -> Union[np.ndarray, np.ma.MaskedArray]:
+        """
+        Get a copy of part of the deque.
+
+        Parameters
+        ----------
+        start
+            Index of the first element (0 is the left of the deque).
+        length
+            Number of elements.
+
+        Returns
+        -------
+        Array, masked if there are gaps in the range.
+        """
+        assert 0 <= start and start + length <= self.maxlen, (
+            "Range {0}-{1} is outside of the deque".format(
+                start, start + length))
+        data = np.empty(length, dtype=self._data.dtype)
+        spans = self._spans(start, length)
+        masked = False
+        for dest, source in spans:
+            data[source] = self._data[dest]
+            masked = masked or self._gaps.any(dest.start, dest.stop)
+        if not masked:
+            return data
+        mask = np.empty(length, dtype=bool)
+        for dest, source in spans:
+            mask[source] = self._gaps.get(dest.start, dest.stop)
+        return np.ma.masked_array(data, mask=mask)
 
     def is_full(self, strict=False) -> bool:
         """
@@ -437,9 +1060,87 @@ class NumpyDeque(object):
             (False: default).
         """
         if strict:
-            return ~np.any(self._mask)
-        return ~np.any([self._mask[0], self._mask[-1]])
+            return self.gap_count == 0
+        return not (self._gaps.is_gap(self._head) or
+                    self._gaps.is_gap((self._head - 1) % self.maxlen))
+
+    @_deque_write
+    def resize(self, maxlen: int) -> None:
+        """
+        Change the maximum length of the deque in place.
+
+        The newest (right-most) data are kept: shrinking removes the oldest
+        elements and growing adds masked elements to the left. Memory is
+        only allocated when the deque grows beyond the longest length it
+        has had.
+
+        Parameters
+        ----------
+        maxlen
+            New maximum length of the deque.
+
+        Examples
+        --------
+        >>> np_deque = NumpyDeque(data=[0, 1, 2, 3], maxlen=5)
+        >>> np_deque.resize(3)
+        >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+        NumpyDeque(data=[1 2 3], maxlen=3)
+        >>> np_deque.resize(5)
+        >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+        NumpyDeque(data=[-- -- 1 2 3], maxlen=5)
+        """
+        assert maxlen > 0, "maxlen must be positive"
+        if maxlen == self.maxlen:
+            return
+        keep = min(maxlen, self.maxlen)
+        kept = self.read(self.maxlen - keep, keep)
+        if len(self._storage) < maxlen:
+            self._storage = np.empty(maxlen, dtype=self._data.dtype)
+        self._data = self._storage[0:maxlen]
+        self._maxlen = maxlen
+        self._head = 0
+        self._gaps.reset(maxlen)
+        self._valid = 0
+        self._write(maxlen - keep, np.ma.getdata(kept), np.ma.getmask(kept))
+
+    def _spans(self, start: int, length: int) -> list:
+        """
+        Map a logical range of the deque onto storage.
+
+        Parameters
+        ----------
+        start
+            Logical index of the first element (0 is the left of the deque).
+        length
+            Number of elements.
+
+        Returns
+        -------
+        List of (storage slice, source slice) tuples - two if the range wraps
+        around the end of the storage, otherwise one.
+        """
+        i = (self._head + start) % self.maxlen
+        first = min(length, self.maxlen - i)
+        spans = [(slice(i, i + first), slice(0, first))]
+        if first < length:
+            spans.append((slice(0, length - first), slice(first, length)))
+        return spans
+
+    def _write(
+            self,
+            start: int,
+            values: Union[list, np.ndarray],
+            mask: Union[bool, np.ndarray],
+    ) -> None:
+        """ Write values and mask into the deque from logical `start`. """
+        for dest, source in self._spans(start, len(values)):
+            self._data[dest] = values[source]
+            if np.isscalar(mask):
+                self._valid -= self._gaps.set(dest.start, dest.stop, mask)
+            else:
+                self._valid -= self._gaps.set_mask(dest.start, mask[source])
 
+    @_deque_write
     def extend(
             self,
             other: Union[list, np.ndarray, np.ma.MaskedArray]
@@ -457,19 +1158,47 @@ class NumpyDeque(object):
         """
         other_length = len(other)
         if isinstance(other, np.ma.MaskedArray):
-            mask_value = other.mask
+            mask_value = np.ma.getmask(other)
             other = other.data
         else:
-            mask_value = np.zeros(other_length)
+            mask_value = False
         if other_length >= self.maxlen:
-            self._data[0:] = other[-self.maxlen:]
-            self._mask[:] = mask_value[-self.maxlen:]
+            self._head = 0
+            self._write(0, other[-self.maxlen:], mask_value if np.isscalar(
+                mask_value) else mask_value[-self.maxlen:])
+            return
+        # Overwrite the oldest elements, then move the head past them.
+        self._write(0, other, mask_value)
+        self._head = (self._head + other_length) % self.maxlen
+
+    @_deque_write
+    def extend_masked(self, length: int) -> None:
+        """
+        Put masked elements onto the right of the deque.
+
+        Used to add gaps without making an array for them.
+
+        Parameters
+        ----------
+        length
+            Number of masked elements to add.
+
+        Examples
+        --------
+        >>> np_deque = NumpyDeque(data=[0, 1, 2], maxlen=5)
+        >>> np_deque.extend_masked(2)
+        >>> print(np_deque) # doctest: +NORMALIZE_WHITESPACE
+        NumpyDeque(data=[0 1 2 -- --], maxlen=5)
+        """
+        if length >= self.maxlen:
+            self._head = 0
+            self._valid -= self._gaps.set(0, self.maxlen, True)
             return
-        self._data[0:-other_length] = self._data[other_length:]
-        self._mask[0:-other_length] = self._mask[other_length:]
-        self._data[-other_length:] = other
-        self._mask[-other_length:] = mask_value
+        for dest, _ in self._spans(0, length):
+            self._valid -= self._gaps.set(dest.start, dest.stop, True)
+        self._head = (self._head + length) % self.maxlen
 
+    @_deque_write
     def extendleft(
             self,
             other: Union[list, np.ndarray, np.ma.MaskedArray]
@@ -487,18 +1216,18 @@ class NumpyDeque(object):
         """
         other_length = len(other)
         if isinstance(other, np.ma.MaskedArray):
-            mask_value = other.mask
+            mask_value = np.ma.getmask(other)
             other = other.data
         else:
-            mask_value = np.zeros(other_length)
+            mask_value = False
         if other_length >= self.maxlen:
-            self._data[0:] = other[0:self.maxlen]
-            self._mask[:] = mask_value[0:self.maxlen]
+            self._head = 0
+            self._write(0, other[0:self.maxlen], mask_value if np.isscalar(
+                mask_value) else mask_value[0:self.maxlen])
             return
-        self._data[other_length:] = self._data[0:-other_length]
-        self._mask[other_length:] = self._mask[0:-other_length]
-        self._data[0:other_length] = other
-        self._mask[0:other_length] = mask_value
+        # Move the head left over the newest elements, then overwrite them.
+        self._head = (self._head - other_length) % self.maxlen
+        self._write(0, other, mask_value)
 
     def append(self, other) -> None:
         """
@@ -530,6 +1259,7 @@ class NumpyDeque(object):
             raise TypeError("other must be a single item, use extendleft")
         self.extendleft([other])
 
+    @_deque_write
     def insert(
             self,
             other: Union[list, np.ndarray, np.ma.MaskedArray],
@@ -584,67 +1314,364 @@ class NumpyDeque(object):
         """
         if not isinstance(other, Sized):
             other = [other]
-        stop = index + len(other)
         if len(other) > self.maxlen:
             Logger.warning("Array longer than max-length, reverting to extend")
             self.extend(other)
-        elif isinstance(other, np.ma.MaskedArray):
-            # Only take the non-masked bits
-            for i in range(len(other)):
-                if not other.mask[i]:
-                    self._data[index + i] = other.data[i]
-                    self._mask[index + i] = 0
+            return
+        if index < 0:
+            index += self.maxlen
+        assert 0 <= index and index + len(other) <= self.maxlen, (
+            "Cannot insert {0} elements at {1} in deque of length {2}".format(
+                len(other), index, self.maxlen))
+        if isinstance(other, np.ma.MaskedArray):
+            # Only take the non-masked bits - scatter them into storage
+            keep = ~np.ma.getmaskarray(other)
+            for dest, source in self._spans(index, len(other)):
+                _keep = keep[source]
+                np.copyto(self._data[dest], other.data[source],
+                          casting="unsafe", where=_keep)
+                self._valid -= self._gaps.unmask(dest.start, _keep)
         else:
-            if stop == 0:
-                self._data[index:] = other
-                self._mask[index:] = 0
-            else:
-                self._data[index:stop] = other
-                self._mask[index:stop] = 0
+            self._write(index, other, False)
 
 
-class Buffer(object):
+class _StorageShare(object):
     """
-    Container for TraceBuffers.
+    Count of NumpyDeques sharing storage after copy-on-write copies.
+
+    Every deque but the last to write to the shared storage copies it
+    first, the last writes in place.
+    """
+    def __init__(self):
+        self.count = 1
+        self.lock = threading.Lock()
+
+
+class _MaskGaps(object):
+    """
+    Gaps in a ring buffer stored as a boolean mask, True where missing.
+
+    All methods that change the gaps return the change in the number of
+    missing elements.
 
     Parameters
     ----------
-    traces
-        Stream or List of TraceBuffers or Traces
     maxlen
-        Maximum length for TraceBuffers in seconds.
+        Length of the ring.
+    """
+    name = "mask"
 
-    Examples
-    --------
+    def __init__(self, maxlen: int):
+        self._storage = self._mask = np.ones(maxlen, dtype=bool)
 
-    >>> from obspy import read
-    >>> st = read()
-    >>> print(st)
-    3 Trace(s) in Stream:
-    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
-    BW.RJOB..EHN | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
-    BW.RJOB..EHE | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
-    >>> buffer = Buffer(st, maxlen=10.)
-    >>> print(buffer)
-    Buffer(3 traces, maxlen=10.0)
+    def __getstate__(self):
+        return {"_mask": self._mask}
+
+    def __setstate__(self, state):
+        self._storage = self._mask = state["_mask"]
+
+    @property
+    def nbytes(self) -> int:
+        return self._storage.nbytes
+
+    def copy(self):
+        """ Get a copy that shares the mask until `own` is called. """
+        new = _MaskGaps.__new__(_MaskGaps)
+        new._storage = new._mask = self._mask
+        return new
+
+    def own(self) -> None:
+        """ Copy the mask so that it is no longer shared. """
+        self._storage = self._mask = self._mask.copy()
+
+    def reset(self, maxlen: int) -> None:
+        """ Make a ring of maxlen that is all missing, re-using memory. """
+        if len(self._storage) < maxlen:
+            self._storage = np.empty(maxlen, dtype=bool)
+        self._mask = self._storage[0:maxlen]
+        self._mask[:] = True
+
+    def get(self, start: int, stop: int) -> np.ndarray:
+        return self._mask[start:stop]
+
+    def any(self, start: int, stop: int) -> bool:
+        return bool(self._mask[start:stop].any())
+
+    def is_gap(self, index: int) -> bool:
+        return bool(self._mask[index])
+
+    def set(self, start: int, stop: int, masked: bool) -> int:
+        """ Set all of start to stop as missing (masked) or not. """
+        n_masked = np.count_nonzero(self._mask[start:stop])
+        self._mask[start:stop] = masked
+        return (stop - start - n_masked) if masked else -n_masked
+
+    def set_mask(self, start: int, mask: np.ndarray) -> int:
+        """ Set the mask from start to the values of mask. """
+        stop = start + len(mask)
+        change = np.count_nonzero(mask) - np.count_nonzero(
+            self._mask[start:stop])
+        self._mask[start:stop] = mask
+        return change
+
+    def unmask(self, start: int, keep: np.ndarray) -> int:
+        """ Set elements from start where keep is True as not missing. """
+        stop = start + len(keep)
+        change = -np.count_nonzero(self._mask[start:stop] & keep)
+        self._mask[start:stop] &= ~keep
+        return change
+
+
+class _IntervalGaps(object):
     """
-    def __init__(
-        self,
-        traces: Union[Stream, List[Union[Trace, TraceBuffer]]] = None,
-        maxlen: float = None
+    Gaps in a ring buffer stored as sorted, non-overlapping intervals.
+
+    Each gap is held as a half-open [start, stop) range of storage indexes,
+    so the cost of queries and updates depends on the number of gaps rather
+    than the length of the ring. All methods that change the gaps return the
+    change in the number of missing elements.
+
+    Parameters
+    ----------
+    maxlen
+        Length of the ring.
+    """
+    name = "intervals"
+
+    def __init__(self, maxlen: int):
+        self.reset(maxlen)
+
+    def __repr__(self):
+        return "_IntervalGaps({0})".format(
+            list(zip(self._starts, self._stops)))
+
+    def reset(self, maxlen: int) -> None:
+        """ Make a ring of maxlen that is all missing. """
+        self._starts, self._stops = [0], [maxlen]
+
+    def copy(self):
+        """ Get an independent copy of the gaps. """
+        new = _IntervalGaps.__new__(_IntervalGaps)
+        new._starts, new._stops = list(self._starts), list(self._stops)
+        return new
+
+    def own(self) -> None:
+        """ Nothing to do - intervals are never shared. """
+        return
+
+    @property
+    def nbytes(self) -> int:
+        # Pointer arrays of the lists and the integers in them
+        return (sys.getsizeof(self._starts) + sys.getsizeof(self._stops) +
+                sum(sys.getsizeof(i) for i in self._starts + self._stops))
+
+    def _overlapping(self, start: int, stop: int) -> tuple:
+        """ Indexes of the first and one past the last gap touching range. """
+        return (bisect.bisect_left(self._stops, start),
+                bisect.bisect_right(self._starts, stop))
+
+    def get(self, start: int, stop: int) -> np.ndarray:
+        mask = np.zeros(stop - start, dtype=bool)
+        first, last = self._overlapping(start, stop)
+        for i in range(first, last):
+            mask[max(self._starts[i], start) - start:
+                 min(self._stops[i], stop) - start] = True
+        return mask
+
+    def count(self, start: int, stop: int) -> int:
+        """ Number of missing elements between start and stop. """
+        first, last = self._overlapping(start, stop)
+        return sum(
+            max(0, min(self._stops[i], stop) - max(self._starts[i], start))
+            for i in range(first, last))
+
+    def any(self, start: int, stop: int) -> bool:
+        return self.count(start, stop) > 0
+
+    def is_gap(self, index: int) -> bool:
+        i = bisect.bisect_right(self._starts, index) - 1
+        return i >= 0 and index < self._stops[i]
+
+    def set(self, start: int, stop: int, masked: bool) -> int:
+        """ Set all of start to stop as missing (masked) or not. """
+        if stop <= start:
+            return 0
+        first, last = self._overlapping(start, stop)
+        n_masked = self.count(start, stop)
+        if masked:
+            change = stop - start - n_masked
+            # Merge with the gaps that overlap or touch the range
+            if first < last:
+                start = min(start, self._starts[first])
+                stop = max(stop, self._stops[last - 1])
+            self._starts[first:last] = [start]
+            self._stops[first:last] = [stop]
+            return change
+        starts, stops = [], []
+        if first < last and self._starts[first] < start:
+            starts.append(self._starts[first])
+            stops.append(start)
+        if first < last and self._stops[last - 1] > stop:
+            starts.append(stop)
+            stops.append(self._stops[last - 1])
+        self._starts[first:last] = starts
+        self._stops[first:last] = stops
+        return -n_masked
+
+    def set_mask(self, start: int, mask: np.ndarray) -> int:
+        """ Set the mask from start to the values of mask. """
+        change = 0
+        for run_start, run_stop, value in _runs(mask):
+            change += self.set(start + run_start, start + run_stop, value)
+        return change
+
+    def unmask(self, start: int, keep: np.ndarray) -> int:
+        """ Set elements from start where keep is True as not missing. """
+        change = 0
+        for run_start, run_stop, value in _runs(keep):
+            if value:
+                change += self.set(start + run_start, start + run_stop, False)
+        return change
+
+
+NumpyDeque._gap_types = {"mask": _MaskGaps, "intervals": _IntervalGaps}
+
+
+def _runs(values: np.ndarray) -> list:
+    """
+    Split a boolean array into runs of the same value.
+
+    Returns
+    -------
+    List of (start, stop, value) tuples.
+    """
+    if len(values) == 0:
+        return []
+    edges = np.flatnonzero(values[1:] != values[:-1]) + 1
+    bounds = [0] + edges.tolist() + [len(values)]
+    first = bool(values[0])
+    return [(bounds[i], bounds[i + 1], first ^ bool(i % 2))
+            for i in range(len(bounds) - 1)]
+
+
+class _SnapshotPin(object):
+    """
+    Owner of the memory behind read-only snapshot views.
+
+    Every view made from the pin (and every view of those views) keeps the
+    pin alive, so a weak-reference to the pin shows whether a reader still
+    holds the memory.
+    """
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.__array_interface__ = array.__array_interface__
+
+
+class _DequeSnapshot(object):
+    """
+    Contiguous copy of a NumpyDeque at a given version.
+
+    Parameters
+    ----------
+    data
+        Array to hold the data.
+    mask
+        Array to hold the mask.
+    """
+    def __init__(self, data: np.ndarray, mask: np.ndarray):
+        self.data = data
+        self.mask = mask
+        self.version = None
+        self.masked = False
+        self._pins = []
+
+    @property
+    def held(self) -> bool:
+        """ Whether any views of this snapshot are still in use. """
+        self._pins = [pin for pin in self._pins if pin() is not None]
+        return len(self._pins) > 0
+
+    def _read_only_view(self, array: np.ndarray) -> np.ndarray:
+        pin = _SnapshotPin(array)
+        self._pins.append(weakref.ref(pin))
+        view = np.asarray(pin)
+        view.flags.writeable = False
+        return view
+
+    def view(self) -> Union[np.ndarray, np.ma.MaskedArray]:
+        """ Get a read-only view of the snapshot. """
+        data = self._read_only_view(self.data)
+        if not self.masked:
+            return data
+        return np.ma.masked_array(
+            data, mask=self._read_only_view(self.mask), copy=False)
+
+
+class Buffer(object):
+    """
+    Container for TraceBuffers.
+
+    Parameters
+    ----------
+    traces
+        Stream or List of TraceBuffers or Traces
+    maxlen
+        Maximum length for TraceBuffers in seconds.
+    gaps
+        How to keep track of missing data, see `NumpyDeque`.
+    dtype
+        Data-type to store all channels as, converted as data are added.
+        Defaults to the data-type of the first data for each channel.
+
+    Examples
+    --------
+
+    >>> from obspy import read
+    >>> st = read()
+    >>> print(st)
+    3 Trace(s) in Stream:
+    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
+    BW.RJOB..EHN | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
+    BW.RJOB..EHE | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z | 100.0 Hz, 3000 samples
+    >>> buffer = Buffer(st, maxlen=10.)
+    >>> print(buffer)
+    Buffer(3 traces, maxlen=10.0)
+
+    Storing data as 32-bit floats
+
+    >>> buffer = Buffer(st, maxlen=10., dtype="float32")
+    >>> buffer.stream[0].data.dtype
+    dtype('float32')
+    >>> buffer.bytes_per_channel()["BW.RJOB..EHZ"]
+    5000
+    """
+    def __init__(
+        self,
+        traces: Union[Stream, List[Union[Trace, TraceBuffer]]] = None,
+        maxlen: float = None,
+        gaps: str = "mask",
+        dtype: Union[str, np.dtype] = None,
     ):
         assert traces or maxlen, "Requires at least maxlen or traces."
         assert isinstance(traces, (Stream, list)), "Must be either Stream or list"
         for tr in traces:
             assert isinstance(tr, (Trace, TraceBuffer)), "Must be Trace or TraceBuffer"
         self.traces = []
+        # Lookups of TraceBuffers by seed id, and of seed ids by each code
+        self._index = dict()
+        self._code_index = [dict() for _ in range(4)]
+        self.gaps = gaps
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        # Held while channels are added or replaced
+        self._lock = _SeqLock()
         self._maxlen = maxlen or max(
             [tr.stats.npts * tr.stats.delta for tr in traces])
         for tr in traces:
             if isinstance(tr, Trace):
                 self.traces.append(TraceBuffer(
                     data=tr.data, header=tr.stats,
-                    maxlen=int(tr.stats.sampling_rate * self._maxlen)))
+                    maxlen=int(tr.stats.sampling_rate * self._maxlen),
+                    gaps=gaps, dtype=self.dtype))
             elif isinstance(tr, TraceBuffer):
                 self.traces.append(tr)
         self.sanitize_traces()
@@ -669,8 +1696,133 @@ class Buffer(object):
         return self
 
     def copy(self):
-        return Buffer(traces=[tr.trace for tr in self.traces],
-                      maxlen=self.maxlen)
+        """
+        Generate a copy of the buffer.
+
+        Channels of the copy share memory with this buffer until either
+        side writes to them, so copying a full buffer is fast and does not
+        use more memory, see `NumpyDeque.copy`.
+
+        Returns
+        -------
+        An independent copy of the buffer.
+        """
+        traces = self._lock.read(list, self.traces)
+        return Buffer(traces=[tr.copy() for tr in traces],
+                      maxlen=self.maxlen, gaps=self.gaps, dtype=self.dtype)
+
+    def checkpoint(self, path: str) -> None:
+        """
+        Save the buffer to a directory so that it can be reloaded quickly.
+
+        The data for each channel are written to a numpy file, which is
+        memory-mapped when the checkpoint is loaded: each channel reads from
+        its file until it is first written to, see `from_checkpoint`. The
+        stats and gaps for
+        all channels are kept in a json header. The header is replaced last,
+        so a checkpoint that is interrupted leaves the previous checkpoint
+        readable. Data files are named "buffer.<generation>.<channel>.npy":
+        only files named like that are removed from the directory, other
+        files are left alone.
+
+        Parameters
+        ----------
+        path
+            Directory to write to - will be created if it does not exist.
+
+        Examples
+        --------
+        >>> import tempfile
+        >>> from obspy import read
+        >>> buffer = Buffer(read(), maxlen=60.)
+        >>> with tempfile.TemporaryDirectory() as path:
+        ...     buffer.checkpoint(path)
+        ...     reloaded = Buffer.from_checkpoint(path)
+        >>> print(reloaded)
+        Buffer(3 traces, maxlen=60.0)
+        >>> all(np.array_equal(
+        ...     tr.data.mask, reloaded.select(tr.id)[0].data.mask)
+        ...     for tr in buffer)
+        True
+        """
+        os.makedirs(path, exist_ok=True)
+        # Files from different checkpoints never share a name
+        generation = time.time_ns()
+        channels = []
+        for i, tr in enumerate(list(self.traces)):
+            data, endtime_ns = tr._lock.read(
+                lambda: (tr.data.read(0, tr.data.maxlen), tr.stats.endtime_ns))
+            file_name = _CHECKPOINT_DATA.format(generation, i)
+            np.save(os.path.join(path, file_name), np.ma.getdata(data))
+            channels.append({
+                "file": file_name, "network": tr.stats.network,
+                "station": tr.stats.station, "location": tr.stats.location,
+                "channel": tr.stats.channel,
+                "sampling_rate": float(tr.stats.sampling_rate),
+                "calib": float(tr.stats.calib), "endtime_ns": endtime_ns,
+                "gaps": [(start, stop) for start, stop, masked
+                         in _runs(np.ma.getmaskarray(data)) if masked]})
+        header = {
+            "maxlen": self.maxlen, "gaps": self.gaps,
+            "dtype": None if self.dtype is None else self.dtype.str,
+            "channels": channels}
+        header_file = os.path.join(path, _CHECKPOINT_HEADER)
+        with open(header_file + ".tmp", "w") as f:
+            json.dump(header, f)
+        os.replace(header_file + ".tmp", header_file)
+        # Remove the data from older and interrupted checkpoints
+        current = {channel["file"] for channel in channels}
+        for file_name in os.listdir(path):
+            if (_CHECKPOINT_DATA_RE.match(file_name) and
+                    file_name not in current):
+                os.remove(os.path.join(path, file_name))
+        Logger.debug("Checkpointed {0} channels to {1}".format(
+            len(channels), path))
+
+    @classmethod
+    def from_checkpoint(cls, path: str, maxlen: float = None):
+        """
+        Load a buffer saved by `checkpoint`.
+
+        The data files are memory-mapped rather than read: each channel is
+        only copied into memory when it is first written to, so loading
+        costs little more than reading the header. Channels are copied when
+        loading if `maxlen` differs from the checkpointed maxlen.
+
+        Parameters
+        ----------
+        path
+            Directory of the checkpoint.
+        maxlen
+            Maximum length of the new buffer in seconds. Defaults to the
+            maxlen of the checkpointed buffer.
+
+        Returns
+        -------
+        Buffer of the checkpointed data.
+        """
+        with open(os.path.join(path, _CHECKPOINT_HEADER), "r") as f:
+            header = json.load(f)
+        traces = []
+        for channel in header["channels"]:
+            data = np.asarray(np.load(
+                os.path.join(path, channel["file"]), mmap_mode="r"))
+            trace_buffer = TraceBuffer.__new__(TraceBuffer)
+            trace_buffer.data = NumpyDeque._from_mapped(
+                data, gap_list=channel["gaps"], gaps=header["gaps"])
+            trace_buffer.stats = BufferStats(dict(
+                network=channel["network"], station=channel["station"],
+                location=channel["location"], channel=channel["channel"],
+                sampling_rate=channel["sampling_rate"],
+                calib=channel["calib"], npts=len(data)))
+            trace_buffer.stats.endtime_ns = channel["endtime_ns"]
+            trace_buffer._writes = _WriteLog()
+            trace_buffer._lock = _SeqLock()
+            traces.append(trace_buffer)
+        Logger.info("Loaded {0} channels from checkpoint at {1}".format(
+            len(traces), path))
+        return cls(traces=traces, maxlen=maxlen or header["maxlen"],
+                   gaps=header["gaps"], dtype=header["dtype"])
 
     @property
     def maxlen(self):
@@ -683,17 +1835,78 @@ class Buffer(object):
 
     def sanitize_traces(self):
         """ Ensure all traces meet that maxlen criteria. """
+        with self._lock:
+            self._sanitize_traces()
+
+    def _sanitize_traces(self):
         _traces = []
         for tr in self.traces:
             _maxlen = int(self.maxlen * tr.stats.sampling_rate)
-            if not tr.data.maxlen == _maxlen:
-                # Need to make a new tracebuffer with the correct maxlen
+            if self.dtype is None or tr.data.dtype == self.dtype:
+                # Resized in place - ingest can continue
+                tr.resize(_maxlen)
+                _traces.append(tr)
+            else:
+                # Need to make a new tracebuffer with the correct dtype
                 _tr = tr.trace
                 _traces.append(TraceBuffer(
-                    data=_tr.data, header=_tr.stats, maxlen=_maxlen))
-            else:
-                _traces.append(tr)
+                    data=_tr.data, header=_tr.stats, maxlen=_maxlen,
+                    gaps=self.gaps, dtype=self.dtype))
         self.traces = _traces
+        self._build_index()
+
+    def _build_index(self) -> None:
+        """ Rebuild the seed id lookups from the traces. """
+        index = dict()
+        code_index = [dict() for _ in range(4)]
+        for tr in self.traces:
+            self._index_trace(tr, index, code_index)
+        # Swap in complete lookups for concurrent readers
+        self._index, self._code_index = index, code_index
+
+    def _index_trace(
+        self,
+        trace_buffer: TraceBuffer,
+        index: dict = None,
+        code_indexes: list = None,
+    ) -> None:
+        """ Add a TraceBuffer to the seed id lookups. """
+        index = self._index if index is None else index
+        code_indexes = code_indexes or self._code_index
+        seed_id = trace_buffer.id
+        index.setdefault(seed_id, []).append(trace_buffer)
+        for code_index, code in zip(code_indexes, seed_id.split(".")):
+            code_index.setdefault(code, set()).add(seed_id)
+
+    def _match(self, pattern: str) -> set:
+        """
+        Find the seed ids in the buffer that match a wildcarded seed id.
+
+        Codes without wildcards are looked up directly, wildcarded codes are
+        only compared to the distinct codes in the buffer.
+        """
+        codes = pattern.split(".")
+        if len(codes) != 4:
+            _pattern = _compile_seed_pattern(pattern)
+            return {seed_id for seed_id in self._index
+                    if _pattern.match(seed_id)}
+        seed_ids = None
+        for code_index, code in zip(self._code_index, codes):
+            if code == "*":
+                continue
+            if _WILDCARDS.intersection(code):
+                _pattern = _compile_seed_pattern(code)
+                matched = set().union(*(
+                    _seed_ids for _code, _seed_ids in code_index.items()
+                    if _pattern.match(_code)))
+            else:
+                matched = code_index.get(code, set())
+            seed_ids = matched if seed_ids is None else seed_ids & matched
+            if len(seed_ids) == 0:
+                break
+        if seed_ids is None:
+            return set(self._index)
+        return seed_ids
 
     def add_stream(self, stream: Union[Trace, Stream]) -> None:
         """
@@ -711,14 +1924,24 @@ class Buffer(object):
         elif isinstance(stream, Buffer):
             stream = stream.stream
         for tr in stream:
-            traces_in_buffer = self.select(id=tr.id)
-            if len(traces_in_buffer) > 0:
+            traces_in_buffer = self._index.get(tr.id)
+            if traces_in_buffer:
                 for trace_in_buffer in traces_in_buffer:
                     trace_in_buffer.add_trace(tr)
-            else:
-                self.traces.append(TraceBuffer(
+                continue
+            with self._lock:
+                # Another writer may have added the channel
+                traces_in_buffer = self._index.get(tr.id)
+                if traces_in_buffer:
+                    for trace_in_buffer in traces_in_buffer:
+                        trace_in_buffer.add_trace(tr)
+                    continue
+                trace_buffer = TraceBuffer(
                     data=tr.data, header=tr.stats,
-                    maxlen=int(self.maxlen * tr.stats.sampling_rate)))
+                    maxlen=int(self.maxlen * tr.stats.sampling_rate),
+                    gaps=self.gaps, dtype=self.dtype)
+                self._index_trace(trace_buffer)
+                self.traces.append(trace_buffer)
 
     def select(self, id: str) -> List:
         """
@@ -728,13 +1951,29 @@ class Buffer(object):
         ----------
         id
             Standard four-part seed id as
-            {network}.{station}.{location}.{channel}
+            {network}.{station}.{location}.{channel}. Codes can contain
+            UNIX-style wildcards (`*`, `?` and `[]`).
 
         Returns
         -------
         List of matching traces.
+
+        Examples
+        --------
+        >>> from obspy import read
+        >>> buffer = Buffer(read(), maxlen=10.)
+        >>> [tr.id for tr in buffer.select(id="BW.RJOB..EHZ")]
+        ['BW.RJOB..EHZ']
+        >>> [tr.id for tr in buffer.select(id="BW.*.*.EH[EN]")]
+        ['BW.RJOB..EHE', 'BW.RJOB..EHN']
         """
-        return [tr for tr in self.traces if tr.id == id]
+        traces = self._index.get(id)
+        if traces is not None:
+            return list(traces)
+        if not _WILDCARDS.intersection(id):
+            return []
+        return [tr for seed_id in sorted(self._match(id))
+                for tr in self._index[seed_id]]
 
     @property
     def stream(self) -> Stream:
@@ -747,6 +1986,107 @@ class Buffer(object):
         """
         return Stream([tr.trace for tr in self.traces])
 
+    def snapshot(self) -> Stream:
+        """
+        Get a read-only Stream view of the buffer.
+
+        The data of each trace are read-only and do not change when new data
+        are added to the buffer. Data are only copied for channels that have
+        changed since the last snapshot, see `TraceBuffer.snapshot`.
+
+        Returns
+        -------
+        A stream representing the current state of the Buffer.
+        """
+        return Stream([tr.snapshot() for tr in self.traces])
+
+    @property
+    def cursor(self) -> dict:
+        """
+        The cursor that `read_since` would return now, without reading any
+        data. A cursor equal to an earlier one means that nothing has been
+        written since.
+
+        Examples
+        --------
+        >>> from obspy import read
+        >>> st = read()
+        >>> buffer = Buffer(st, maxlen=30.)
+        >>> cursor = buffer.cursor
+        >>> buffer.cursor == cursor
+        True
+        >>> buffer.add_stream(st)
+        >>> buffer.cursor == cursor
+        False
+        """
+        return {tr.id: tr.cursor for tr in self.traces}
+
+    def read_since(self, cursor: dict = None, pad: float = 0.) -> tuple:
+        """
+        Get the data appended or back-filled since a cursor.
+
+        The cost scales with the amount of new data rather than the length
+        of the buffer.
+
+        Parameters
+        ----------
+        cursor
+            Cursor returned by a previous call. All the data are returned for
+            channels that are not in the cursor, or if None.
+        pad
+            Seconds of data before each new section to include, e.g. to
+            give filters time to settle.
+
+        Returns
+        -------
+        Tuple of (Stream, cursor). The Stream holds one trace for each
+        contiguous section of new data.
+
+        Examples
+        --------
+        >>> from obspy import read
+        >>> st = read()
+        >>> buffer = Buffer(st, maxlen=30.)
+        >>> new, cursor = buffer.read_since()
+        >>> print(new[0])  # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+        BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - ...
+        | 100.0 Hz, 3000 samples
+        >>> new, cursor = buffer.read_since(cursor)
+        >>> len(new)
+        0
+        >>> for tr in st:
+        ...     tr.stats.starttime += 30
+        >>> buffer.add_stream(st.slice(endtime=st[0].stats.starttime + .99))
+        >>> new, cursor = buffer.read_since(cursor)
+        >>> print(new[0])  # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+        BW.RJOB..EHZ | 2009-08-24T00:20:33.000000Z - ...
+        | 100.0 Hz, 100 samples
+        """
+        cursor = cursor or dict()
+        traces, new_cursor = [], dict()
+        for tr in self.traces:
+            new, new_cursor[tr.id] = tr.read_since(cursor.get(tr.id), pad=pad)
+            traces.extend(new)
+        return Stream(traces), new_cursor
+
+    def bytes_per_channel(self) -> dict:
+        """
+        Memory used by each channel.
+
+        Returns
+        -------
+        Dictionary of bytes used to store the data and gaps keyed by seed id.
+        """
+        nbytes = dict()
+        for tr in self.traces:
+            nbytes[tr.id] = nbytes.get(tr.id, 0) + tr.nbytes
+        return nbytes
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes used to store the data and gaps of all channels. """
+        return sum(tr.nbytes for tr in self.traces)
+
     def is_full(self, strict=False) -> bool:
         """
         Check whether the buffer is full or not.
@@ -767,6 +2107,1158 @@ class Buffer(object):
         return True
 
 
+class AlignedBuffer(object):
+    """
+    Container for multi-channel data on a common sample grid.
+
+    All channels share one sampling-rate and one set of sample times, and are
+    stored together in a single (n_channels, n_samples) array with a matching
+    mask of missing samples. As for NumpyDeque, the time axis is a ring, so
+    adding data only costs the length of the new data. Sample times are
+    rounded onto the grid of whole samples since 1970-01-01.
+
+    Parameters
+    ----------
+    traces
+        Stream or list of Traces to initialise the buffer with.
+    maxlen
+        Maximum length of the buffer in seconds.
+    sampling_rate
+        Sampling-rate of all channels in Hz. If not given the sampling-rate
+        of the first trace will be used.
+    dtype
+        Data-type for the stored data.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> st = read()
+    >>> buffer = AlignedBuffer(st, maxlen=10.)
+    >>> print(buffer)
+    AlignedBuffer(3 traces, maxlen=10.0, sampling_rate=100.0)
+    >>> data, mask = buffer.matrix()
+    >>> data.shape
+    (3, 1000)
+    >>> print(buffer.endtime)
+    2009-08-24T00:20:32.990000Z
+    """
+    def __init__(
+        self,
+        traces: Union[Stream, List[Trace]] = None,
+        maxlen: float = None,
+        sampling_rate: float = None,
+        dtype: Union[str, np.dtype] = np.float64,
+    ):
+        traces = traces or []
+        assert traces or maxlen, "Requires at least maxlen or traces."
+        assert traces or sampling_rate, (
+            "Requires at least sampling_rate or traces.")
+        self.sampling_rate = float(
+            sampling_rate or traces[0].stats.sampling_rate)
+        self._maxlen = maxlen or max(
+            [tr.stats.npts * tr.stats.delta for tr in traces])
+        self._npts = int(round(self._maxlen * self.sampling_rate))
+        self._data = np.empty((0, self._npts), dtype=dtype)
+        self._mask = np.ones((0, self._npts), dtype=bool)
+        self.seed_ids = []
+        self._rows = dict()
+        self._headers = []
+        self._writes = []
+        # Grid index of the latest sample
+        self._end = None
+        self._lock = _SeqLock()
+        self.add_stream(traces)
+
+    def __repr__(self):
+        return ("AlignedBuffer({0} traces, maxlen={1}, "
+                "sampling_rate={2})".format(
+                    self.__len__(), self.maxlen, self.sampling_rate))
+
+    def __iter__(self):
+        return (_AlignedChannel(self, seed_id) for seed_id in self.seed_ids)
+
+    def __len__(self):
+        return len(self.seed_ids)
+
+    def __iadd__(self, other: Union[Trace, Stream]):
+        self.add_stream(other)
+        return self
+
+    @property
+    def maxlen(self) -> float:
+        return self._maxlen
+
+    @property
+    def npts(self) -> int:
+        """ Length of the buffer in samples. """
+        return self._npts
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes allocated for the data and mask, including spare rows. """
+        return self._data.nbytes + self._mask.nbytes
+
+    def bytes_per_channel(self) -> dict:
+        """
+        Memory used by each channel.
+
+        Returns
+        -------
+        Dictionary of bytes used to store the data and mask keyed by seed id.
+        """
+        row_bytes = self.npts * (self._data.itemsize + self._mask.itemsize)
+        return {seed_id: row_bytes for seed_id in self.seed_ids}
+
+    @property
+    def starttime(self) -> UTCDateTime:
+        """ Time of the oldest sample in the buffer. """
+        if self._end is None:
+            return None
+        return UTCDateTime((self._end - self.npts + 1) / self.sampling_rate)
+
+    @property
+    def endtime(self) -> UTCDateTime:
+        """ Time of the newest sample in the buffer. """
+        if self._end is None:
+            return None
+        return UTCDateTime(self._end / self.sampling_rate)
+
+    def _spans(self, start: int, length: int) -> list:
+        """
+        Map a range of grid indexes onto columns of the storage.
+
+        Returns
+        -------
+        List of (column slice, source slice) tuples.
+        """
+        return _ring_spans(start, length, self.npts)
+
+    def _add_channel(self, trace: Trace) -> int:
+        """ Add a row for a new channel, returns the row index. """
+        row = len(self.seed_ids)
+        if row == self._data.shape[0]:
+            # Grow the storage in steps to avoid copying for every channel
+            extra = max(1, row)
+            self._data = np.concatenate(
+                [self._data,
+                 np.empty((extra, self.npts), dtype=self._data.dtype)])
+            self._mask = np.concatenate(
+                [self._mask, np.ones((extra, self.npts), dtype=bool)])
+        self._mask[row] = True
+        self.seed_ids.append(trace.id)
+        self._rows[trace.id] = row
+        self._writes.append(_WriteLog())
+        self._headers.append({
+            key: trace.stats[key] for key in
+            ("network", "station", "location", "channel", "calib")})
+        return row
+
+    def _advance(self, end: int) -> None:
+        """ Move the end of the grid forward, masking the new samples. """
+        n_new = end - self._end
+        if n_new >= self.npts:
+            self._mask[:] = True
+        else:
+            for columns, _ in self._spans(self._end + 1, n_new):
+                self._mask[:, columns] = True
+        self._end = end
+
+    def add_trace(self, trace: Trace) -> None:
+        """
+        Add a trace to the buffer.
+
+        As for TraceBuffer, data in the trace replace data in the buffer,
+        but masked samples in the trace are not used.
+
+        Parameters
+        ----------
+        trace
+            Trace to add, must have the sampling-rate of the buffer.
+        """
+        assert trace.stats.sampling_rate == self.sampling_rate, (
+            "Sampling rates {0} and {1} differ".format(
+                self.sampling_rate, trace.stats.sampling_rate))
+        if trace.stats.npts == 0:
+            return
+        with self._lock:
+            self._add_trace(trace)
+
+    def _add_trace(self, trace: Trace) -> None:
+        """ Add a trace to the buffer - the write lock must be held. """
+        row = self._rows.get(trace.id)
+        if row is None:
+            row = self._add_channel(trace)
+        start = int(round(
+            trace.stats.starttime.timestamp * self.sampling_rate))
+        end = start + trace.stats.npts - 1
+        if self._end is None:
+            self._end = end
+        elif end > self._end:
+            self._advance(end)
+        keep = ~np.ma.getmaskarray(trace.data)
+        values = np.ma.getdata(trace.data)
+        # Drop samples older than the buffer
+        cut = max(0, (self._end - self.npts + 1) - start)
+        if cut >= len(values):
+            return
+        for columns, source in self._spans(start + cut, len(values) - cut):
+            source = slice(source.start + cut, source.stop + cut)
+            np.copyto(self._data[row, columns], values[source],
+                      casting="unsafe", where=keep[source])
+            self._mask[row, columns] &= ~keep[source]
+        self._writes[row].record(start + cut, end)
+
+    def add_stream(self, stream: Union[Trace, Stream]) -> None:
+        """
+        Add a stream or trace to the buffer.
+
+        Parameters
+        ----------
+        stream
+            Trace, Stream or list of Traces to add.
+        """
+        if isinstance(stream, Trace):
+            stream = [stream]
+        for tr in stream:
+            self.add_trace(tr)
+
+    def select(self, id: str) -> List:
+        """
+        Select channels from the buffer based on seed id.
+
+        Parameters
+        ----------
+        id
+            Standard four-part seed id as
+            {network}.{station}.{location}.{channel}. Codes can contain
+            UNIX-style wildcards (`*`, `?` and `[]`).
+
+        Returns
+        -------
+        List of matching channels.
+        """
+        if id in self._rows:
+            return [_AlignedChannel(self, id)]
+        if not _WILDCARDS.intersection(id):
+            return []
+        pattern = _compile_seed_pattern(id)
+        return [_AlignedChannel(self, seed_id) for seed_id in self.seed_ids
+                if pattern.match(seed_id)]
+
+    def matrix(self, length: float = None) -> tuple:
+        """
+        Get the data for all channels as a contiguous array.
+
+        Parameters
+        ----------
+        length
+            Length in seconds of the most recent data to get - defaults to
+            the whole buffer.
+
+        Returns
+        -------
+        Tuple of (data, mask) arrays, both of shape (n_channels, n_samples),
+        rows ordered as `seed_ids`. Mask is True for missing samples.
+        """
+        data, mask, _, _ = self._lock.read(self._matrix, length)
+        return data, mask
+
+    def _matrix(self, length: float) -> tuple:
+        """
+        Copy the data, returns (data, mask, end grid index, headers).
+        """
+        n_channels = len(self.seed_ids)
+        headers = self._headers[:n_channels]
+        npts = self.npts
+        if length is not None:
+            npts = min(npts, int(round(length * self.sampling_rate)))
+        data = np.empty((n_channels, npts), dtype=self._data.dtype)
+        mask = np.ones((n_channels, npts), dtype=bool)
+        end = self._end
+        if end is None:
+            return data, mask, end, headers
+        for columns, source in self._spans(end - npts + 1, npts):
+            data[:, source] = self._data[:n_channels, columns]
+            mask[:, source] = self._mask[:n_channels, columns]
+        return data, mask, end, headers
+
+    def window(self, length: float = None) -> Stream:
+        """
+        Get a Stream of the most recent data for all channels.
+
+        The traces all start and end at the same time and their data are
+        rows of one contiguous array, so they need no merging or trimming.
+
+        Parameters
+        ----------
+        length
+            Length in seconds of the most recent data to get - defaults to
+            the whole buffer.
+
+        Returns
+        -------
+        Stream with one trace per channel, masked where data are missing.
+        """
+        data, mask, end, headers = self._lock.read(self._matrix, length)
+        if end is None:
+            return Stream()
+        starttime = UTCDateTime((end - data.shape[1] + 1) / self.sampling_rate)
+        traces = []
+        for row, header in enumerate(headers):
+            tr_data = data[row]
+            if mask[row].any():
+                tr_data = np.ma.masked_array(tr_data, mask=mask[row])
+            traces.append(Trace(data=tr_data, header=dict(
+                header, starttime=starttime,
+                sampling_rate=self.sampling_rate)))
+        return Stream(traces)
+
+    @property
+    def cursor(self) -> dict:
+        """
+        The cursor that `read_since` would return now, without reading any
+        data, see `Buffer.cursor`.
+        """
+        return self._lock.read(self._cursor)
+
+    def _cursor(self) -> dict:
+        if self._end is None:
+            return dict()
+        return {seed_id: writes.cursor
+                for seed_id, writes in zip(self.seed_ids, self._writes)}
+
+    def read_since(self, cursor: dict = None, pad: float = 0.) -> tuple:
+        """
+        Get the data appended or back-filled since a cursor.
+
+        See `Buffer.read_since`.
+
+        Parameters
+        ----------
+        cursor
+            Cursor returned by a previous call. All the data are returned for
+            channels that are not in the cursor, or if None.
+        pad
+            Seconds of data before each new section to include.
+
+        Returns
+        -------
+        Tuple of (Stream, cursor).
+        """
+        return self._lock.read(self._read_since, cursor, pad)
+
+    def _read_since(self, cursor: dict, pad: float) -> tuple:
+        cursor = cursor or dict()
+        traces, new_cursor = [], dict()
+        if self._end is None:
+            return Stream(), new_cursor
+        first = self._end - self.npts + 1
+        pad = int(round(pad * self.sampling_rate))
+        for row, seed_id in enumerate(self.seed_ids):
+            writes = self._writes[row]
+            ranges = writes.since(cursor.get(seed_id))
+            new_cursor[seed_id] = writes.cursor
+            if ranges is None:
+                ranges = [(first, self._end)]
+            for start, end in _merge_ranges(ranges, pad, 1):
+                start, end = max(first, start), min(self._end, end)
+                if end < start:
+                    continue
+                data = np.empty(end - start + 1, dtype=self.dtype)
+                mask = np.empty(end - start + 1, dtype=bool)
+                for columns, source in self._spans(start, end - start + 1):
+                    data[source] = self._data[row, columns]
+                    mask[source] = self._mask[row, columns]
+                if mask.all():
+                    continue
+                if mask.any():
+                    data = np.ma.masked_array(data, mask=mask)
+                traces.append(Trace(data=data, header=dict(
+                    self._headers[row], sampling_rate=self.sampling_rate,
+                    starttime=UTCDateTime(start / self.sampling_rate))))
+        return Stream(traces), new_cursor
+
+    @property
+    def stream(self) -> Stream:
+        """
+        Get a static Stream view of the buffer
+
+        Returns
+        -------
+        A stream representing the current state of the AlignedBuffer.
+        """
+        return self.window()
+
+    def snapshot(self) -> Stream:
+        """
+        Get a Stream view of the buffer.
+
+        The data are copied from the buffer into one array, so the stream
+        does not change as new data are added.
+
+        Returns
+        -------
+        A stream representing the current state of the AlignedBuffer.
+        """
+        return self.window()
+
+    def is_full(self, strict=False) -> bool:
+        """
+        Check whether the buffer is full or not.
+
+        If strict=False (default) then only the start and end of the buffer
+        are checked.  Otherwise (strict=True) the whole buffer must contain
+        real data (e.g. the mask is all False)
+
+        Parameters
+        ----------
+        strict
+            Whether to check the whole buffer (True), or just the start and
+            end (False: default).
+        """
+        return self._lock.read(self._is_full, strict)
+
+    def _is_full(self, strict: bool) -> bool:
+        if self._end is None:
+            return False
+        mask = self._mask[:len(self.seed_ids)]
+        if strict:
+            return not mask.any()
+        first, last = (self._end + 1) % self.npts, self._end % self.npts
+        return not (mask[:, first].any() or mask[:, last].any())
+
+    def copy(self):
+        """
+        Generate a copy of the buffer.
+
+        Returns
+        -------
+        A deepcopy of the AlignedBuffer.
+        """
+        return self._lock.read(copy.deepcopy, self)
+
+
+class _AlignedChannel(object):
+    """
+    Handle to one channel of an AlignedBuffer.
+
+    Provides the parts of the TraceBuffer interface used by streaming
+    clients and plotting.
+
+    Parameters
+    ----------
+    buffer
+        AlignedBuffer holding the channel.
+    seed_id
+        Seed id of the channel.
+    """
+    def __init__(self, buffer: AlignedBuffer, seed_id: str):
+        self._buffer = buffer
+        self.id = seed_id
+        self._row = buffer._rows[seed_id]
+
+    def __repr__(self):
+        return "_AlignedChannel(buffer={0}, seed_id={1})".format(
+            self._buffer, self.id)
+
+    def __len__(self) -> int:
+        """ Number of samples of real data in the channel. """
+        return self._buffer.npts - int(
+            np.count_nonzero(self._buffer._mask[self._row]))
+
+    @property
+    def data_len(self) -> float:
+        """ Length of real data in the channel in seconds. """
+        return self.__len__() / self._buffer.sampling_rate
+
+    @property
+    def stats(self) -> BufferStats:
+        return BufferStats(dict(
+            self._buffer._headers[self._row],
+            sampling_rate=self._buffer.sampling_rate,
+            endtime=self._buffer.endtime or UTCDateTime(0),
+            npts=self._buffer.npts))
+
+    def is_full(self, strict=False) -> bool:
+        mask = self._buffer._mask[self._row]
+        if strict:
+            return not mask.any()
+        end = self._buffer._end
+        return not (mask[(end + 1) % self._buffer.npts] or
+                    mask[end % self._buffer.npts])
+
+
+class SharedBuffer(object):
+    """
+    Container for multiple channels of data in shared memory.
+
+    One process writes to the buffer, any number of other processes can
+    attach to it by name and read from it without copying the data between
+    processes. The channels are fixed when the buffer is created. Each
+    channel has a sequence counter that is odd while the channel is being
+    written and is incremented for every write, so that readers can get a
+    consistent copy of a channel without locking the writer.
+
+    Pickling a SharedBuffer (e.g. passing it to a `multiprocessing.Process`)
+    attaches the copy read-only to the same memory.
+
+    Parameters
+    ----------
+    seed_ids
+        Seed ids of all the channels that will be written to the buffer.
+    maxlen
+        Maximum length of the buffer in seconds.
+    sampling_rate
+        Sampling-rate in Hz, either one for all channels, or a dictionary of
+        sampling-rates keyed by seed id.
+    dtype
+        Data-type for the stored data.
+    name
+        Name of the shared memory block - one will be generated if not given.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> st = read()
+    >>> buffer = SharedBuffer(
+    ...     [tr.id for tr in st], maxlen=10., sampling_rate=100.)
+    >>> buffer.add_stream(st)
+    >>> reader = SharedBuffer.attach(buffer.name)
+    >>> print(reader.stream)  # doctest: +NORMALIZE_WHITESPACE
+    3 Trace(s) in Stream:
+    BW.RJOB..EHZ | 2009-08-24T00:20:23.000000Z - 2009-08-24T00:20:32.990000Z
+    | 100.0 Hz, 1000 samples
+    BW.RJOB..EHN | 2009-08-24T00:20:23.000000Z - 2009-08-24T00:20:32.990000Z
+    | 100.0 Hz, 1000 samples
+    BW.RJOB..EHE | 2009-08-24T00:20:23.000000Z - 2009-08-24T00:20:32.990000Z
+    | 100.0 Hz, 1000 samples
+    >>> reader.close()
+    >>> buffer.close()
+    >>> buffer.unlink()
+    """
+    # Sequence counter and latest sample index for each channel
+    _state_fields = 2
+
+    def __init__(
+        self,
+        seed_ids: List[str],
+        maxlen: float,
+        sampling_rate: Union[float, dict],
+        dtype: Union[str, np.dtype] = np.float64,
+        name: str = None,
+    ):
+        if not isinstance(sampling_rate, dict):
+            sampling_rate = {seed_id: sampling_rate for seed_id in seed_ids}
+        header = dict(
+            seed_ids=list(seed_ids), maxlen=maxlen,
+            sampling_rates=[float(sampling_rate[seed_id])
+                            for seed_id in seed_ids],
+            dtype=np.dtype(dtype).str)
+        header = json.dumps(header).encode()
+        size = _SharedLayout(header).size
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:8] = np.uint64(len(header)).tobytes()
+        shm.buf[8:8 + len(header)] = header
+        self._setup(shm, read_only=False)
+        self._state[:, 1] = -1
+        self._mask[:] = True
+
+    @classmethod
+    def attach(cls, name: str):
+        """
+        Attach read-only to an existing SharedBuffer.
+
+        Parameters
+        ----------
+        name
+            Name of the SharedBuffer to attach to.
+
+        Returns
+        -------
+        Read-only SharedBuffer.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        if parent_process() is None:
+            # Stop this process's resource tracker from removing the memory
+            # when this process exits: the writer owns it. Processes started
+            # by multiprocessing share the tracker of their parent.
+            resource_tracker.unregister(shm._name, "shared_memory")
+        buffer = cls.__new__(cls)
+        buffer._setup(shm, read_only=True)
+        return buffer
+
+    def _setup(self, shm: shared_memory.SharedMemory, read_only: bool):
+        self._shm = shm
+        self._name = shm.name
+        header_len = int(np.frombuffer(shm.buf[:8], dtype=np.uint64)[0])
+        header = bytes(shm.buf[8:8 + header_len])
+        layout = _SharedLayout(header)
+        header = json.loads(header.decode())
+        self.seed_ids = header["seed_ids"]
+        self._maxlen = header["maxlen"]
+        self._sampling_rates = np.array(header["sampling_rates"])
+        self._npts = np.round(
+            self._maxlen * self._sampling_rates).astype(int)
+        self._rows = {
+            seed_id: row for row, seed_id in enumerate(self.seed_ids)}
+        self._state, self._data, self._mask = layout.arrays(shm.buf)
+        self.read_only = read_only
+        if read_only:
+            for array in (self._state, self._data, self._mask):
+                array.flags.writeable = False
+        self._unknown = set()
+
+    def __reduce__(self):
+        return SharedBuffer.attach, (self.name, )
+
+    def __repr__(self):
+        return "SharedBuffer({0} traces, maxlen={1}, name={2})".format(
+            self.__len__(), self.maxlen, self.name)
+
+    def __iter__(self):
+        return (_SharedChannel(self, seed_id) for seed_id in self.seed_ids
+                if self._state[self._rows[seed_id], 1] >= 0)
+
+    def __len__(self):
+        """ Number of channels that contain data. """
+        return int(np.count_nonzero(self._state[:, 1] >= 0))
+
+    def __iadd__(self, other: Union[Trace, Stream]):
+        self.add_stream(other)
+        return self
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def maxlen(self) -> float:
+        return self._maxlen
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    def sequence(self, seed_id: str) -> int:
+        """
+        Get the sequence counter for a channel.
+
+        The counter increases by two for every write to the channel, so a
+        changed counter means that the channel has new data.
+
+        Parameters
+        ----------
+        seed_id
+            Seed id of the channel.
+        """
+        return int(self._state[self._rows[seed_id], 0])
+
+    def add_trace(self, trace: Trace) -> None:
+        """
+        Add a trace to the buffer.
+
+        As for TraceBuffer, data in the trace replace data in the buffer,
+        but masked samples in the trace are not used.
+
+        Parameters
+        ----------
+        trace
+            Trace to add, must be one of the channels of the buffer with the
+            same sampling-rate.
+        """
+        assert not self.read_only, "Cannot write to a read-only SharedBuffer"
+        row = self._rows.get(trace.id)
+        if row is None:
+            if trace.id not in self._unknown:
+                Logger.warning(
+                    "{0} is not in the SharedBuffer, data will not be "
+                    "kept".format(trace.id))
+                self._unknown.add(trace.id)
+            return
+        sampling_rate = self._sampling_rates[row]
+        assert trace.stats.sampling_rate == sampling_rate, (
+            "Sampling rates {0} and {1} differ".format(
+                sampling_rate, trace.stats.sampling_rate))
+        if trace.stats.npts == 0:
+            return
+        npts = self._npts[row]
+        start = int(round(trace.stats.starttime.timestamp * sampling_rate))
+        end = start + trace.stats.npts - 1
+        keep = ~np.ma.getmaskarray(trace.data)
+        values = np.ma.getdata(trace.data)
+        data, mask, state = self._data[row], self._mask[row], self._state[row]
+        state[0] += 1  # Odd while writing
+        try:
+            last = state[1]
+            if last < 0:
+                state[1] = end
+            elif end > last:
+                if end - last >= npts:
+                    mask[:npts] = True
+                else:
+                    for columns, _ in _ring_spans(
+                            last + 1, end - last, npts):
+                        mask[columns] = True
+                state[1] = end
+            # Drop samples older than the buffer
+            cut = max(0, (state[1] - npts + 1) - start)
+            if cut < len(values):
+                for columns, source in _ring_spans(
+                        start + cut, len(values) - cut, npts):
+                    source = slice(source.start + cut, source.stop + cut)
+                    np.copyto(data[columns], values[source],
+                              casting="unsafe", where=keep[source])
+                    mask[columns] &= ~keep[source]
+        finally:
+            # Never leave readers waiting on a failed write
+            state[0] += 1
+
+    def add_stream(self, stream: Union[Trace, Stream]) -> None:
+        """
+        Add a stream or trace to the buffer.
+
+        Parameters
+        ----------
+        stream
+            Trace, Stream or list of Traces to add.
+        """
+        if isinstance(stream, Trace):
+            stream = [stream]
+        for tr in stream:
+            self.add_trace(tr)
+
+    def clear(self) -> None:
+        """ Remove all data from the buffer. """
+        assert not self.read_only, "Cannot clear a read-only SharedBuffer"
+        for row in range(len(self.seed_ids)):
+            self._state[row, 0] += 1
+            self._mask[row] = True
+            self._state[row, 1] = -1
+            self._state[row, 0] += 1
+
+    def _read(self, row: int) -> tuple:
+        """
+        Get a consistent copy of one channel.
+
+        Returns
+        -------
+        Tuple of (data, mask, end) with data and mask in time order and end
+        the sample index of the last sample.
+        """
+        npts = self._npts[row]
+        while True:
+            sequence = self._state[row, 0]
+            if sequence % 2:
+                # Mid-write, let the writer finish.
+                time.sleep(0)
+                continue
+            end = int(self._state[row, 1])
+            data = np.empty(npts, dtype=self._data.dtype)
+            mask = np.ones(npts, dtype=bool)
+            if end >= 0:
+                for columns, source in _ring_spans(end - npts + 1, npts, npts):
+                    data[source] = self._data[row, columns]
+                    mask[source] = self._mask[row, columns]
+            if self._state[row, 0] == sequence:
+                return data, mask, end
+
+    def _trace(self, row: int) -> Trace:
+        data, mask, end = self._read(row)
+        network, station, location, channel = self.seed_ids[row].split('.')
+        sampling_rate = self._sampling_rates[row]
+        if mask.any():
+            data = np.ma.masked_array(data, mask=mask)
+        return Trace(data=data, header=dict(
+            network=network, station=station, location=location,
+            channel=channel, sampling_rate=sampling_rate,
+            starttime=UTCDateTime((end - len(data) + 1) / sampling_rate)))
+
+    def select(self, id: str) -> List:
+        """
+        Select channels from the buffer based on seed id.
+
+        Parameters
+        ----------
+        id
+            Standard four-part seed id as
+            {network}.{station}.{location}.{channel}. Codes can contain
+            UNIX-style wildcards (`*`, `?` and `[]`).
+
+        Returns
+        -------
+        List of matching channels that contain data.
+        """
+        if _WILDCARDS.intersection(id):
+            pattern = _compile_seed_pattern(id)
+            return [channel for channel in self
+                    if pattern.match(channel.id)]
+        return [channel for channel in self if channel.id == id]
+
+    @property
+    def cursor(self) -> dict:
+        """
+        The cursor that `read_since` would return now, without reading any
+        data, see `Buffer.cursor`.
+        """
+        return {seed_id: (self.name, self.sequence(seed_id))
+                for row, seed_id in enumerate(self.seed_ids)
+                if self._state[row, 1] >= 0}
+
+    def read_since(self, cursor: dict = None, pad: float = 0.) -> tuple:
+        """
+        Get the channels that have been written to since a cursor.
+
+        Only the sequence counters are shared between processes, so all the
+        data are returned for channels that have changed.
+
+        Parameters
+        ----------
+        cursor
+            Cursor returned by a previous call. All channels are returned if
+            None.
+        pad
+            Not used, kept for compatibility with `Buffer.read_since`.
+
+        Returns
+        -------
+        Tuple of (Stream, cursor).
+        """
+        cursor = cursor or dict()
+        traces, new_cursor = [], dict()
+        for row, seed_id in enumerate(self.seed_ids):
+            if self._state[row, 1] < 0:
+                continue
+            # Read the sequence before the data: new writes are read again
+            new_cursor[seed_id] = (self.name, self.sequence(seed_id))
+            if cursor.get(seed_id) == new_cursor[seed_id]:
+                continue
+            traces.append(self._trace(row))
+        return Stream(traces), new_cursor
+
+    @property
+    def stream(self) -> Stream:
+        """
+        Get a static Stream view of the buffer
+
+        Returns
+        -------
+        A stream representing the current state of the SharedBuffer.
+        """
+        return Stream([self._trace(row) for row, seed_id
+                       in enumerate(self.seed_ids)
+                       if self._state[row, 1] >= 0])
+
+    def snapshot(self) -> Stream:
+        """
+        Get a Stream view of the buffer.
+
+        The data are copied out of shared memory so that they do not change
+        as new data are added.
+
+        Returns
+        -------
+        A stream representing the current state of the SharedBuffer.
+        """
+        return self.stream
+
+    def is_full(self, strict=False) -> bool:
+        """
+        Check whether the buffer is full or not.
+
+        If strict=False (default) then only the start and end of the buffer
+        are checked.  Otherwise (strict=True) the whole buffer must contain
+        real data (e.g. the mask is all False)
+
+        Parameters
+        ----------
+        strict
+            Whether to check the whole buffer (True), or just the start and
+            end (False: default).
+        """
+        for channel in self:
+            if not channel.is_full(strict=strict):
+                return False
+        return True
+
+    def copy(self):
+        """
+        Generate a copy of the buffer.
+
+        Returns
+        -------
+        A Buffer of the current data - the copy is not shared.
+        """
+        return Buffer(traces=self.stream.traces, maxlen=self.maxlen,
+                      dtype=self.dtype)
+
+    def close(self) -> None:
+        """ Close this process's access to the shared memory. """
+        if getattr(self, "_shm", None) is None:
+            return
+        # Views of the memory have to be released before it can be closed
+        self._state = self._data = self._mask = None
+        self._shm.close()
+        self._shm = None
+
+    def unlink(self) -> None:
+        """
+        Free the shared memory - should be called once by the writer when
+        the buffer is no longer needed.
+        """
+        shared_memory.SharedMemory(name=self._name).unlink()
+
+
+class _SharedLayout(object):
+    """
+    Layout of a SharedBuffer in memory.
+
+    Memory starts with the length of the json header and the header, then
+    the channel states, data and masks, each aligned to 64 bytes.
+
+    Parameters
+    ----------
+    header
+        Encoded json header of the buffer.
+    """
+    _align = 64
+
+    def __init__(self, header: bytes):
+        info = json.loads(header.decode())
+        self.n_channels = len(info["seed_ids"])
+        self.npts = max([int(round(info["maxlen"] * sampling_rate))
+                         for sampling_rate in info["sampling_rates"]] or [0])
+        self.dtype = np.dtype(info["dtype"])
+        self.state_offset = self._aligned(8 + len(header))
+        state_size = self.n_channels * SharedBuffer._state_fields * 8
+        self.data_offset = self._aligned(self.state_offset + state_size)
+        data_size = self.n_channels * self.npts * self.dtype.itemsize
+        self.mask_offset = self._aligned(self.data_offset + data_size)
+        self.size = max(1, self.mask_offset + self.n_channels * self.npts)
+
+    def _aligned(self, offset: int) -> int:
+        return -(-offset // self._align) * self._align
+
+    def arrays(self, buf: memoryview) -> tuple:
+        """ Get the state, data and mask arrays in the memory. """
+        state = np.ndarray(
+            (self.n_channels, SharedBuffer._state_fields), dtype=np.int64,
+            buffer=buf, offset=self.state_offset)
+        data = np.ndarray(
+            (self.n_channels, self.npts), dtype=self.dtype, buffer=buf,
+            offset=self.data_offset)
+        mask = np.ndarray(
+            (self.n_channels, self.npts), dtype=bool, buffer=buf,
+            offset=self.mask_offset)
+        return state, data, mask
+
+
+class _SharedChannel(object):
+    """
+    Handle to one channel of a SharedBuffer.
+
+    Provides the parts of the TraceBuffer interface used by streaming
+    clients and plotting.
+
+    Parameters
+    ----------
+    buffer
+        SharedBuffer holding the channel.
+    seed_id
+        Seed id of the channel.
+    """
+    def __init__(self, buffer: SharedBuffer, seed_id: str):
+        self._buffer = buffer
+        self.id = seed_id
+        self._row = buffer._rows[seed_id]
+
+    def __repr__(self):
+        return "_SharedChannel(buffer={0}, seed_id={1})".format(
+            self._buffer, self.id)
+
+    def __len__(self) -> int:
+        """ Number of samples of real data in the channel. """
+        return int(self._buffer._npts[self._row] - np.count_nonzero(
+            self._buffer._mask[self._row, :self._buffer._npts[self._row]]))
+
+    @property
+    def data_len(self) -> float:
+        """ Length of real data in the channel in seconds. """
+        return self.__len__() / self._buffer._sampling_rates[self._row]
+
+    @property
+    def stats(self) -> BufferStats:
+        network, station, location, channel = self.id.split('.')
+        sampling_rate = self._buffer._sampling_rates[self._row]
+        return BufferStats(dict(
+            network=network, station=station, location=location,
+            channel=channel, sampling_rate=sampling_rate,
+            endtime=UTCDateTime(
+                int(self._buffer._state[self._row, 1]) / sampling_rate),
+            npts=int(self._buffer._npts[self._row])))
+
+    @property
+    def trace(self) -> Trace:
+        """ Get a copy of the data in the channel. """
+        return self._buffer._trace(self._row)
+
+    def is_full(self, strict=False) -> bool:
+        npts = self._buffer._npts[self._row]
+        mask = self._buffer._mask[self._row, :npts]
+        if strict:
+            return not mask.any()
+        end = int(self._buffer._state[self._row, 1])
+        return not (mask[(end + 1) % npts] or mask[end % npts])
+
+
+class _SeqLock(object):
+    """
+    Sequence lock between one writer at a time and any number of readers.
+
+    Writers hold a lock and make the sequence odd while writing. Readers do
+    not take the lock: they retry their read if the sequence changed while
+    they were reading, so readers never hold up writers.
+
+    Examples
+    --------
+    >>> lock = _SeqLock()
+    >>> data = [0, 0]
+    >>> with lock:
+    ...     data[0] = data[1] = 1
+    >>> lock.read(sum, data)
+    2
+    """
+    def __init__(self):
+        self.sequence = 0
+        self._write_lock = threading.Lock()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def __deepcopy__(self, memo):
+        return _SeqLock()
+
+    def __enter__(self):
+        self._write_lock.acquire()
+        self.sequence += 1
+
+    def __exit__(self, *args):
+        self.sequence += 1
+        self._write_lock.release()
+
+    def read(self, func, *args, **kwargs):
+        """ Call func until it runs without a write happening. """
+        while True:
+            sequence = self.sequence
+            if sequence % 2:
+                # Let the writer finish its packet.
+                time.sleep(0)
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                # Torn state can raise, only raise errors from clean reads
+                if self.sequence == sequence:
+                    raise
+                continue
+            if self.sequence == sequence:
+                return result
+
+
+class _WriteLog(object):
+    """
+    Record of the time-ranges written to one channel of a buffer.
+
+    Parameters
+    ----------
+    maxlen
+        Number of writes to keep - older cursors get all the data.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, maxlen: int = 1024):
+        self.id = next(self._ids)
+        self.version = 0
+        self._writes = deque(maxlen=maxlen)
+
+    def __deepcopy__(self, memo):
+        # Copies get their own id so that cursors are not shared.
+        return _WriteLog(maxlen=self._writes.maxlen)
+
+    @property
+    def cursor(self) -> tuple:
+        return self.id, self.version
+
+    def record(self, start: float, end: float) -> None:
+        """ Record a write of data between start and end. """
+        self.version += 1
+        self._writes.append((self.version, start, end))
+
+    def since(self, cursor: tuple) -> Union[list, None]:
+        """
+        Get the ranges written after a cursor.
+
+        Returns
+        -------
+        List of (start, end) tuples, or None if the cursor is not from
+        this log or is older than the writes kept.
+        """
+        if cursor is None or cursor[0] != self.id or cursor[1] > self.version:
+            return None
+        n_new = self.version - cursor[1]
+        if n_new > len(self._writes):
+            return None
+        return [(start, end) for _, start, end in
+                itertools.islice(self._writes, len(self._writes) - n_new,
+                                 None)]
+
+
+def _merge_ranges(ranges: list, pad: float, tolerance: float) -> list:
+    """
+    Merge overlapping (start, end) ranges after padding their starts.
+
+    Ranges separated by no more than tolerance are joined.
+    """
+    merged = []
+    for start, end in sorted((start - pad, end) for start, end in ranges):
+        if merged and start <= merged[-1][1] + tolerance:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(_range) for _range in merged]
+
+
+def _ring_spans(start: int, length: int, npts: int) -> list:
+    """
+    Map a range of sample indexes onto a ring of npts samples.
+
+    Returns
+    -------
+    List of (ring slice, source slice) tuples.
+    """
+    i = start % npts
+    first = min(length, npts - i)
+    spans = [(slice(i, i + first), slice(0, first))]
+    if first < length:
+        spans.append((slice(0, length - first), slice(first, length)))
+    return spans
+
+
+@lru_cache(maxsize=256)
+def _compile_seed_pattern(pattern: str):
+    """ Compile a UNIX-style wildcard pattern to a regular expression. """
+    return re.compile(fnmatch.translate(pattern))
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
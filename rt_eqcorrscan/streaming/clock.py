@@ -0,0 +1,176 @@
+"""
+Clocks for timing real-time runs: wall-clock time for real-time use and
+virtual time to run simulations as fast as possible.
+
+Author
+    Calum J Chamberlain
+License
+    GPL v3.0
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from obspy import UTCDateTime
+
+
+Logger = logging.getLogger(__name__)
+
+
+class WallClock(object):
+    """
+    Real time: `now` is the time now and `sleep` sleeps.
+
+    Examples
+    --------
+    >>> clock = WallClock()
+    >>> abs(clock.now() - UTCDateTime.now()) < 1
+    True
+    """
+    virtual = False
+
+    def __repr__(self):
+        return "WallClock()"
+
+    def now(self) -> UTCDateTime:
+        """ The time now. """
+        return UTCDateTime.now()
+
+    def sleep(self, seconds: float) -> None:
+        """ Sleep for a number of seconds. """
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def attach(self, thread: threading.Thread = None) -> None:
+        """ Nothing to do for real time, see `VirtualClock.attach`. """
+
+    def detach(self, thread: threading.Thread = None) -> None:
+        """ Nothing to do for real time, see `VirtualClock.detach`. """
+
+
+class VirtualClock(object):
+    """
+    Virtual time that only passes while every thread using the clock sleeps,
+    so simulations run as fast as the computer allows.
+
+    Threads that sleep on the clock are attached to it. When every attached
+    thread is sleeping, time jumps to the earliest wake-up and that one
+    thread is woken. Threads are woken one at a time, in order of wake-up
+    time and then of when they went to sleep, so a run is repeatable.
+    Work done between sleeps takes no virtual time.
+
+    Threads started to use the clock should be attached before they start,
+    so that time does not pass before they first sleep. Threads that end are
+    detached automatically. Threads that wait for other attached threads,
+    e.g. by joining them, must detach first or the clock stops.
+
+    Parameters
+    ----------
+    starttime
+        Virtual time to start at, defaults to now.
+
+    Examples
+    --------
+    >>> clock = VirtualClock(starttime=UTCDateTime(2020, 1, 1))
+    >>> ticks = []
+    >>> def tick(name, interval):
+    ...     for _ in range(3):
+    ...         clock.sleep(interval)
+    ...         ticks.append((name, clock.now().strftime("%H:%M:%S")))
+    >>> threads = [threading.Thread(target=tick, args=("fast", 60.)),
+    ...            threading.Thread(target=tick, args=("slow", 150.))]
+    >>> for thread in threads:
+    ...     clock.attach(thread)
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> ticks  # doctest: +NORMALIZE_WHITESPACE
+    [('fast', '00:01:00'), ('fast', '00:02:00'), ('slow', '00:02:30'),
+     ('fast', '00:03:00'), ('slow', '00:05:00'), ('slow', '00:07:30')]
+    """
+    virtual = True
+
+    def __init__(self, starttime: UTCDateTime = None):
+        starttime = starttime or UTCDateTime.now()
+        self._now = starttime.ns
+        self._condition = threading.Condition()
+        self._participants = set()
+        # Heap of (wake time, order, thread)
+        self._sleepers = []
+        self._sleeping = set()
+        self._order = itertools.count()
+
+    def __repr__(self):
+        return "VirtualClock(now={0})".format(self.now())
+
+    def __getstate__(self):
+        # Threads and locks cannot be copied to other processes: the copy
+        # carries on from the same time on its own.
+        return {"_now": self._now}
+
+    def __setstate__(self, state):
+        self.__init__(starttime=UTCDateTime(ns=state["_now"]))
+
+    def now(self) -> UTCDateTime:
+        """ The virtual time now. """
+        return UTCDateTime(ns=self._now)
+
+    def attach(self, thread: threading.Thread = None) -> None:
+        """
+        Make time wait for a thread, defaults to the current thread.
+        """
+        with self._condition:
+            self._participants.add(thread or threading.current_thread())
+
+    def detach(self, thread: threading.Thread = None) -> None:
+        """
+        Stop time waiting for a thread, defaults to the current thread.
+        """
+        with self._condition:
+            self._participants.discard(thread or threading.current_thread())
+            self._advance()
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Sleep for a number of virtual seconds, attaching the current thread
+        to the clock.
+        """
+        thread = threading.current_thread()
+        with self._condition:
+            self._participants.add(thread)
+            wake = self._now + max(int(round(seconds * 1e9)), 0)
+            heapq.heappush(self._sleepers, (wake, next(self._order), thread))
+            self._sleeping.add(thread)
+            self._advance()
+            while thread in self._sleeping:
+                # Time out to notice attached threads ending
+                if not self._condition.wait(0.05):
+                    self._advance()
+
+    def _advance(self) -> None:
+        """
+        Wake the next sleeper if all attached threads are sleeping. Must be
+        called with the condition held.
+        """
+        # Threads that have not started yet still count, enumerate includes
+        # threads that are starting, which are not alive yet.
+        running = set(threading.enumerate())
+        self._participants = {
+            thread for thread in self._participants
+            if thread.ident is None or thread in running}
+        if len(self._sleepers) == 0 or not all(
+                thread in self._sleeping for thread in self._participants):
+            return
+        wake, _, thread = heapq.heappop(self._sleepers)
+        self._now = max(self._now, wake)
+        self._sleeping.discard(thread)
+        self._condition.notify_all()
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,250 @@
+"""
+Per-channel metrics for data arriving from streaming clients.
+
+Author
+    Calum J Chamberlain
+License
+    GPL v3.0
+"""
+import bisect
+import logging
+import os
+import time
+
+from obspy import Trace
+
+
+Logger = logging.getLogger(__name__)
+
+# Upper bounds of the packet latency histogram bins in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+
+class _ChannelMetrics(object):
+    """ Counters for one channel - only changed by `IngestMetrics.record`. """
+    __slots__ = ("packets", "samples", "gaps", "gap_seconds", "out_of_order",
+                 "latency_sum", "latency_counts", "first_arrival",
+                 "last_arrival", "endtime_ns")
+
+    def __init__(self, n_buckets: int):
+        self.packets = 0
+        self.samples = 0
+        self.gaps = 0
+        self.gap_seconds = 0.
+        self.out_of_order = 0
+        self.latency_sum = 0.
+        # One count per bucket, then one for latencies beyond the last
+        self.latency_counts = [0] * (n_buckets + 1)
+        self.first_arrival = None
+        self.last_arrival = None
+        self.endtime_ns = None
+
+
+class IngestMetrics(object):
+    """
+    Health metrics of the data arriving for each channel.
+
+    For each channel this counts packets, samples, gaps and out-of-order
+    packets (packets that start before the end of data already received
+    for the channel), and keeps a histogram of the latency of packets: the
+    time between the last sample of a packet and the packet arriving.
+
+    Counters are only changed by `record`, which is called by a single
+    ingest thread, so no locks are taken: reads from other threads may be
+    one packet behind. New channels are only added once their first packet
+    has been counted.
+
+    Parameters
+    ----------
+    latency_buckets
+        Upper bounds of the latency histogram bins in seconds.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> tr = read()[0]
+    >>> metrics = IngestMetrics()
+    >>> metrics.record(tr.slice(endtime=tr.stats.starttime + 9.99),
+    ...                arrival=tr.stats.starttime.timestamp + 10.2)
+    >>> metrics.record(tr.slice(starttime=tr.stats.starttime + 20),
+    ...                arrival=tr.stats.endtime.timestamp + 0.4)
+    >>> channel = metrics.to_dict()["BW.RJOB..EHZ"]
+    >>> channel["packets"], channel["gaps"], channel["gap_seconds"]
+    (2, 1, 10.0)
+    >>> print(metrics.to_prometheus()) # doctest: +ELLIPSIS
+    # HELP rt_eqcorrscan_packets_total Packets received.
+    # TYPE rt_eqcorrscan_packets_total counter
+    rt_eqcorrscan_packets_total{channel="BW.RJOB..EHZ"} 2
+    ...
+    rt_eqcorrscan_packet_latency_seconds_bucket{...,le="0.25"} 1
+    ...
+    """
+    def __init__(self, latency_buckets: tuple = LATENCY_BUCKETS):
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self._channels = dict()
+
+    def __repr__(self):
+        return "IngestMetrics({0} channels)".format(len(self._channels))
+
+    def __len__(self):
+        return len(self._channels)
+
+    @property
+    def seed_ids(self) -> list:
+        return list(self._channels.keys())
+
+    def record(self, trace: Trace, arrival: float = None) -> None:
+        """
+        Count a packet.
+
+        Parameters
+        ----------
+        trace
+            The packet.
+        arrival
+            Time the packet arrived as a UNIX timestamp, defaults to now.
+        """
+        if arrival is None:
+            arrival = time.time()
+        stats = trace.stats
+        seed_id = trace.id
+        channel = self._channels.get(seed_id)
+        new = channel is None
+        if new:
+            # Filled in before readers can see it
+            channel = _ChannelMetrics(len(self.latency_buckets))
+        start_ns, end_ns = stats.starttime.ns, stats.endtime.ns
+        if channel.endtime_ns is not None:
+            delta_ns = int(round(1e9 / stats.sampling_rate))
+            # A gap is at least one missing sample
+            offset = start_ns - (channel.endtime_ns + delta_ns)
+            if offset > delta_ns // 2:
+                channel.gaps += 1
+                channel.gap_seconds += offset * 1e-9
+            elif offset < -(delta_ns // 2):
+                channel.out_of_order += 1
+        if channel.endtime_ns is None or end_ns > channel.endtime_ns:
+            channel.endtime_ns = end_ns
+        latency = arrival - end_ns * 1e-9
+        channel.latency_sum += latency
+        channel.latency_counts[
+            bisect.bisect_left(self.latency_buckets, latency)] += 1
+        channel.packets += 1
+        channel.samples += stats.npts
+        if channel.first_arrival is None:
+            channel.first_arrival = arrival
+        channel.last_arrival = arrival
+        if new:
+            self._channels[seed_id] = channel
+
+    def reset(self) -> None:
+        """ Clear all the counters. """
+        self._channels = dict()
+
+    def to_dict(self) -> dict:
+        """
+        Get the metrics for all channels.
+
+        Returns
+        -------
+        Dictionary keyed by seed id of dictionaries of metrics. Latency
+        bins hold cumulative counts keyed by their upper bounds, as in
+        Prometheus histograms.
+        """
+        metrics = dict()
+        for seed_id, channel in list(self._channels.items()):
+            packets = channel.packets
+            if packets == 0:
+                # Not counted yet
+                continue
+            duration = channel.last_arrival - channel.first_arrival
+            counts, cumulative = dict(), 0
+            for bound, count in zip(self.latency_buckets + (float("inf"), ),
+                                    channel.latency_counts):
+                cumulative += count
+                counts[bound] = cumulative
+            metrics[seed_id] = {
+                "packets": packets, "samples": channel.samples,
+                "packets_per_second": (
+                    (packets - 1) / duration if duration > 0 else 0.),
+                "gaps": channel.gaps, "gap_seconds": channel.gap_seconds,
+                "out_of_order": channel.out_of_order,
+                "mean_latency": channel.latency_sum / max(packets, 1),
+                "latency_sum": channel.latency_sum,
+                "latency_buckets": counts,
+                "last_arrival": channel.last_arrival}
+        return metrics
+
+    def to_prometheus(self) -> str:
+        """
+        Get the metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        Metrics text, with channels labelled by seed id.
+        """
+        metrics = self.to_dict()
+        simple = (
+            ("packets_total", "counter", "Packets received.", "packets"),
+            ("samples_total", "counter", "Samples received.", "samples"),
+            ("packets_per_second", "gauge",
+             "Mean packet arrival rate.", "packets_per_second"),
+            ("gaps_total", "counter", "Gaps between packets.", "gaps"),
+            ("gap_seconds_total", "counter",
+             "Seconds of data missing between packets.", "gap_seconds"),
+            ("out_of_order_total", "counter",
+             "Packets starting before the end of received data.",
+             "out_of_order"),
+            ("last_packet_timestamp_seconds", "gauge",
+             "Arrival time of the last packet.", "last_arrival"))
+        lines = []
+        for name, kind, description, key in simple:
+            name = "rt_eqcorrscan_" + name
+            lines.extend(["# HELP {0} {1}".format(name, description),
+                          "# TYPE {0} {1}".format(name, kind)])
+            lines.extend('{0}{{channel="{1}"}} {2}'.format(
+                name, seed_id, _format_value(channel[key]))
+                for seed_id, channel in metrics.items())
+        name = "rt_eqcorrscan_packet_latency_seconds"
+        lines.extend([
+            "# HELP {0} Time from the last sample of a packet to its "
+            "arrival.".format(name),
+            "# TYPE {0} histogram".format(name)])
+        for seed_id, channel in metrics.items():
+            for bound, count in channel["latency_buckets"].items():
+                lines.append('{0}_bucket{{channel="{1}",le="{2}"}} {3}'.format(
+                    name, seed_id, _format_value(bound), count))
+            lines.append('{0}_sum{{channel="{1}"}} {2}'.format(
+                name, seed_id, _format_value(channel["latency_sum"])))
+            lines.append('{0}_count{{channel="{1}"}} {2}'.format(
+                name, seed_id, channel["packets"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Write the metrics to a file for Prometheus, e.g. for the node
+        exporter textfile collector. The file is replaced atomically.
+
+        Parameters
+        ----------
+        path
+            File to write to.
+        """
+        with open(path + ".tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+
+
+def _format_value(value) -> str:
+    """ Format a number for Prometheus. """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,454 @@
+"""
+Incremental pre-processing of streaming data for detection.
+
+Author
+    Calum J Chamberlain
+License
+    GPL v3.0
+"""
+import logging
+import threading
+import numpy as np
+
+from typing import Union, List
+
+from scipy.signal import iirfilter, sosfilt, sosfilt_zi, zpk2sos
+from obspy import Stream, Trace, UTCDateTime
+
+from rt_eqcorrscan.streaming.buffers import Buffer, _TIME_TOLERANCE_NS
+
+
+Logger = logging.getLogger(__name__)
+
+# Anti-alias lowpass used when decimating without a highcut: corner as a
+# fraction of the processed Nyquist, and number of corners
+_ANTI_ALIAS_CORNER = 0.8
+_ANTI_ALIAS_ORDER = 8
+
+
+class _ChannelProcessor(object):
+    """
+    Zero-phase filter and decimate one channel as packets arrive.
+
+    Packets are held until `batch` samples are held, or `update` is
+    called. The forward pass of the filter then runs over the held data,
+    carrying the filter state from the previous batch. The backward pass
+    needs later data, so it is re-run over the newest `settle` samples for
+    each batch: older samples no longer depend on new data (within
+    `tolerance`) and are released. Away from the start of the data the
+    output matches filtering the whole channel at once with obspy's
+    zero-phase filters.
+
+    Data are decimated by picking samples, so when decimating without a
+    `highcut` (or with a `highcut` above the processed Nyquist) an
+    anti-alias lowpass is added to the filter, with a corner at
+    `_ANTI_ALIAS_CORNER` of the processed Nyquist.
+
+    Parameters
+    ----------
+    sampling_rate
+        Sampling-rate of the raw data in Hz.
+    lowcut
+        Lower corner of the filter in Hz, or None for a lowpass.
+    highcut
+        Upper corner of the filter in Hz, or None for a highpass.
+    filt_order
+        Number of corners of the Butterworth filter.
+    samp_rate
+        Sampling-rate of the processed data in Hz, the raw sampling-rate
+        must be an integer multiple of this.
+    tolerance
+        Size of the backward-pass impulse response, relative to its peak,
+        below which samples are released.
+    batch
+        Number of samples to hold before processing them.
+    """
+    def __init__(
+        self,
+        sampling_rate: float,
+        lowcut: float = None,
+        highcut: float = None,
+        filt_order: int = 4,
+        samp_rate: float = None,
+        tolerance: float = 1e-6,
+        batch: int = 0,
+    ):
+        samp_rate = samp_rate or sampling_rate
+        decimation = sampling_rate / samp_rate
+        assert abs(decimation - round(decimation)) < 1e-6 and (
+            decimation >= 1), (
+            "Raw sampling-rate {0} is not a multiple of {1}".format(
+                sampling_rate, samp_rate))
+        self.sampling_rate = sampling_rate
+        self.samp_rate = samp_rate
+        self.batch = batch
+        self._decimation = int(round(decimation))
+        self._sos = None
+        self._settle = 0
+        nyquist = .5 * sampling_rate
+        if lowcut and highcut:
+            corners, btype = [lowcut / nyquist, highcut / nyquist], "band"
+        elif lowcut:
+            corners, btype = lowcut / nyquist, "highpass"
+        elif highcut:
+            corners, btype = highcut / nyquist, "lowpass"
+        else:
+            corners = None
+        sos, poles = [], []
+        if corners is not None:
+            z, p, k = iirfilter(filt_order, corners, btype=btype,
+                                ftype="butter", output="zpk")
+            sos.append(zpk2sos(z, p, k))
+            poles.append(p)
+        if self._decimation > 1 and (
+                highcut is None or highcut >= .5 * samp_rate):
+            corner = _ANTI_ALIAS_CORNER * .5 * samp_rate / nyquist
+            z, p, k = iirfilter(_ANTI_ALIAS_ORDER, corner, btype="lowpass",
+                                ftype="butter", output="zpk")
+            sos.append(zpk2sos(z, p, k))
+            poles.append(p)
+        if len(sos):
+            self._sos = np.vstack(sos)
+            # Samples for the slowest pole to decay to tolerance
+            self._settle = int(np.ceil(
+                np.log(tolerance) / np.log(np.abs(np.concatenate(
+                    poles)).max())))
+        self._start_ns = None
+
+    @property
+    def latency(self) -> float:
+        """ Seconds that processed data are held for after arriving. """
+        return self._settle / self.sampling_rate
+
+    @property
+    def next_ns(self) -> int:
+        """ Time of the next expected sample, or None if not started. """
+        if self._start_ns is None:
+            return None
+        return self._start_ns + int(round(
+            self._n_in * 1e9 / self.sampling_rate))
+
+    def _start(self, start_ns: int, first: float) -> None:
+        """ Start a new segment of contiguous data. """
+        self._start_ns = start_ns
+        # Raw samples since the epoch, so that every segment is decimated
+        # onto the same grid of processed samples
+        self._phase = int(round(start_ns * self.sampling_rate / 1e9))
+        self._n_in, self._n_out = 0, 0
+        self._pending, self._n_pending = [], 0
+        self._tail = np.empty(0)
+        if self._sos is not None:
+            # Steady-state for the first value, so an offset does not ring
+            self._zi = sosfilt_zi(self._sos) * first
+
+    def add(self, data: np.ndarray, start_ns: int) -> List[Trace]:
+        """
+        Add the next packet.
+
+        Parameters
+        ----------
+        data
+            Unmasked data of the packet.
+        start_ns
+            Time of the first sample in integer nanoseconds. If this does not
+            follow on from the last packet the previous data are flushed and a
+            new segment is started.
+
+        Returns
+        -------
+        List of traces of the processed data released.
+        """
+        released = []
+        if len(data) == 0:
+            return released
+        next_ns = self.next_ns
+        if next_ns is None or abs(start_ns - next_ns) > _TIME_TOLERANCE_NS:
+            released.extend(self.flush())
+            self._start(start_ns, data[0])
+        self._pending.append(data)
+        self._n_pending += len(data)
+        self._n_in += len(data)
+        if self._n_pending >= self.batch:
+            released.extend(self.update())
+        return released
+
+    def update(self) -> List[Trace]:
+        """ Process the held packets, returning the data released. """
+        released = []
+        if self._n_pending == 0:
+            return released
+        data = np.concatenate(self._pending).astype(np.float64, copy=False)
+        self._pending, self._n_pending = [], 0
+        if self._sos is not None:
+            data, self._zi = sosfilt(self._sos, data, zi=self._zi)
+        forward = np.concatenate((self._tail, data))
+        n_final = len(forward) - self._settle
+        if n_final <= 0:
+            self._tail = forward
+            return released
+        self._tail = forward[n_final:].copy()
+        if self._sos is not None:
+            # Samples this far from the end are not changed by new data
+            forward = sosfilt(self._sos, forward[::-1])[::-1]
+        released.extend(self._release(forward[0:n_final]))
+        return released
+
+    def flush(self) -> List[Trace]:
+        """ Release all the held data, ending the current segment. """
+        if self._start_ns is None:
+            return []
+        released = self.update()
+        tail = self._tail
+        if self._sos is not None and len(tail):
+            tail = sosfilt(self._sos, tail[::-1])[::-1]
+        released.extend(self._release(tail))
+        self._start_ns = None
+        return released
+
+    def _release(self, final: np.ndarray) -> List[Trace]:
+        """ Decimate final samples onto the output grid. """
+        first = -(self._phase + self._n_out) % self._decimation
+        index = self._n_out + first
+        self._n_out += len(final)
+        data = final[first::self._decimation]
+        if len(data) == 0:
+            return []
+        starttime = UTCDateTime(ns=self._start_ns + int(round(
+            index * 1e9 / self.sampling_rate)))
+        return [Trace(data=data, header=dict(
+            sampling_rate=self.samp_rate, starttime=starttime))]
+
+
+class ProcessedBuffer(object):
+    """
+    Buffer of filtered and resampled data, processed as data arrive.
+
+    Each channel is filtered with a zero-phase Butterworth filter, as used
+    by EQcorrscan, and decimated to `samp_rate`, with an anti-alias lowpass
+    if there is no `highcut`. The filter state is kept
+    between packets so each packet is only processed once, rather than the
+    whole detection window being re-processed for every detection. Packets
+    are held and processed together once `batch_length` seconds of data are
+    held for a channel, or when the buffer is read. Processed data are added
+    to the buffer once later data can no longer change them, which is
+    `latency` seconds after they arrive.
+
+    This is close to, but not the same as, EQcorrscan's processing of a
+    window of data, which is detrended, filtered from rest and Fourier
+    resampled: processed data differ most near the start of data and after
+    gaps.
+
+    Packets that do not follow on from the previous packet for a channel
+    start a new segment: late packets (e.g. back-filled data) are processed
+    on their own, and gaps restart the filter.
+
+    Parameters
+    ----------
+    maxlen
+        Maximum length of the buffer in seconds.
+    lowcut
+        Lower corner of the filter in Hz, or None for a lowpass.
+    highcut
+        Upper corner of the filter in Hz, or None for a highpass.
+    filt_order
+        Number of corners of the filter.
+    samp_rate
+        Sampling-rate of the processed data in Hz. The sampling-rate of the
+        raw data must be an integer multiple of this: other channels are not
+        processed, see `unprocessed`.
+    gaps
+        How the buffer keeps track of missing data, see `NumpyDeque`.
+    dtype
+        Float data-type to store processed data as, see `NumpyDeque`.
+        Defaults to the type of the processed data (float64).
+    batch_length
+        Seconds of data to hold for a channel before processing them.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> st = read()
+    >>> processed = ProcessedBuffer(
+    ...     maxlen=30., lowcut=2., highcut=10., filt_order=4, samp_rate=50.)
+    >>> processed.add_stream(st.slice(endtime=st[0].stats.starttime + 15))
+    >>> processed.add_stream(st.slice(starttime=st[0].stats.starttime + 15.01))
+    >>> processed.flush()
+    >>> print(processed.stream.merge()) # doctest: +NORMALIZE_WHITESPACE
+    3 Trace(s) in Stream:
+    BW.RJOB..EHE | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.980000Z
+    | 50.0 Hz, 1500 samples
+    BW.RJOB..EHN | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.980000Z
+    | 50.0 Hz, 1500 samples
+    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.980000Z
+    | 50.0 Hz, 1500 samples
+    """
+    def __init__(
+        self,
+        maxlen: float,
+        lowcut: float = None,
+        highcut: float = None,
+        filt_order: int = 4,
+        samp_rate: float = None,
+        gaps: str = "mask",
+        dtype: Union[str, np.dtype] = None,
+        batch_length: float = 10.,
+    ):
+        assert dtype is None or np.issubdtype(dtype, np.floating), (
+            "Processed data must be stored as floats")
+        self.lowcut = lowcut
+        self.highcut = highcut
+        self.filt_order = filt_order
+        self.samp_rate = samp_rate
+        self.batch_length = batch_length
+        self.buffer = Buffer(traces=[], maxlen=maxlen, gaps=gaps, dtype=dtype)
+        self._processors = dict()
+        # Packets and back-fill can arrive from different threads
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return ("ProcessedBuffer({0} traces, maxlen={1}, lowcut={2}, "
+                "highcut={3}, filt_order={4}, samp_rate={5})".format(
+                    len(self), self.maxlen, self.lowcut, self.highcut,
+                    self.filt_order, self.samp_rate))
+
+    def __iter__(self):
+        return self.buffer.__iter__()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    @property
+    def maxlen(self) -> float:
+        return self.buffer.maxlen
+
+    @maxlen.setter
+    def maxlen(self, maxlen: float):
+        self.buffer.maxlen = maxlen
+
+    @property
+    def latency(self) -> float:
+        """ Longest time in seconds that a channel holds data for. """
+        with self._lock:
+            return max((processor.latency
+                        for processor in self._processors.values()
+                        if processor is not None), default=0.)
+
+    @property
+    def unprocessed(self) -> List[str]:
+        """
+        Seed ids of channels that cannot be processed as they arrive.
+
+        Their raw sampling-rate is not an integer multiple of `samp_rate`, so
+        they are not added to the buffer and must be processed some other
+        way, e.g. for each detection window.
+        """
+        with self._lock:
+            return sorted(seed_id for seed_id, processor
+                          in self._processors.items() if processor is None)
+
+    def _new_processor(
+        self,
+        sampling_rate: float,
+        batch: int = 0,
+    ) -> _ChannelProcessor:
+        return _ChannelProcessor(
+            sampling_rate=sampling_rate, lowcut=self.lowcut,
+            highcut=self.highcut, filt_order=self.filt_order,
+            samp_rate=self.samp_rate, batch=batch)
+
+    def _processor(self, trace: Trace) -> Union[_ChannelProcessor, None]:
+        """ Get the processor for a channel, None if it cannot process it. """
+        if trace.id in self._processors:
+            processor = self._processors[trace.id]
+            if processor is None or (
+                    processor.sampling_rate == trace.stats.sampling_rate):
+                return processor
+        try:
+            processor = self._new_processor(
+                trace.stats.sampling_rate, batch=int(
+                    self.batch_length * trace.stats.sampling_rate))
+        except AssertionError as e:
+            Logger.warning("Not processing {0}: {1}".format(trace.id, e))
+            processor = None
+        self._processors[trace.id] = processor
+        return processor
+
+    def add_stream(self, stream: Union[Trace, Stream]) -> None:
+        """
+        Process new data and add them to the buffer.
+
+        Parameters
+        ----------
+        stream
+            Raw data to add, masked data are split at the gaps.
+        """
+        if isinstance(stream, Trace):
+            stream = Stream([stream])
+        if any(isinstance(tr.data, np.ma.MaskedArray) for tr in stream):
+            stream = stream.copy().split()
+        released = []
+        with self._lock:
+            for tr in stream:
+                processor = self._processor(tr)
+                if processor is None:
+                    continue
+                next_ns = processor.next_ns
+                if next_ns is not None and (
+                        tr.stats.starttime.ns < next_ns - _TIME_TOLERANCE_NS):
+                    # Late data: process alone to keep the live state
+                    late = self._new_processor(tr.stats.sampling_rate)
+                    traces = late.add(tr.data, tr.stats.starttime.ns)
+                    traces.extend(late.flush())
+                else:
+                    traces = processor.add(tr.data, tr.stats.starttime.ns)
+                for _tr in traces:
+                    _tr.id = tr.id
+                released.extend(traces)
+        if len(released):
+            self.buffer.add_stream(Stream(released))
+
+    def _release_all(self, flush: bool) -> None:
+        released = []
+        with self._lock:
+            for seed_id, processor in self._processors.items():
+                if processor is None:
+                    continue
+                traces = processor.flush() if flush else processor.update()
+                for tr in traces:
+                    tr.id = seed_id
+                released.extend(traces)
+        if len(released):
+            self.buffer.add_stream(Stream(released))
+
+    def update(self) -> None:
+        """ Process the packets held for all channels. """
+        self._release_all(flush=False)
+
+    def flush(self) -> None:
+        """ Release all the data held for all channels, ending segments. """
+        self._release_all(flush=True)
+
+    def select(self, id: str) -> List:
+        """ Select processed channels, see `Buffer.select`. """
+        self.update()
+        return self.buffer.select(id)
+
+    @property
+    def stream(self) -> Stream:
+        """ Get a copy of the processed data. """
+        self.update()
+        return self.buffer.stream
+
+    def snapshot(self) -> Stream:
+        """ Get a read-only view of the processed data. """
+        self.update()
+        return self.buffer.snapshot()
+
+    def is_full(self, strict=False) -> bool:
+        return self.buffer.is_full(strict=strict)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -7,6 +7,7 @@ License
     GPL v3.0
 """
 import logging
+import socket
 
 from obspy.clients.seedlink.easyseedlink import EasySeedLinkClient
 from obspy import Stream
@@ -31,6 +32,13 @@ class RealTimeClient(_StreamingClient, EasySeedLinkClient):
         Stream to buffer data into
     buffer_capacity
         Length of buffer in seconds. Old data are removed in a LIFO style.
+    wavebank
+        Optional wavebank to save data to.
+    coalesce_latency
+        Longest time in seconds to hold packets to add them to the buffer
+        together, see `_StreamingClient`.
+    coalesce_samples
+        Number of samples held for a channel that releases the channel.
     """
     def __init__(
         self,
@@ -38,12 +46,20 @@ class RealTimeClient(_StreamingClient, EasySeedLinkClient):
         buffer: Stream = None,
         buffer_capacity: float = 600.,
         wavebank: WaveBank = None,
+        coalesce_latency: float = None,
+        coalesce_samples: int = None,
     ) -> None:
         EasySeedLinkClient.__init__(
             self, server_url=server_url, autoconnect=False)
+        # Some ObsPy versions leave the connection time-out unset, which
+        # makes every connection attempt fail.
+        if self.conn.timeout is None:
+            self.conn.timeout = 30.
         _StreamingClient.__init__(
             self, client_name=server_url, buffer=buffer,
-            buffer_capacity=buffer_capacity, wavebank=wavebank)
+            buffer_capacity=buffer_capacity, wavebank=wavebank,
+            coalesce_latency=coalesce_latency,
+            coalesce_samples=coalesce_samples)
         Logger.debug("Instantiated RealTime client: {0}".format(self))
 
     def __repr__(self):
@@ -77,12 +93,15 @@ class RealTimeClient(_StreamingClient, EasySeedLinkClient):
             Whether to start the new client with an empty buffer or not.
         """
         if empty_buffer:
-            buffer = Stream()
+            buffer = self._empty_buffer()
         else:
             buffer = self.buffer.copy()
         return RealTimeClient(
-            server_url=self.server_hostname, buffer=buffer,
-            buffer_capacity=self.buffer_capacity, wavebank=self.wavebank)
+            server_url="{0}:{1}".format(
+                self.server_hostname, self.server_port), buffer=buffer,
+            buffer_capacity=self.buffer_capacity, wavebank=self.wavebank,
+            coalesce_latency=self.coalesce_latency,
+            coalesce_samples=self.coalesce_samples)
 
     def start(self) -> None:
         """ Start the connection. """
@@ -100,6 +119,12 @@ class RealTimeClient(_StreamingClient, EasySeedLinkClient):
     def stop(self) -> None:
         self.busy = False
         self.conn.terminate()
+        if self.conn.socket is not None:
+            # Wake the streaming thread if it is waiting for data
+            try:
+                self.conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         self.close()
         self.started = False
 
@@ -0,0 +1,611 @@
+"""
+Local SeedLink server that replays old data, for testing and load-testing
+streaming clients without a live server.
+
+Author
+    Calum J Chamberlain
+License
+    GPL v3.0
+"""
+import datetime
+import fnmatch
+import io
+import itertools
+import logging
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from collections import deque
+from typing import Union, Iterable
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime, read
+from obsplus import WaveBank
+
+
+Logger = logging.getLogger(__name__)
+
+RECORD_LENGTH = 512
+# Sequence numbers are six hexadecimal digits
+_SEQUENCE_MODULUS = 0x1000000
+# Start time in the fixed header of big-endian records
+_BTIME = struct.Struct(">HHBBBxH")
+_SOFTWARE = "SeedLink v3.1 (RT-EQcorrscan replay)"
+_ORGANIZATION = "RT-EQcorrscan"
+
+
+class _Packet(object):
+    """ One miniSEED record and when to release it. """
+    __slots__ = ("release", "network", "station", "location", "channel",
+                 "record", "sequence")
+
+    def __init__(self, release: float, stats, record: bytes):
+        self.release = release
+        self.network = stats.network
+        self.station = stats.station
+        self.location = stats.location
+        self.channel = stats.channel
+        self.record = record
+        self.sequence = None
+
+
+class _StationSelection(object):
+    """ A station requested by a client and its stream selectors. """
+    def __init__(self, network: str, station: str):
+        self.network = network
+        self.station = station
+        self.selectors = []
+        self.sequence = None
+
+    def add_selector(self, selector: str) -> None:
+        """ Add a SeedLink selector: [LL]CCC with ? wildcards, e.g. EH? """
+        selector = selector.split(".")[0]
+        location, channel = selector[:-3], selector[-3:]
+        self.selectors.append((location or "*", channel))
+
+    def wants(self, packet: _Packet) -> bool:
+        if (packet.network != self.network or
+                packet.station != self.station):
+            return False
+        if self.sequence is not None and packet.sequence < self.sequence:
+            return False
+        if len(self.selectors) == 0:
+            return True
+        for location, channel in self.selectors:
+            if (fnmatch.fnmatchcase(packet.channel, channel) and
+                    fnmatch.fnmatchcase(packet.location, location)):
+                return True
+        return False
+
+
+class SeedLinkReplayServer(object):
+    """
+    SeedLink server that replays data as if they were arriving in real-time.
+
+    Data are cut into miniSEED records which are released to connected
+    clients once the replay clock passes their last sample. Clients such as
+    `RealTimeClient` connect to `url` and select streams as for any
+    SeedLink server. Reconnecting clients resume from the sequence number
+    of the last packet they received.
+
+    Parameters
+    ----------
+    data
+        Data to replay: a Stream, a miniSEED file name or glob, a list of
+        those, or a WaveBank.
+    host
+        Address to listen on.
+    port
+        Port to listen on - 0 picks a free port.
+    starttime
+        Start of the data to replay, defaults to the start of the data.
+    endtime
+        End of the data to replay, defaults to the end of the data.
+    n_channels
+        Number of channels to serve. Channels are repeated, with new station
+        codes, to make up more channels than are in the data. Defaults to
+        the channels in the data.
+    packet_length
+        Seconds of data in each packet. Defaults to as much as fits in a
+        512 byte record.
+    speed_up
+        Multiplier to replay faster than real-time (real-time is 1.0).
+    latency
+        Seconds between the last sample of a packet and its release.
+    jitter
+        Largest random extra delay in seconds added to each packet.
+    out_of_order
+        Probability that a packet is released after the next packet of its
+        channel.
+    disconnect_interval
+        Close each connection after this many seconds of streaming, to test
+        reconnection. None (default) never disconnects. ObsPy clients only
+        notice a closed connection after their network time-out
+        (`conn.set_net_timeout`) and reconnect after their network delay
+        (`conn.set_net_delay`).
+    wait_for_client
+        Whether to start the replay clock when the first client starts
+        streaming, rather than when the server starts, so that the first
+        client gets all the data.
+    timeshift
+        Whether to shift the times of the data so that the replay starts
+        now. At a speed-up of 1 the latency of packets measured by clients
+        is then the end-to-end latency.
+    ring_size
+        Number of released packets kept for clients resuming after a
+        disconnect.
+    seed
+        Seed for the random jitter and out-of-order packets.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> from rt_eqcorrscan.streaming.seedlink import RealTimeClient
+    >>> server = SeedLinkReplayServer(read(), packet_length=1., speed_up=20.)
+    >>> server.start()
+    >>> client = RealTimeClient(server_url=server.url, buffer_capacity=60.)
+    >>> client.select_stream(net="BW", station="RJOB", selector="EH?")
+    >>> client.background_run()
+    >>> server.finished.wait(timeout=10)
+    True
+    >>> time.sleep(0.5)  # Let the client receive the last packets
+    >>> client.background_stop()
+    >>> server.stop()
+    >>> server.stats()["released"]
+    180
+    >>> print(client.get_stream().split()) # doctest: +ELLIPSIS
+    3 Trace(s) in Stream:
+    BW.RJOB..EHE | ... | 100.0 Hz, 3000 samples
+    BW.RJOB..EHN | ... | 100.0 Hz, 3000 samples
+    BW.RJOB..EHZ | ... | 100.0 Hz, 3000 samples
+    """
+    def __init__(
+        self,
+        data: Union[Stream, str, Iterable[str], WaveBank],
+        host: str = "localhost",
+        port: int = 0,
+        starttime: UTCDateTime = None,
+        endtime: UTCDateTime = None,
+        n_channels: int = None,
+        packet_length: float = None,
+        speed_up: float = 1.,
+        latency: float = 0.,
+        jitter: float = 0.,
+        out_of_order: float = 0.,
+        disconnect_interval: float = None,
+        wait_for_client: bool = True,
+        timeshift: bool = True,
+        ring_size: int = 100000,
+        seed: int = None,
+    ):
+        assert speed_up > 0, "speed_up must be positive"
+        assert 0 <= out_of_order <= 1, "out_of_order must be a probability"
+        self.host = host
+        self.port = port
+        self.st = _load(data, starttime=starttime, endtime=endtime)
+        assert len(self.st), "No data to replay"
+        if n_channels is not None:
+            self.st = _repeat_channels(self.st, n_channels)
+        self.packet_length = packet_length
+        self.speed_up = speed_up
+        self.latency = latency
+        self.jitter = jitter
+        self.out_of_order = out_of_order
+        self.disconnect_interval = disconnect_interval
+        self.wait_for_client = wait_for_client
+        self.timeshift = timeshift
+        self.seed = seed
+        self.finished = threading.Event()
+        self._ring = deque(maxlen=ring_size)
+        self._next_sequence = 0
+        self._new_data = threading.Condition()
+        self._stopped = threading.Event()
+        self._streaming = threading.Event()
+        self._server = None
+        self._threads = []
+        self._handlers = set()
+        self._counts = dict(released=0, sent=0, connections=0, disconnects=0)
+
+    def __repr__(self):
+        return "SeedLinkReplayServer({0} channels, url={1})".format(
+            len(self.st), self.url)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        """ Address for clients to connect to. """
+        return "{0}:{1}".format(self.host, self.port)
+
+    @property
+    def stations(self) -> set:
+        """ (network, station) of all stations served. """
+        return {(tr.stats.network, tr.stats.station) for tr in self.st}
+
+    def start(self) -> None:
+        """ Encode the data and start listening. """
+        assert self._server is None, "Server already started"
+        self._stopped.clear()
+        self._streaming.clear()
+        self.finished.clear()
+        packets = self._packets()
+        self._server = _TCPServer((self.host, self.port), _SeedLinkHandler)
+        self._server.replay = self
+        self.port = self._server.server_address[1]
+        self._threads = [
+            threading.Thread(target=self._server.serve_forever,
+                             kwargs=dict(poll_interval=0.1),
+                             name="SeedLinkServer", daemon=True),
+            threading.Thread(target=self._replay,
+                             args=(packets, ),
+                             name="SeedLinkReplay", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        Logger.info("Serving {0} packets for {1} channels at {2}".format(
+            len(packets), len(self.st), self.url))
+
+    def stop(self) -> None:
+        """ Stop the replay and close all connections. """
+        if self._server is None:
+            return
+        self._stopped.set()
+        with self._new_data:
+            self._new_data.notify_all()
+        self._server.shutdown()
+        for handler in list(self._handlers):
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._server = None
+        Logger.info("Stopped SeedLink replay server")
+
+    def stats(self) -> dict:
+        """
+        Counts of packets released and sent, and of client connections and
+        disconnections made by the server.
+        """
+        return dict(self._counts)
+
+    def _packets(self) -> list:
+        """ Encode the data into packets sorted by release time. """
+        rng = np.random.default_rng(self.seed)
+        packets = []
+        for tr in self.st:
+            channel_packets = [
+                _Packet(end + self.latency, tr.stats, record)
+                for end, record in _encode(tr.copy(), self.packet_length)]
+            if self.jitter:
+                for packet in channel_packets:
+                    packet.release += rng.uniform(0, self.jitter)
+            if self.out_of_order:
+                for first, second in zip(channel_packets[:-1],
+                                         channel_packets[1:]):
+                    if rng.uniform() < self.out_of_order:
+                        first.release = max(first.release, second.release)
+                        second.release = np.nextafter(
+                            first.release, -np.inf)
+            packets.extend(channel_packets)
+        packets.sort(key=lambda packet: packet.release)
+        return packets
+
+    def _replay(self, packets: list) -> None:
+        """ Release packets to the ring as the replay clock passes them. """
+        if self.wait_for_client:
+            while not self._streaming.wait(0.1):
+                if self._stopped.is_set():
+                    return
+        wall_start = time.time()
+        data_start = min(tr.stats.starttime for tr in self.st).timestamp
+        # Whole ten-thousandths of a second: the resolution of record times
+        shift = 0
+        if self.timeshift:
+            shift = int(round((wall_start - data_start) * 1e4))
+        for packet in packets:
+            wait = (wall_start + (packet.release - data_start) /
+                    self.speed_up - time.time())
+            if wait > 0 and self._stopped.wait(wait):
+                return
+            if shift:
+                packet.record = _shift_record(packet.record, shift)
+            with self._new_data:
+                packet.sequence = self._next_sequence
+                self._next_sequence += 1
+                self._ring.append(packet)
+                self._counts["released"] += 1
+                self._new_data.notify_all()
+        self.finished.set()
+        Logger.info("Replay finished")
+
+    def _wait_for_packets(self, sequence: int, timeout: float) -> list:
+        """ Get released packets from sequence on, waiting for new ones. """
+        with self._new_data:
+            if self._next_sequence <= sequence and not self._stopped.is_set():
+                self._new_data.wait(timeout)
+            if len(self._ring) == 0:
+                return []
+            start = max(sequence - self._ring[0].sequence, 0)
+            return list(itertools.islice(self._ring, start, None))
+
+    def _info(self, level: str) -> str:
+        """ XML for an INFO request. """
+        level = level.upper()
+        if level == "CAPABILITIES":
+            capabilities = ["dialup", "multistation", "info:id",
+                            "info:capabilities", "info:stations",
+                            "info:streams"]
+            return "<seedlink>{0}</seedlink>".format("".join(
+                '<capability name="{0}"/>'.format(capability)
+                for capability in capabilities))
+        if level in ("STATIONS", "STREAMS"):
+            stations = []
+            for network, station in sorted(self.stations):
+                streams = ""
+                if level == "STREAMS":
+                    streams = "".join(
+                        '<stream location="{0}" seedname="{1}" type="D" '
+                        'begin_time="{2}" end_time="{3}"/>'.format(
+                            tr.stats.location, tr.stats.channel,
+                            tr.stats.starttime, tr.stats.endtime)
+                        for tr in self.st.select(
+                            network=network, station=station))
+                stations.append(
+                    '<station name="{0}" network="{1}" description="">'
+                    '{2}</station>'.format(station, network, streams))
+            return "<seedlink>{0}</seedlink>".format("".join(stations))
+        return '<seedlink software="{0}" organization="{1}"/>'.format(
+            _SOFTWARE, _ORGANIZATION)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    replay = None
+
+
+class _SeedLinkHandler(socketserver.BaseRequestHandler):
+    """ One client connection. """
+    def setup(self):
+        self.replay = self.server.replay
+        self.stations = []
+        self._pending = b""
+
+    def handle(self):
+        replay = self.replay
+        replay._handlers.add(self)
+        replay._counts["connections"] += 1
+        try:
+            if self._negotiate():
+                self._stream()
+        except OSError as e:
+            Logger.debug("Connection closed: {0}".format(e))
+        finally:
+            replay._handlers.discard(self)
+
+    def _send(self, data: bytes) -> None:
+        self.request.sendall(data)
+
+    def _read_command(self, timeout: float = None) -> Union[str, None]:
+        """
+        Read one command line, or None if the client has gone or, when a
+        timeout is given, no command arrives in that time.
+        """
+        while True:
+            for terminator in (b"\r", b"\n"):
+                if terminator in self._pending:
+                    line, self._pending = self._pending.split(terminator, 1)
+                    line = line.strip()
+                    if line:
+                        return line.decode("ascii", errors="replace")
+                    break
+            else:
+                if timeout is not None:
+                    readable, _, _ = select.select(
+                        [self.request], [], [], timeout)
+                    if not readable:
+                        return ""
+                data = self.request.recv(1024)
+                if not data:
+                    return None
+                self._pending += data
+
+    def _send_info(self, level: str) -> None:
+        records = _encode_text(self.replay._info(level))
+        for i, record in enumerate(records):
+            terminated = i == len(records) - 1
+            self._send((b"SLINFO  " if terminated else b"SLINFO *") + record)
+
+    def _negotiate(self) -> bool:
+        """ Handle commands until the client starts streaming with END. """
+        station = None
+        while not self.replay._stopped.is_set():
+            command = self._read_command()
+            if command is None:
+                return False
+            verb, *args = command.split()
+            verb = verb.upper()
+            if verb == "HELLO":
+                self._send("{0}\r\n{1}\r\n".format(
+                    _SOFTWARE, _ORGANIZATION).encode())
+            elif verb == "INFO":
+                self._send_info(args[0] if args else "ID")
+            elif verb == "STATION" and len(args) == 2:
+                if (args[1], args[0]) in self.replay.stations:
+                    station = _StationSelection(
+                        network=args[1], station=args[0])
+                    self.stations.append(station)
+                    self._send(b"OK\r\n")
+                else:
+                    station = None
+                    self._send(b"ERROR\r\n")
+            elif verb == "SELECT" and station is not None and len(args):
+                station.add_selector(args[0])
+                self._send(b"OK\r\n")
+            elif verb in ("DATA", "FETCH") and station is not None:
+                if args:
+                    station.sequence = int(args[0], 16)
+                self._send(b"OK\r\n")
+            elif verb == "END":
+                return len(self.stations) > 0
+            elif verb == "BYE":
+                return False
+            else:
+                # TIME windows and uni-station mode are not supported
+                self._send(b"ERROR\r\n")
+        return False
+
+    def _stream(self) -> None:
+        """ Send packets for the selected stations as they are released. """
+        replay = self.replay
+        with replay._new_data:
+            sequence = replay._next_sequence
+        replay._streaming.set()
+        resumed = [station.sequence for station in self.stations
+                   if station.sequence is not None]
+        if resumed:
+            sequence = min(resumed + [sequence])
+        connected = time.time()
+        while not replay._stopped.is_set():
+            if (replay.disconnect_interval is not None and
+                    time.time() - connected > replay.disconnect_interval):
+                replay._counts["disconnects"] += 1
+                Logger.info("Disconnecting client")
+                return
+            for packet in replay._wait_for_packets(sequence, timeout=0.1):
+                sequence = packet.sequence + 1
+                if any(station.wants(packet) for station in self.stations):
+                    self._send(b"SL%06X" % (
+                        packet.sequence % _SEQUENCE_MODULUS) + packet.record)
+                    replay._counts["sent"] += 1
+            # Answer keep-alive INFO requests, stop on BYE
+            while True:
+                command = self._read_command(timeout=0)
+                if command is None or command.upper() == "BYE":
+                    return
+                if not command:
+                    break
+                if command.upper().startswith("INFO"):
+                    self._send_info((command.split() + ["ID"])[1])
+
+
+def _load(
+    data: Union[Stream, str, Iterable[str], WaveBank],
+    starttime: UTCDateTime = None,
+    endtime: UTCDateTime = None,
+) -> Stream:
+    """ Read the data to replay, split where there are gaps. """
+    if isinstance(data, Stream):
+        st = data.copy()
+    elif isinstance(data, WaveBank):
+        st = data.get_waveforms(starttime=starttime, endtime=endtime)
+    else:
+        if isinstance(data, str):
+            data = [data]
+        st = Stream()
+        for path in data:
+            st += read(path)
+    st = st.merge().split()
+    if starttime is not None or endtime is not None:
+        st.trim(starttime, endtime)
+    st.traces = [tr for tr in st if tr.stats.npts > 0]
+    return st.sort()
+
+
+def _repeat_channels(st: Stream, n_channels: int) -> Stream:
+    """ Repeat channels with new station codes to make n_channels. """
+    seed_ids = sorted({tr.id for tr in st})
+    stations = sorted({(tr.stats.network, tr.stats.station) for tr in st})
+    repeated = Stream()
+    for i in range(n_channels):
+        repeat, index = divmod(i, len(seed_ids))
+        for tr in st.select(id=seed_ids[index]):
+            tr = tr.copy()
+            if repeat:
+                # New station codes for each repeat of each station
+                station_index = stations.index(
+                    (tr.stats.network, tr.stats.station))
+                tr.stats.station = "R{0:04d}".format(
+                    (repeat - 1) * len(stations) + station_index)
+            repeated += tr
+    return repeated
+
+
+def _encode(tr: Trace, packet_length: float = None) -> list:
+    """
+    Encode a trace into big-endian 512 byte miniSEED records.
+
+    Returns
+    -------
+    List of (time of the last sample as a UNIX timestamp, record bytes).
+    """
+    if tr.data.dtype.kind in "iu":
+        tr.data = tr.data.astype(np.int32)
+    sampling_rate = tr.stats.sampling_rate
+    chunk = tr.stats.npts
+    if packet_length is not None:
+        chunk = max(1, int(round(packet_length * sampling_rate)))
+    records = []
+    for first in range(0, tr.stats.npts, chunk):
+        chunk_tr = Trace(data=tr.data[first:first + chunk], header=dict(
+            network=tr.stats.network, station=tr.stats.station,
+            location=tr.stats.location, channel=tr.stats.channel,
+            sampling_rate=sampling_rate,
+            starttime=tr.stats.starttime + first / sampling_rate))
+        buf = io.BytesIO()
+        chunk_tr.write(buf, format="MSEED", reclen=RECORD_LENGTH,
+                       byteorder=">")
+        raw = buf.getvalue()
+        start = chunk_tr.stats.starttime.timestamp
+        for offset in range(0, len(raw), RECORD_LENGTH):
+            record = raw[offset:offset + RECORD_LENGTH]
+            # Number of samples is in the fixed header
+            npts = struct.unpack(">H", record[30:32])[0]
+            records.append((start + (npts - 1) / sampling_rate, record))
+            start += npts / sampling_rate
+    return records
+
+
+def _shift_record(record: bytes, shift: int) -> bytes:
+    """
+    Shift the start time in the header of a big-endian record by shift
+    ten-thousandths of a second.
+    """
+    year, julday, hour, minute, second, fract = _BTIME.unpack_from(
+        record, 20)
+    start = datetime.datetime(year, 1, 1, hour, minute, second) + \
+        datetime.timedelta(days=julday - 1, microseconds=(fract + shift) * 100)
+    return b"".join([record[:20], _BTIME.pack(
+        start.year, start.timetuple().tm_yday, start.hour, start.minute,
+        start.second, start.microsecond // 100), record[30:]])
+
+
+def _encode_text(text: str) -> list:
+    """ Encode text into 512 byte miniSEED log records. """
+    tr = Trace(data=np.frombuffer(text.encode("ascii"), dtype="S1"),
+               header=dict(station="INFO", channel="LOG",
+                           starttime=UTCDateTime.now()))
+    buf = io.BytesIO()
+    tr.write(buf, format="MSEED", reclen=RECORD_LENGTH, encoding="ASCII",
+             byteorder=">")
+    raw = buf.getvalue()
+    return [raw[offset:offset + RECORD_LENGTH]
+            for offset in range(0, len(raw), RECORD_LENGTH)]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
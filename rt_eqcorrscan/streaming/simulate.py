@@ -7,16 +7,22 @@ Author
 License
     GPL v3.0
 """
+import asyncio
 import logging
+import threading
 import time
 import copy
+
+from collections import deque
 from numpy import random
 
 from obspy import Stream, UTCDateTime
 
 from obsplus import WaveBank
 
-from rt_eqcorrscan.streaming.streaming import _StreamingClient
+from rt_eqcorrscan.streaming.clock import WallClock
+from rt_eqcorrscan.streaming.streaming import (
+    _StreamingClient, AsyncStreamingClient)
 
 
 Logger = logging.getLogger(__name__)
@@ -26,6 +32,16 @@ class SimulateRealTimeClient(_StreamingClient):
     """
     Simulation of a real-time client for past data. Used for testing
 
+    Data for all selected streams are requested in one `get_waveforms_bulk`
+    call per query if the client supports it, and one `get_waveforms` call
+    per stream otherwise. With `prefetch` set, data are instead read ahead
+    of the queries in the background, `prefetch` query intervals at a time,
+    and queries are served from memory.
+
+    With a `VirtualClock` the client does not wait between queries, and
+    simulations run as fast as data can be read and processed while keeping
+    the same sequence of queries as in real time.
+
     Parameters
     ----------
     client
@@ -40,6 +56,20 @@ class SimulateRealTimeClient(_StreamingClient):
         Stream to buffer data into
     buffer_capacity
         Length of buffer in seconds. Old data are removed in a FIFO style.
+    wavebank
+        Optional wavebank to save data to.
+    coalesce_latency
+        Longest time in seconds to hold packets to add them to the buffer
+        together, see `_StreamingClient`. Held packets are always added at
+        the end of each query.
+    coalesce_samples
+        Number of samples held for a channel that releases the channel.
+    prefetch
+        Number of query intervals to read from the client at once, ahead of
+        the queries. 0 (default) queries the client for every interval.
+    clock
+        Clock to keep time with, defaults to a `WallClock`. Query times and
+        waits between queries are measured by this clock.
     """
     def __init__(
         self,
@@ -50,16 +80,26 @@ class SimulateRealTimeClient(_StreamingClient):
         buffer: Stream = None,
         buffer_capacity: float = 600.,
         wavebank: WaveBank = None,
+        coalesce_latency: float = None,
+        coalesce_samples: int = None,
+        prefetch: int = 0,
+        clock=None,
     ) -> None:
         self.client = client
         super().__init__(
             client_name=self.client.base_url, buffer=buffer,
-            buffer_capacity=buffer_capacity, wavebank=wavebank)
+            buffer_capacity=buffer_capacity, wavebank=wavebank,
+            coalesce_latency=coalesce_latency,
+            coalesce_samples=coalesce_samples)
         self.starttime = starttime
         self.query_interval = query_interval
         self.speed_up = speed_up
+        self.prefetch = prefetch
+        self.clock = clock or WallClock()
         self.bulk = []
         self.streaming = False
+        self._progress = None
+        self._read_ahead = None
         Logger.info(
             "Instantiated simulated real-time client "
             "(starttime = {0}): {1}".format(self.starttime, self))
@@ -71,14 +111,16 @@ class SimulateRealTimeClient(_StreamingClient):
 
     def copy(self, empty_buffer: bool = True):
         if empty_buffer:
-            buffer = Stream()
+            buffer = self._empty_buffer()
         else:
-            buffer = self.get_stream()
-        return SimulateRealTimeClient(
+            buffer = self.buffer.copy()
+        return self.__class__(
             client=self.client, starttime=self.starttime,
             query_interval=self.query_interval, speed_up=self.speed_up,
             buffer=buffer, buffer_capacity=self.buffer_capacity,
-            wavebank=self.wavebank)
+            wavebank=self.wavebank, coalesce_latency=self.coalesce_latency,
+            coalesce_samples=self.coalesce_samples, prefetch=self.prefetch,
+            clock=self.clock)
 
     @property
     def can_add_streams(self) -> bool:
@@ -102,40 +144,150 @@ class SimulateRealTimeClient(_StreamingClient):
             Logger.debug("Added {0} to streaming selection".format(_bulk))
             self.bulk.append(_bulk)
 
+    @property
+    def speed_up_stats(self) -> dict:
+        """
+        Requested and achieved speed-up of the last run, or None if the
+        client has not run.
+
+        The achieved speed-up is the simulated time covered divided by the
+        time taken, and is lower than requested when queries take longer
+        than `query_interval / speed_up`.
+        """
+        if self._progress is None:
+            return None
+        simulated, elapsed, queries, query_time = self._progress
+        return {
+            "requested": self.speed_up,
+            "achieved": simulated / elapsed if elapsed > 0 else 0.,
+            "simulated_seconds": simulated, "elapsed_seconds": elapsed,
+            "queries": queries,
+            "mean_query_duration": query_time / max(queries, 1)}
+
+    @property
+    def prefetch_stats(self) -> dict:
+        """
+        Summary of reading ahead, or None if data are not read ahead.
+
+        Wait times are the time queries spent waiting for data to be read.
+        """
+        if self._read_ahead is None:
+            return None
+        return self._read_ahead.stats()
+
+    def _query(self, starttime: UTCDateTime, endtime: UTCDateTime) -> Stream:
+        """ Get data for the selected streams up to a jittered endtime. """
+        for _bulk in self.bulk:
+            jitter = random.randint(int(self.query_interval))
+            _bulk.update({
+                "starttime": starttime,
+                "endtime": endtime - jitter})
+        if self._read_ahead is not None:
+            return self._read_ahead.get(self.bulk)
+        return self._get_waveforms(self.bulk)
+
+    def _get_waveforms(self, selection: list) -> Stream:
+        """ Get data for a list of get_waveforms keyword arguments. """
+        if hasattr(self.client, "get_waveforms_bulk"):
+            bulk = [(_bulk["network"], _bulk["station"], _bulk["location"],
+                     _bulk["channel"], _bulk["starttime"], _bulk["endtime"])
+                    for _bulk in selection]
+            Logger.debug("Querying client for {0}".format(bulk))
+            try:
+                return self.client.get_waveforms_bulk(bulk)
+            except Exception as e:
+                Logger.error("Failed (bulk={0}), querying streams "
+                             "individually".format(bulk))
+                Logger.error(e)
+        st = Stream()
+        for _bulk in selection:
+            Logger.debug("Querying client for {0}".format(_bulk))
+            try:
+                st += self.client.get_waveforms(**_bulk)
+            except Exception as e:
+                Logger.error("Failed (bulk={0})".format(_bulk))
+                Logger.error(e)
+                continue
+        return st
+
+    def _ingest(self, st: Stream, query_start: UTCDateTime,
+                now: UTCDateTime) -> float:
+        """
+        Add queried data to the buffer.
+
+        Data are counted in `metrics` as arriving at the simulated time of
+        the query, `now`, so that latencies are in simulated time.
+
+        Returns
+        -------
+        Seconds taken since the query started.
+        """
+        for tr in st:
+            self.on_data(tr, arrival=now.timestamp)
+        # Nothing more will arrive until the next query
+        self.flush()
+        _query_duration = self.clock.now() - query_start
+        Logger.debug(
+            "It took {0:.2f}s to query the database and sort data".format(
+                _query_duration))
+        return _query_duration
+
+    def _tick(self, now: UTCDateTime, run_start: float,
+              query_duration: float) -> float:
+        """
+        Record the progress of the simulation after a query.
+
+        Returns
+        -------
+        Seconds to sleep before the next query to keep to the speed-up.
+        """
+        simulated, elapsed, queries, query_time = self._progress
+        # Progress up to the start of this query
+        self._progress = (
+            now - self.starttime,
+            time.perf_counter() - run_start - query_duration,
+            queries + 1, query_time + query_duration)
+        if queries and queries % 100 == 0:
+            Logger.info("Simulating at {0:.1f}x real-time ({1:.1f}x "
+                        "requested)".format(
+                            self.speed_up_stats["achieved"], self.speed_up))
+        return self.query_interval / self.speed_up - query_duration
+
+    def _start_read_ahead(self, starttime: UTCDateTime) -> None:
+        if self.prefetch > 0:
+            self._read_ahead = _ReadAhead(
+                fetch=self._get_waveforms, selection=self.bulk,
+                starttime=starttime,
+                chunk_length=self.prefetch * self.query_interval)
+            self._read_ahead.start()
+
+    def _stop_read_ahead(self) -> None:
+        if self._read_ahead is not None:
+            self._read_ahead.stop()
+
     def run(self) -> None:
         assert len(self.bulk) > 0, "Select a stream first"
         self.streaming = True
         now = copy.deepcopy(self.starttime)
         last_query_start = now - self.query_interval
-        while self.streaming:
-            _query_start = UTCDateTime.now()
-            st = Stream()
-            for _bulk in self.bulk:
-                jitter = random.randint(int(self.query_interval))
-                _bulk.update({
-                    "starttime": last_query_start,
-                    "endtime": now - jitter})
-                Logger.debug("Querying client for {0}".format(_bulk))
-                try:
-                    st += self.client.get_waveforms(**_bulk)
-                except Exception as e:
-                    Logger.error("Failed (bulk={0})".format(_bulk))
-                    Logger.error(e)
-                    continue
-            for tr in st:
-                self.on_data(tr)
-            _query_duration = UTCDateTime.now() - _query_start
-            Logger.debug(
-                "It took {0:.2f}s to query the database and sort data".format(
-                    _query_duration))
-            sleep_step = (
-                self.query_interval - _query_duration) / self.speed_up
-            if sleep_step > 0:
-                Logger.debug("Waiting {0:.2f}s before next query".format(
-                    sleep_step))
-                time.sleep(sleep_step)
-            now += max(self.query_interval, _query_duration)
-            last_query_start = min([_bulk["endtime"] for _bulk in self.bulk])
+        run_start, self._progress = time.perf_counter(), (0., 0., 0, 0.)
+        self._start_read_ahead(last_query_start)
+        try:
+            while self.streaming:
+                _query_start = self.clock.now()
+                st = self._query(last_query_start, now)
+                _query_duration = self._ingest(st, _query_start, now)
+                sleep_step = self._tick(now, run_start, _query_duration)
+                if sleep_step > 0:
+                    Logger.debug("Waiting {0:.2f}s before next query".format(
+                        sleep_step))
+                    self.clock.sleep(sleep_step)
+                now += max(self.query_interval, _query_duration)
+                last_query_start = min(
+                    [_bulk["endtime"] for _bulk in self.bulk])
+        finally:
+            self._stop_read_ahead()
+            self.clock.detach()
 
     def stop(self) -> None:
         self.busy = False
@@ -143,6 +295,164 @@ class SimulateRealTimeClient(_StreamingClient):
         self.started = False
 
 
+class AsyncSimulateRealTimeClient(AsyncStreamingClient,
+                                  SimulateRealTimeClient):
+    """
+    Simulation of a real-time client for past data, run in an asyncio event
+    loop, see `AsyncStreamingClient`.
+
+    Parameters are as for `SimulateRealTimeClient`. Queries to the client
+    are run in the event loop's default executor. Waits are made in the
+    event loop, so only a `WallClock` can be used.
+    """
+    async def run(self) -> None:
+        assert len(self.bulk) > 0, "Select a stream first"
+        assert not self.clock.virtual, "Virtual clocks need threads"
+        self.streaming = True
+        loop = asyncio.get_running_loop()
+        now = copy.deepcopy(self.starttime)
+        last_query_start = now - self.query_interval
+        run_start, self._progress = time.perf_counter(), (0., 0., 0, 0.)
+        self._start_read_ahead(last_query_start)
+        try:
+            while self.streaming:
+                _query_start = self.clock.now()
+                st = await loop.run_in_executor(
+                    None, self._query, last_query_start, now)
+                _query_duration = self._ingest(st, _query_start, now)
+                sleep_step = self._tick(now, run_start, _query_duration)
+                if sleep_step > 0:
+                    Logger.debug("Waiting {0:.2f}s before next query".format(
+                        sleep_step))
+                    if await self.sleep(sleep_step):
+                        break
+                now += max(self.query_interval, _query_duration)
+                last_query_start = min(
+                    [_bulk["endtime"] for _bulk in self.bulk])
+        finally:
+            self._stop_read_ahead()
+
+    async def stop(self) -> None:
+        self.streaming = False
+        await super().stop()
+
+
+class _ReadAhead(object):
+    """
+    Reads data for the selected streams in the background, in chunks of
+    chunk_length seconds, keeping at least one chunk ahead of the data
+    asked for.
+
+    Parameters
+    ----------
+    fetch
+        Function taking a list of get_waveforms keyword arguments and
+        returning a Stream.
+    selection
+        get_waveforms keyword arguments for each selected stream.
+    starttime
+        Start of the first chunk.
+    chunk_length
+        Seconds of data to read at once.
+    """
+    def __init__(
+        self,
+        fetch,
+        selection: list,
+        starttime: UTCDateTime,
+        chunk_length: float,
+    ):
+        self.fetch = fetch
+        self.selection = [
+            {key: value for key, value in _bulk.items()
+             if key not in ("starttime", "endtime")} for _bulk in selection]
+        self.chunk_length = chunk_length
+        # Chunks of (starttime, endtime, list of traces for each selection)
+        self._chunks = deque()
+        self._next_start = starttime
+        self._wanted = starttime
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = None
+        self._counts = dict(chunks=0, read_time=0., waits=0, wait_time=0.)
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="ReadAheadThread", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        counts = dict(self._counts)
+        counts["mean_read_time"] = (
+            counts["read_time"] / max(counts["chunks"], 1))
+        counts["chunks_held"] = len(self._chunks)
+        return counts
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                # Read ahead one chunk beyond the data wanted
+                while (self._running and self._next_start >
+                       self._wanted + self.chunk_length):
+                    self._condition.wait()
+                if not self._running:
+                    return
+                starttime = self._next_start
+            endtime = starttime + self.chunk_length
+            tic = time.perf_counter()
+            st = self.fetch([dict(_bulk, starttime=starttime, endtime=endtime)
+                             for _bulk in self.selection])
+            traces = [st.select(
+                network=_bulk["network"], station=_bulk["station"],
+                location=_bulk["location"], channel=_bulk["channel"]).traces
+                for _bulk in self.selection]
+            Logger.debug("Read {0} - {1} ahead".format(starttime, endtime))
+            with self._condition:
+                self._chunks.append((starttime, endtime, traces))
+                self._next_start = endtime
+                self._counts["chunks"] += 1
+                self._counts["read_time"] += time.perf_counter() - tic
+                self._condition.notify_all()
+
+    def get(self, selection: list) -> Stream:
+        """
+        Get data for get_waveforms keyword arguments for each of the
+        selected streams, waiting for them to be read.
+        """
+        starttime = min(_bulk["starttime"] for _bulk in selection)
+        endtime = max(_bulk["endtime"] for _bulk in selection)
+        with self._condition:
+            while self._chunks and self._chunks[0][1] < starttime:
+                self._chunks.popleft()
+            self._wanted = endtime
+            self._condition.notify_all()
+            if self._running and self._next_start < endtime:
+                tic = time.perf_counter()
+                while self._running and self._next_start < endtime:
+                    self._condition.wait()
+                self._counts["waits"] += 1
+                self._counts["wait_time"] += time.perf_counter() - tic
+            chunks = list(self._chunks)
+        st = Stream()
+        for i, _bulk in enumerate(selection):
+            for chunk_start, chunk_end, traces in chunks:
+                if (chunk_end < _bulk["starttime"] or
+                        chunk_start > _bulk["endtime"]):
+                    continue
+                for tr in traces[i]:
+                    tr = tr.slice(_bulk["starttime"], _bulk["endtime"])
+                    if tr.stats.npts:
+                        st += tr
+        return st
+
+
 if __name__ == "__main__":
     import doctest
 
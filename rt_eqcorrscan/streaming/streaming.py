@@ -8,16 +8,23 @@ License
     GPL v3.0
 """
 
+import asyncio
 import threading
 import logging
+import time
+import numpy as np
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Union
 
 from obspy import Stream, Trace
 from obsplus import WaveBank
 
-from rt_eqcorrscan.streaming.buffers import Buffer
+from rt_eqcorrscan.streaming.buffers import (
+    Buffer, AlignedBuffer, SharedBuffer, _TIME_TOLERANCE_NS)
+from rt_eqcorrscan.streaming.metrics import IngestMetrics
 
 Logger = logging.getLogger(__name__)
 
@@ -37,6 +44,35 @@ class _StreamingClient(ABC):
     wavebank
         Optional wavebank to save data to. Used for backfilling by
         RealTimeTribe
+    coalesce_latency
+        Longest time in seconds to hold packets before adding them to the
+        buffer. Contiguous packets for a channel that arrive within this
+        time are joined and added to the buffer (and wavebank) together,
+        which reduces the cost per packet, but data reach detection and
+        plotting up to this much later. Set to None (default) to add every
+        packet as it arrives.
+    coalesce_samples
+        Add held packets for a channel once this many samples are held.
+        Can be used with or without `coalesce_latency`.
+
+    Attributes
+    ----------
+    processed_buffer
+        Optional `ProcessedBuffer`: data added to the buffer are also
+        processed into this as they arrive.
+    metrics
+        `IngestMetrics` for packets as they arrive: packet counts, gaps,
+        out-of-order packets and latency for each channel. Arrival times
+        are taken from `clock` if it is set.
+    clock
+        Optional clock (see `rt_eqcorrscan.streaming.clock`) that the client
+        keeps time with. Threads started by `background_run` are attached
+        to it.
+    archiver
+        Optional `WaveBankArchiver` writing to `wavebank`: data for the
+        wavebank are queued to this and written in the background, rather
+        than written as they arrive. Data reach the wavebank up to the
+        archiver's `flush_interval` later.
 
     Notes
     -----
@@ -46,13 +82,18 @@ class _StreamingClient(ABC):
     """
     busy = False
     started = False
+    processed_buffer = None
+    clock = None
+    archiver = None
 
     def __init__(
         self,
         client_name: str = None,
-        buffer: Union[Stream, Buffer] = None,
+        buffer: Union[Stream, Buffer, AlignedBuffer, SharedBuffer] = None,
         buffer_capacity: float = 600.,
         wavebank: WaveBank = None,
+        coalesce_latency: float = None,
+        coalesce_samples: int = None,
     ) -> None:
         self.client_name = client_name
         if buffer is None:
@@ -60,8 +101,16 @@ class _StreamingClient(ABC):
         elif isinstance(buffer, Stream):
             buffer = Buffer(buffer.traces, maxlen=buffer_capacity)
         self._buffer = buffer
-        self.buffer_capacity = buffer_capacity
+        self._buffer_capacity = buffer_capacity
         self.wavebank = wavebank
+        self.coalesce_latency = coalesce_latency
+        self.coalesce_samples = coalesce_samples
+        self._coalescer = None
+        if coalesce_latency is not None or coalesce_samples is not None:
+            self._coalescer = _PacketCoalescer(
+                max_latency=coalesce_latency, max_samples=coalesce_samples,
+                on_release=self._buffer_traces)
+        self.metrics = IngestMetrics()
         self.threads = []
 
     def __repr__(self):
@@ -90,12 +139,62 @@ class _StreamingClient(ABC):
         """ Whether streams can be added."""
 
     @property
-    def buffer(self) -> Buffer:
+    def buffer(self) -> Union[Buffer, AlignedBuffer, SharedBuffer]:
         return self._buffer
 
+    @property
+    def buffer_capacity(self) -> float:
+        """ Length of the buffer in seconds. """
+        return self._buffer_capacity
+
+    @buffer_capacity.setter
+    def buffer_capacity(self, capacity: float):
+        """
+        Set the length of the buffer.
+
+        A `Buffer` is resized in place, keeping the newest data, and can be
+        resized while data are streaming. Other buffers are fixed size: the
+        new capacity is used for the buffers of copies and cleared buffers.
+        """
+        self._buffer_capacity = capacity
+        if self.processed_buffer is not None:
+            self.processed_buffer.maxlen = capacity
+        if isinstance(self._buffer, Buffer):
+            self._buffer.maxlen = capacity
+        else:
+            Logger.warning(
+                "Cannot resize a {0}, capacity will be used for new "
+                "buffers".format(type(self._buffer).__name__))
+
+    @property
+    def reads_shared_buffer(self) -> bool:
+        """ Whether the buffer is written by another client. """
+        return (isinstance(self._buffer, SharedBuffer) and
+                self._buffer.read_only)
+
+    def _empty_buffer(self) -> Union[Buffer, AlignedBuffer, SharedBuffer]:
+        """
+        Make a new empty buffer of the same type as the current buffer.
+
+        SharedBuffers are attached read-only instead, so that the new buffer
+        reads the data written by this client.
+        """
+        if isinstance(self._buffer, SharedBuffer):
+            return SharedBuffer.attach(self._buffer.name)
+        if isinstance(self._buffer, AlignedBuffer):
+            return AlignedBuffer(
+                maxlen=self.buffer_capacity,
+                sampling_rate=self._buffer.sampling_rate,
+                dtype=self._buffer.dtype)
+        return Buffer(traces=[], maxlen=self.buffer_capacity,
+                      gaps=self._buffer.gaps, dtype=self._buffer.dtype)
+
     def clear_buffer(self):
         """ Clear the current buffer. """
-        self._buffer = Buffer(traces=[], maxlen=self.buffer_capacity)
+        if isinstance(self._buffer, SharedBuffer):
+            self._buffer.clear()
+        else:
+            self._buffer = self._empty_buffer()
 
     @property
     def buffer_full(self) -> bool:
@@ -121,12 +220,73 @@ class _StreamingClient(ABC):
         ----------
         empty_buffer
             Whether to start the new client with an empty buffer or not.
+            Copies of Buffers share memory with this client's buffer until
+            either client writes to them.
         """
 
     def get_stream(self) -> Stream:
         """ Get a copy of the current data in buffer. """
         return self.buffer.stream
 
+    def get_snapshot(self) -> Stream:
+        """ Get a read-only view of the current data in buffer. """
+        return self.buffer.snapshot()
+
+    def read_since(self, cursor: dict = None, pad: float = 0.) -> tuple:
+        """
+        Get the data added to the buffer since a cursor.
+
+        See `Buffer.read_since` for details.
+        """
+        return self.buffer.read_since(cursor, pad=pad)
+
+    @property
+    def cursor(self) -> dict:
+        """
+        Cursor for the data in the buffer now, without reading them.
+
+        See `Buffer.cursor` for details.
+        """
+        return self.buffer.cursor
+
+    def checkpoint(self, path: str) -> None:
+        """
+        Save the data in the buffer to disk, see `Buffer.checkpoint`.
+
+        Parameters
+        ----------
+        path
+            Directory to write the checkpoint to.
+        """
+        buffer = self.buffer
+        if not isinstance(buffer, Buffer):
+            buffer = Buffer(traces=buffer.stream.traces,
+                            maxlen=self.buffer_capacity)
+        buffer.checkpoint(path)
+
+    def load_checkpoint(self, path: str) -> None:
+        """
+        Add the data from a checkpoint to the buffer.
+
+        An empty `Buffer` with the same gaps and dtype is replaced by the
+        checkpointed buffer, which reads from the checkpoint files until it
+        is written to, rather than copying the data.
+
+        Parameters
+        ----------
+        path
+            Directory of a checkpoint written by `checkpoint`.
+        """
+        checkpoint = Buffer.from_checkpoint(path, maxlen=self.buffer_capacity)
+        if (type(self._buffer) is Buffer and len(self._buffer) == 0 and
+                self._buffer.gaps == checkpoint.gaps and
+                self._buffer.dtype == checkpoint.dtype):
+            self._buffer = checkpoint
+        else:
+            self.buffer.add_stream(checkpoint.stream)
+        if self.processed_buffer is not None:
+            self.processed_buffer.add_stream(checkpoint.stream)
+
     def _bg_run(self):
         while self.busy:
             self.run()
@@ -137,6 +297,8 @@ class _StreamingClient(ABC):
         streaming_thread = threading.Thread(
             target=self._bg_run, name="StreamThread")
         streaming_thread.daemon = True
+        if self.clock is not None:
+            self.clock.attach(streaming_thread)
         streaming_thread.start()
         self.threads.append(streaming_thread)
         Logger.info("Started streaming")
@@ -146,27 +308,93 @@ class _StreamingClient(ABC):
         self.stop()
         for thread in self.threads:
             thread.join()
+        self.flush()
+        if self.archiver is not None:
+            self.archiver.stop()
+
+    @property
+    def archiving_stats(self) -> dict:
+        """
+        Summary of background archiving, or None if there is no archiver,
+        see `WaveBankArchiver.stats`.
+        """
+        if self.archiver is None:
+            return None
+        return self.archiver.stats()
 
-    def on_data(self, trace: Trace):
+    @property
+    def coalescing_stats(self) -> dict:
+        """
+        Summary of packet coalescing, or None if packets are not coalesced.
+
+        Latencies are the times in seconds that packets were held for before
+        being added to the buffer.
+        """
+        if self._coalescer is None:
+            return None
+        return self._coalescer.stats()
+
+    def flush(self) -> None:
+        """ Add any packets held for coalescing to the buffer. """
+        if self._coalescer is not None:
+            self._buffer_traces(self._coalescer.flush())
+
+    def _buffer_traces(self, traces: list) -> None:
+        """ Add traces to the buffer and wavebank. """
+        if len(traces) == 0:
+            return
+        st = Stream(traces)
+        self.buffer.add_stream(st)
+        if self.processed_buffer is not None:
+            self.processed_buffer.add_stream(st)
+        if self.wavebank is not None:
+            self._archive(st)
+
+    def _archive(self, st: Stream) -> None:
+        """ Save data to the wavebank, or queue them to the archiver. """
+        if self.archiver is not None:
+            self.archiver.put(st)
+        else:
+            self.wavebank.put_waveforms(stream=st)
+
+    def _arrival(self) -> float:
+        """ The time now as a UNIX timestamp, by the client's clock. """
+        if self.clock is None:
+            return time.time()
+        return self.clock.now().timestamp
+
+    def on_data(self, trace: Trace, record: bool = True,
+                arrival: float = None):
         """
         Handle incoming data
 
         Parameters
         ----------
         trace
-            New data.
+            New data. If packets are coalesced the trace may be changed
+            in-place.
+        record
+            Whether to count the data in `metrics`. Metrics are only
+            recorded from the streaming thread: data added from other
+            threads, e.g. back-filled data, should not be recorded.
+        arrival
+            Time the data arrived as a UNIX timestamp, used for the latency
+            in `metrics`. Defaults to now by the client's clock.
         """
-        logging.debug("Packet of {0} samples for {1}".format(
-            trace.stats.npts, trace.id))
-        self.buffer.add_stream(trace)
-        if self.wavebank is not None:
-            self.wavebank.put_waveforms(stream=Stream([trace]))
-        Logger.debug("Buffer contains {0}".format(self.buffer))
+        if record:
+            self.metrics.record(
+                trace, arrival=self._arrival() if arrival is None
+                else arrival)
+        if self._coalescer is None:
+            self._buffer_traces([trace])
+        else:
+            self._buffer_traces(self._coalescer.add(trace))
 
     def on_terminate(self) -> Stream:  # pragma: no cover
         """
         Handle termination gracefully
         """
+        self.flush()
         Logger.info("Termination of {0}".format(self.__repr__()))
         return self.buffer
 
@@ -178,6 +406,366 @@ class _StreamingClient(ABC):
         pass
 
 
+class AsyncStreamingClient(_StreamingClient):
+    """
+    Abstract Base Class for streaming clients run in an asyncio event loop.
+
+    Counterpart to `_StreamingClient` for clients that share one event loop
+    instead of running a thread each. `run` is a coroutine that should
+    await new data rather than block. `on_data` only adds data to memory:
+    writes to the wavebank are handed to one writer thread shared by all
+    asynchronous clients. `stop` is a coroutine that returns once the
+    client has stopped and its data have been written.
+
+    Parameters are as for `_StreamingClient`.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> from rt_eqcorrscan.streaming.buffers import Buffer
+    >>> class PacketClient(AsyncStreamingClient):
+    ...     def __init__(self, packets, **kwargs):
+    ...         super().__init__(**kwargs)
+    ...         self.packets = packets
+    ...     def start(self):
+    ...         self.started = True
+    ...     @property
+    ...     def can_add_streams(self):
+    ...         return False
+    ...     def copy(self, empty_buffer=True):
+    ...         return PacketClient(self.packets, buffer=self._empty_buffer())
+    ...     async def run(self):
+    ...         for packet in self.packets:
+    ...             self.on_data(packet)
+    ...             await self.sleep(0.01)
+    ...         await self.stop()
+    >>> async def stream_all(clients):
+    ...     for client in clients:
+    ...         client.background_run()
+    ...     await asyncio.gather(*[client.wait() for client in clients])
+    >>> clients = [PacketClient(read(), buffer=Buffer([], maxlen=30.))
+    ...            for _ in range(3)]
+    >>> asyncio.run(stream_all(clients))
+    >>> [len(client.buffer) for client in clients]
+    [3, 3, 3]
+    """
+    # Writes to wavebanks are kept in order by a single worker
+    _archive_executor = None
+    _archive_executor_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._stop_event = None
+        self._tasks = []
+        self._archiving = set()
+
+    @abstractmethod
+    async def run(self) -> None:
+        """ Stream data, calling `on_data` for each packet, until stopped. """
+
+    async def stop(self) -> None:
+        """
+        Stop streaming and wait for the client to finish.
+
+        Held packets are added to the buffer and pending writes to the
+        wavebank are completed before returning.
+        """
+        self.busy = False
+        self.started = False
+        if self._stop_event is not None:
+            self._stop_event.set()
+        current = asyncio.current_task()
+        tasks = [task for task in self._tasks if task is not current]
+        if len(tasks):
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = [task for task in self._tasks if task is current]
+        self.flush()
+        await self.wait_archived()
+
+    async def sleep(self, seconds: float) -> bool:
+        """
+        Wait without blocking the event loop, stopping early if the client
+        is stopped.
+
+        Parameters
+        ----------
+        seconds
+            Longest time to wait for.
+
+        Returns
+        -------
+        Whether the client has been stopped.
+        """
+        if self._stop_event is None:
+            self._stop_event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self._stop_event.is_set()
+
+    async def _bg_run(self):
+        while self.busy:
+            await self.run()
+
+    def background_run(self) -> asyncio.Task:
+        """
+        Run the client as a task in the running event loop.
+
+        Returns
+        -------
+        The task running the client.
+        """
+        self.busy = True
+        self._stop_event = asyncio.Event()
+        task = asyncio.get_running_loop().create_task(self._bg_run())
+        self._tasks.append(task)
+        Logger.info("Started streaming")
+        return task
+
+    async def background_stop(self):
+        """ Stop the client and wait for it to finish. """
+        await self.stop()
+
+    async def wait(self) -> None:
+        """ Wait for the client to stop streaming. """
+        tasks = [task for task in self._tasks
+                 if task is not asyncio.current_task()]
+        if len(tasks):
+            await asyncio.gather(*tasks)
+        await self.wait_archived()
+
+    async def wait_archived(self) -> None:
+        """ Wait for pending writes to the wavebank to finish. """
+        while len(self._archiving):
+            await asyncio.gather(*self._archiving, return_exceptions=True)
+        if self.archiver is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.archiver.stop)
+
+    def _archive(self, st: Stream) -> None:
+        """ Save data to the wavebank in the writer thread. """
+        if self.archiver is not None:
+            # Already written in the background
+            super()._archive(st)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not in the event loop, e.g. when back-filling
+            super()._archive(st)
+            return
+        with self._archive_executor_lock:
+            if AsyncStreamingClient._archive_executor is None:
+                AsyncStreamingClient._archive_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="WaveBankWriter")
+        future = loop.run_in_executor(
+            AsyncStreamingClient._archive_executor,
+            partial(self.wavebank.put_waveforms, stream=st))
+        self._archiving.add(future)
+        future.add_done_callback(self._archived)
+
+    def _archived(self, future: asyncio.Future) -> None:
+        self._archiving.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            Logger.error("Could not write to wavebank due to: {0}".format(
+                future.exception()))
+
+
+class _PendingPackets(object):
+    """ Contiguous packets held for one channel. """
+    __slots__ = ("arrivals", "sampling_rate", "start_ns", "npts", "packets")
+
+    def __init__(self, trace: Trace, arrival: float):
+        self.arrivals = [arrival]
+        self.sampling_rate = trace.stats.sampling_rate
+        self.start_ns = trace.stats.starttime.ns
+        self.npts = trace.stats.npts
+        self.packets = [trace]
+
+    @property
+    def next_ns(self) -> int:
+        """ Expected start of the next packet in integer nanoseconds. """
+        return self.start_ns + int(round(self.npts * 1e9 / self.sampling_rate))
+
+    @property
+    def arrival(self) -> float:
+        """ Arrival time of the oldest held packet. """
+        return self.arrivals[0]
+
+    def follows(self, trace: Trace) -> bool:
+        """ Whether a trace continues on from the held packets. """
+        return (trace.stats.sampling_rate == self.sampling_rate and
+                abs(trace.stats.starttime.ns - self.next_ns)
+                <= _TIME_TOLERANCE_NS)
+
+    def append(self, trace: Trace, arrival: float) -> None:
+        self.packets.append(trace)
+        self.arrivals.append(arrival)
+        self.npts += trace.stats.npts
+
+    def join(self) -> Trace:
+        """
+        Join the held packets into one trace.
+
+        The first packet is re-used for the joined data: making a new Trace
+        would cost more than the coalescing saves.
+        """
+        joined = self.packets[0]
+        if len(self.packets) == 1:
+            return joined
+        data = [tr.data for tr in self.packets]
+        if any(isinstance(d, np.ma.MaskedArray) for d in data):
+            joined.data = np.ma.concatenate(data)
+        else:
+            joined.data = np.concatenate(data)
+        return joined
+
+
+class _PacketCoalescer(object):
+    """
+    Join contiguous packets for each channel before they are buffered.
+
+    Packets for a channel are held until the oldest has been held for
+    `max_latency` seconds, `max_samples` samples are held, or a packet
+    arrives that does not follow on from the held packets. Held packets are
+    checked when new packets arrive. If `on_release` is given, a timer also
+    releases packets once they have been held for `max_latency`, so a
+    channel that stops sending data is not held until `flush`.
+
+    Parameters
+    ----------
+    max_latency
+        Longest time in seconds to hold a packet.
+    max_samples
+        Number of samples held for a channel that releases the channel.
+    on_release
+        Function called from the timer thread with the list of traces
+        released when `max_latency` passes without new packets.
+
+    Examples
+    --------
+    >>> from obspy import read
+    >>> tr = read()[0]
+    >>> coalescer = _PacketCoalescer(max_samples=3000)
+    >>> coalescer.add(tr.slice(tr.stats.starttime, tr.stats.starttime + 9.99))
+    []
+    >>> print(coalescer.add(tr.slice(tr.stats.starttime + 10))[0])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:32.990000Z
+    | 100.0 Hz, 3000 samples
+    """
+    def __init__(self, max_latency: float = None, max_samples: int = None,
+                 on_release=None):
+        self.max_latency = max_latency
+        self.max_samples = max_samples
+        self.on_release = on_release
+        # Keyed by seed id, in the order that the channels started being held
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._timer = None
+        self.packets = 0
+        self.flushes = 0
+        self.total_hold = 0.
+        self.max_hold = 0.
+
+    def _release(self, seed_id: str, now: float) -> Trace:
+        pending = self._pending.pop(seed_id)
+        hold = now - pending.arrival
+        self.flushes += 1
+        self.total_hold += sum(now - arrival for arrival in pending.arrivals)
+        self.max_hold = max(self.max_hold, hold)
+        return pending.join()
+
+    def _release_expired(self, now: float) -> list:
+        """ Release channels held for max_latency - call with the lock. """
+        released = []
+        # The oldest held channels are first
+        while self._pending:
+            seed_id, pending = next(iter(self._pending.items()))
+            if now - pending.arrival < self.max_latency:
+                break
+            released.append(self._release(seed_id, now))
+        return released
+
+    def _schedule(self, now: float) -> None:
+        """ Time the release of the oldest channel - call with the lock. """
+        if (self.on_release is None or self.max_latency is None or
+                self._timer is not None or not self._pending):
+            return
+        oldest = next(iter(self._pending.values()))
+        self._timer = threading.Timer(
+            max(0., oldest.arrival + self.max_latency - now), self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self) -> None:
+        """ Release channels that have been held too long. """
+        now = time.monotonic()
+        with self._lock:
+            self._timer = None
+            released = self._release_expired(now)
+            self._schedule(now)
+        if len(released):
+            self.on_release(released)
+
+    def add(self, trace: Trace) -> list:
+        """
+        Hold a packet.
+
+        Parameters
+        ----------
+        trace
+            New packet.
+
+        Returns
+        -------
+        List of traces released, ready to be buffered.
+        """
+        now = time.monotonic()
+        released = []
+        with self._lock:
+            self.packets += 1
+            seed_id = trace.id
+            pending = self._pending.get(seed_id)
+            if pending is not None and not pending.follows(trace):
+                released.append(self._release(seed_id, now))
+                pending = None
+            if pending is None:
+                pending = _PendingPackets(trace, arrival=now)
+                self._pending[seed_id] = pending
+            else:
+                pending.append(trace, arrival=now)
+            if self.max_samples is not None and (
+                    pending.npts >= self.max_samples):
+                released.append(self._release(seed_id, now))
+            if self.max_latency is not None:
+                released.extend(self._release_expired(now))
+                self._schedule(now)
+        return released
+
+    def flush(self) -> list:
+        """ Release all held packets. """
+        now = time.monotonic()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return [self._release(seed_id, now)
+                    for seed_id in list(self._pending.keys())]
+
+    def stats(self) -> dict:
+        """ Summary of the packets coalesced so far. """
+        with self._lock:
+            released = self.packets - sum(
+                len(pending.packets) for pending in self._pending.values())
+            return {
+                "packets": self.packets, "flushes": self.flushes,
+                "held": self.packets - released,
+                "mean_latency": self.total_hold / max(released, 1),
+                "max_latency": self.max_hold}
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -6,14 +6,15 @@ import unittest
 import os
 import shutil
 import glob
+import numpy as np
 
-from eqcorrscan import Tribe, Party
+from eqcorrscan import Tribe, Template, Party
 from eqcorrscan.utils import catalog_utils
-from obspy import UTCDateTime
+from obspy import Stream, Trace, UTCDateTime, read
 from obspy.clients.fdsn import Client
 
-from rt_eqcorrscan.rt_match_filter import RealTimeTribe
-from rt_eqcorrscan.streaming import RealTimeClient
+from rt_eqcorrscan.rt_match_filter import RealTimeTribe, _data_length
+from rt_eqcorrscan.streaming import RealTimeClient, Buffer
 from rt_eqcorrscan.reactor import get_inventory
 
 
@@ -103,6 +104,151 @@ class RealTimeTribeTest(unittest.TestCase):
             shutil.rmtree(cls.detect_dir)
 
 
+class DataLengthTest(unittest.TestCase):
+    def test_channel_stopped_in_window(self):
+        """ Only data in the detection window count. """
+        starttime = UTCDateTime(2020, 1, 1)
+        buffer = Buffer(traces=[], maxlen=600.)
+        for station, length in (("LIVE", 600), ("DEAD", 350)):
+            buffer.add_stream(Trace(
+                data=np.ones(length * 10), header=dict(
+                    network="XX", station=station, channel="HHZ",
+                    sampling_rate=10., starttime=starttime)))
+        # Keep the dead channel in the buffer to the live channel's end
+        buffer.add_stream(Trace(
+            data=np.ma.masked_all(1), header=dict(
+                network="XX", station="DEAD", channel="HHZ",
+                sampling_rate=10., starttime=starttime + 599.9)))
+        st = buffer.stream.trim(starttime + 300, starttime + 599.9)
+        lengths = {tr.stats.station: _data_length(tr) for tr in st}
+        self.assertEqual(buffer.select(id="XX.DEAD..HHZ")[0].data_len, 350.)
+        self.assertAlmostEqual(lengths["LIVE"], 300.)
+        self.assertAlmostEqual(lengths["DEAD"], 50.)
+
+
+class _BulkClient(object):
+    """ Back-fill client that serves slices of a stream. """
+    def __init__(self, st):
+        self.st = st
+
+    def get_waveforms_bulk(self, bulk):
+        st = Stream()
+        for network, station, location, channel, starttime, endtime in bulk:
+            st += self.st.select(
+                network=network, station=station, location=location,
+                channel=channel).slice(starttime, endtime).copy()
+        return st
+
+
+class BackfillTest(unittest.TestCase):
+    def test_backfill_not_recorded(self):
+        """ Back-filled data are not counted as late live packets. """
+        st = read()
+        starttime = st[0].stats.starttime
+        tribe = Tribe([Template(
+            name="rjob", st=st.slice(starttime + 5, starttime + 7).copy(),
+            process_length=10, lowcut=2., highcut=10., filt_order=4,
+            samp_rate=100., prepick=0.1)])
+        rt_client = RealTimeClient(
+            server_url="localhost", buffer_capacity=30.)
+        rt_tribe = RealTimeTribe(
+            tribe=tribe, rt_client=rt_client, detect_interval=10.,
+            plot=False)
+        for tr in st.slice(starttime + 20):
+            rt_client.on_data(tr)
+        metrics = rt_client.metrics.to_dict()
+        # Fill from the end of a checkpoint to the live data
+        rt_tribe._backfill(_BulkClient(st), checkpoint_ends={
+            tr.id: starttime for tr in st})
+        self.assertEqual(rt_client.metrics.to_dict(), metrics)
+        for tr in rt_client.buffer:
+            self.assertEqual(tr.stats.endtime, st[0].stats.endtime)
+            self.assertAlmostEqual(tr.data_len, 30.)
+
+
+class ProcessedBufferTest(unittest.TestCase):
+    def test_int_raw_buffer_processed_as_float(self):
+        """ Filtered data are not quantised to the raw storage type. """
+        tribe = Tribe([Template(
+            name="a", process_length=30, lowcut=2., highcut=10.,
+            filt_order=4, samp_rate=50.)])
+        for dtype, expected in ((np.int32, np.float64),
+                                (np.float32, np.float32)):
+            rt_client = RealTimeClient(
+                server_url="localhost", buffer=Buffer(
+                    traces=[], maxlen=30., dtype=dtype),
+                buffer_capacity=30.)
+            rt_tribe = RealTimeTribe(
+                tribe=tribe, rt_client=rt_client, detect_interval=10.,
+                plot=False)
+            processed = rt_tribe._processed_buffer()
+            processed.add_stream(read())
+            processed.flush()
+            for tr in processed.stream:
+                self.assertEqual(tr.data.dtype, expected)
+
+    def test_unsupported_rate_falls_back(self):
+        """ Channels that cannot be processed are not missed out. """
+        tribe = Tribe([Template(
+            name="a", process_length=30, lowcut=2., highcut=10.,
+            filt_order=4, samp_rate=40.)])
+        rt_client = RealTimeClient(
+            server_url="localhost", buffer_capacity=30.)
+        rt_tribe = RealTimeTribe(
+            tribe=tribe, rt_client=rt_client, detect_interval=10.,
+            plot=False)
+        processed_buffer = rt_tribe._processed_buffer()
+        rt_client.processed_buffer = processed_buffer
+        kwargs = dict(pre_processed=True)
+        self.assertIs(rt_tribe._check_processed_buffer(
+            processed_buffer, kwargs), processed_buffer)
+        # 100 Hz is not a multiple of 40 Hz
+        rt_client.on_data(read()[0])
+        self.assertIsNone(rt_tribe._check_processed_buffer(
+            processed_buffer, kwargs))
+        self.assertIsNone(rt_client.processed_buffer)
+        self.assertNotIn("pre_processed", kwargs)
+
+    def test_detections_match(self):
+        """ Detections are close to those from processing the window. """
+        st = read()
+        processed = st.copy().detrend().filter(
+            "bandpass", freqmin=2., freqmax=10., corners=4, zerophase=True)
+        processed.resample(50.)
+        peak = processed[0].stats.starttime + (
+            np.abs(processed[0].data).argmax() / 50.)
+        tribe = Tribe([Template(
+            name="rjob", st=processed.slice(peak - 1., peak + 1.),
+            lowcut=2., highcut=10., filt_order=4, samp_rate=50.,
+            process_length=30, prepick=0.1)])
+        rt_client = RealTimeClient(
+            server_url="localhost", buffer_capacity=30.)
+        rt_tribe = RealTimeTribe(
+            tribe=tribe, rt_client=rt_client, detect_interval=10.,
+            plot=False)
+        processed_buffer = rt_tribe._processed_buffer()
+        starttime = st[0].stats.starttime
+        for second in range(30):
+            processed_buffer.add_stream(st.slice(
+                starttime + second, starttime + second + 0.99))
+        processed_buffer.flush()
+        detections = []
+        for stream, pre_processed in ((st, False),
+                                      (processed_buffer.stream, True)):
+            party = tribe.detect(
+                stream=stream.copy(), threshold=1.5, threshold_type="absolute",
+                trig_int=1., plot=False, parallel_process=False,
+                pre_processed=pre_processed)
+            detections.append(max(
+                (d for family in party for d in family),
+                key=lambda d: d.detect_val))
+        window, incremental = detections
+        self.assertLessEqual(
+            abs(incremental.detect_time - window.detect_time), 1 / 50.)
+        self.assertLess(abs(incremental.detect_val - window.detect_val),
+                        .05 * abs(window.detect_val))
+
+
 if __name__ == "__main__":
     import logging
 
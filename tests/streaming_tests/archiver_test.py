@@ -0,0 +1,128 @@
+"""
+Tests for background archiving to a WaveBank.
+"""
+
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+
+from obspy import read
+from obsplus import WaveBank
+
+from rt_eqcorrscan.streaming.archiver import WaveBankArchiver
+
+
+class _SlowBank(object):
+    """ Bank that does not write until released. """
+    def __init__(self, fail=False):
+        self.released = threading.Event()
+        self.fail = fail
+        self.written = []
+
+    def put_waveforms(self, stream):
+        self.released.wait()
+        if self.fail:
+            raise IOError("Disk full")
+        self.written.append(stream)
+
+
+class WaveBankArchiverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def packets(self):
+        """ One second packets, interleaving the channels. """
+        starttime = self.st[0].stats.starttime
+        packets = []
+        for second in range(30):
+            packets.extend(self.st.slice(
+                starttime + second, starttime + second + 0.99).copy())
+        return packets
+
+    def assertArchived(self, bank):
+        archived = bank.get_waveforms().merge()
+        self.assertEqual(len(archived), 3)
+        for tr, tr_original in zip(archived.sort(), self.st.copy().sort()):
+            self.assertEqual(tr.stats.starttime, tr_original.stats.starttime)
+            self.assertTrue(np.array_equal(tr.data, tr_original.data))
+
+    def test_flush_on_size(self):
+        with tempfile.TemporaryDirectory() as path:
+            archiver = WaveBankArchiver(
+                WaveBank(path), flush_samples=1000, flush_interval=600.)
+            for packet in self.packets():
+                archiver.put([packet])
+            archiver.flush()
+            stats = archiver.stats()
+            self.assertArchived(archiver.wavebank)
+            archiver.stop()
+        # Written when a channel has ten packets and when flushed
+        self.assertGreaterEqual(stats["flushes"], 3)
+        self.assertLessEqual(stats["flushes"], 4)
+        self.assertEqual(stats["written"], 90)
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["held"], 0)
+
+    def test_flush_on_time(self):
+        with tempfile.TemporaryDirectory() as path:
+            archiver = WaveBankArchiver(WaveBank(path), flush_interval=0.2)
+            for packet in self.packets():
+                archiver.put([packet])
+            # Written without being asked
+            tic = time.monotonic()
+            while (archiver.stats()["written"] < 90 and
+                   time.monotonic() - tic < 30.):
+                time.sleep(0.05)
+            self.assertEqual(archiver.stats()["written"], 90)
+            self.assertArchived(archiver.wavebank)
+            archiver.stop()
+        self.assertFalse(archiver.running)
+
+    def test_full_queue_drops(self):
+        bank = _SlowBank()
+        archiver = WaveBankArchiver(bank, max_queue=5, flush_samples=1)
+        packets = self.packets()[0:20]
+        tic = time.perf_counter()
+        for packet in packets:
+            archiver.put([packet])
+        # Putting does not wait for the writer
+        self.assertLess(time.perf_counter() - tic, 1.)
+        stats = archiver.stats()
+        self.assertLessEqual(stats["depth"], 5)
+        self.assertLessEqual(stats["max_depth"], 5)
+        self.assertGreaterEqual(stats["dropped"], 14)
+        bank.released.set()
+        archiver.stop()
+        stats = archiver.stats()
+        self.assertEqual(stats["written"] + stats["dropped"], 20)
+        self.assertEqual(stats["written"], stats["queued"])
+
+    def test_write_errors(self):
+        bank = _SlowBank(fail=True)
+        bank.released.set()
+        archiver = WaveBankArchiver(bank, flush_samples=1)
+        archiver.put(self.st.copy())
+        archiver.stop()
+        stats = archiver.stats()
+        self.assertEqual(stats["errors"], 3)
+        self.assertEqual(stats["written"], 0)
+
+    def test_restart(self):
+        with tempfile.TemporaryDirectory() as path:
+            archiver = WaveBankArchiver(WaveBank(path))
+            packets = self.packets()
+            for packet in packets[0:45]:
+                archiver.put([packet])
+            archiver.stop()
+            for packet in packets[45:]:
+                archiver.put([packet])
+            archiver.stop()
+            self.assertArchived(archiver.wavebank)
+        self.assertEqual(archiver.stats()["flushes"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
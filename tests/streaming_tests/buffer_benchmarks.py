@@ -0,0 +1,611 @@
+"""
+Benchmarks for RT_EQcorrscan's buffer implementation.
+
+These are not run as part of the test-suite, run them directly with:
+    python tests/streaming_tests/buffer_benchmarks.py
+"""
+
+import time
+import timeit
+import tracemalloc
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+
+from rt_eqcorrscan.streaming.buffers import NumpyDeque, TraceBuffer, Buffer
+from rt_eqcorrscan.streaming.processing import ProcessedBuffer
+from rt_eqcorrscan.streaming.streaming import _StreamingClient
+
+
+class _BenchClient(_StreamingClient):
+    """ Client that is fed packets directly. """
+    def start(self) -> None:
+        self.started = True
+
+    def stop(self) -> None:
+        self.busy = False
+
+    @property
+    def can_add_streams(self) -> bool:
+        return True
+
+    def copy(self, empty_buffer: bool = True):
+        raise NotImplementedError
+
+
+def bench_insert(
+    masked: bool,
+    maxlen: int = 60000,
+    insert_length: int = 6000,
+    repeat: int = 200,
+) -> float:
+    """
+    Time inserting data into a NumpyDeque.
+
+    Parameters
+    ----------
+    masked
+        Whether to insert a masked array (with every tenth sample masked) or
+        a plain numpy array.
+    maxlen
+        Length of the deque in samples.
+    insert_length
+        Number of samples inserted on each call.
+    repeat
+        Number of inserts to time.
+
+    Returns
+    -------
+    Insert throughput in samples per second.
+    """
+    deque = NumpyDeque(np.random.randn(maxlen), maxlen=maxlen)
+    # Move the head so that inserts cross the end of the storage
+    deque.extend(np.random.randn(maxlen // 3))
+    other = np.random.randn(insert_length)
+    if masked:
+        mask = np.zeros(insert_length, dtype=bool)
+        mask[::10] = True
+        other = np.ma.masked_array(other, mask=mask)
+    index = maxlen - (maxlen // 3) - (insert_length // 2)
+    run_time = timeit.timeit(
+        lambda: deque.insert(other, index), number=repeat)
+    return (insert_length * repeat) / run_time
+
+
+def bench_add_trace(
+    packet_length: int = 512,
+    maxlen: int = 60000,
+    sampling_rate: float = 100.,
+    repeat: int = 2000,
+    gaps: str = "mask",
+) -> float:
+    """
+    Time adding consecutive packets to a TraceBuffer.
+
+    Parameters
+    ----------
+    packet_length
+        Length of each packet in samples.
+    maxlen
+        Length of the buffer in samples.
+    sampling_rate
+        Sampling-rate in Hz.
+    repeat
+        Number of packets to add.
+    gaps
+        How the buffer keeps track of gaps, see `NumpyDeque`.
+
+    Returns
+    -------
+    Mean seconds per packet.
+    """
+    endtime = UTCDateTime(2020, 1, 1)
+    trace_buffer = TraceBuffer(
+        data=np.random.randn(maxlen), maxlen=maxlen, header=dict(
+            station="S001", sampling_rate=sampling_rate, endtime=endtime),
+        gaps=gaps)
+    packets = []
+    for i in range(repeat):
+        packets.append(Trace(data=np.random.randn(packet_length), header=dict(
+            station="S001", sampling_rate=sampling_rate,
+            starttime=endtime + (1 + i * packet_length) / sampling_rate)))
+    tic = timeit.default_timer()
+    for packet in packets:
+        trace_buffer.add_trace(packet)
+    return (timeit.default_timer() - tic) / repeat
+
+
+def bench_add_trace_cases(
+    packet_length: int = 512,
+    maxlen: int = 60000,
+    sampling_rate: float = 100.,
+    repeat: int = 2000,
+) -> dict:
+    """
+    Time adding packets to a TraceBuffer for each way a packet can line up
+    with the buffer.
+
+    Cases are: contiguous packets (starting one sample after the buffer
+    ends), packets that overlap the end of the buffer by half a packet,
+    packets after a gap of half a packet, packets of old data inside the
+    buffer, and packets longer than the buffer that overlap its end.
+
+    Parameters
+    ----------
+    packet_length
+        Length of each packet in samples.
+    maxlen
+        Length of the buffer in samples.
+    sampling_rate
+        Sampling-rate in Hz.
+    repeat
+        Number of packets to add for each case.
+
+    Returns
+    -------
+    Dictionary of mean seconds per packet keyed by case.
+    """
+    delta = 1. / sampling_rate
+    # Offset in samples of each packet from the end of the buffer
+    steps = {
+        "contiguous": lambda length: 1,
+        "overlap": lambda length: 1 - length // 2,
+        "gap": lambda length: 1 + length // 2,
+        "old data": lambda length: -maxlen // 2,
+        "longer than maxlen": lambda length: 1 - length // 2,
+    }
+    results = dict()
+    for case, step in steps.items():
+        length = packet_length
+        if case == "longer than maxlen":
+            length = maxlen + packet_length
+            repeat_case = max(1, repeat // 100)
+        else:
+            repeat_case = repeat
+        endtime = UTCDateTime(2020, 1, 1)
+        trace_buffer = TraceBuffer(
+            data=np.random.randn(maxlen), maxlen=maxlen, header=dict(
+                station="S001", sampling_rate=sampling_rate,
+                endtime=endtime))
+        packets, end = [], 0
+        for _ in range(repeat_case):
+            start = end + step(length)
+            packets.append(Trace(data=np.random.randn(length), header=dict(
+                station="S001", sampling_rate=sampling_rate,
+                starttime=endtime + start * delta)))
+            if case != "old data":
+                end = start + length - 1
+        tic = timeit.default_timer()
+        for packet in packets:
+            trace_buffer.add_trace(packet)
+        results[case] = (timeit.default_timer() - tic) / repeat_case
+    return results
+
+
+def bench_memory(
+    buffer_length: float = 600.,
+    sampling_rate: float = 100.,
+    dtype=None,
+    gaps: str = "mask",
+) -> int:
+    """
+    Memory used to buffer one full channel.
+
+    Parameters
+    ----------
+    buffer_length
+        Buffer length in seconds.
+    sampling_rate
+        Sampling-rate in Hz.
+    dtype
+        Data-type to store data as, data are generated as float64.
+    gaps
+        How the buffer keeps track of gaps, see `NumpyDeque`.
+
+    Returns
+    -------
+    Bytes per channel.
+    """
+    npts = int(buffer_length * sampling_rate)
+    tr = Trace(data=np.random.randn(npts), header=dict(
+        station="S001", sampling_rate=sampling_rate))
+    buffer = Buffer([tr], maxlen=buffer_length, gaps=gaps, dtype=dtype)
+    return buffer.bytes_per_channel()[tr.id]
+
+
+def bench_snapshot_churn(
+    n_channels: int = 300,
+    buffer_length: float = 600.,
+    sampling_rate: float = 100.,
+    packet_length: int = 512,
+    window: float = 300.,
+    n_reads: int = 5,
+) -> dict:
+    """
+    Measure the memory allocated reading a Buffer in a detection loop.
+
+    Each iteration adds a packet to every channel, then reads the buffer and
+    trims the read to the detection window, as `RealTimeTribe.run` does.
+    The read is kept until the next iteration: "released" drops it just
+    before the next read, as `RealTimeTribe.run` does, "held" only drops it
+    once the next read has been made.
+
+    Parameters
+    ----------
+    n_channels
+        Number of channels in the buffer.
+    buffer_length
+        Buffer length in seconds.
+    sampling_rate
+        Sampling-rate of all channels in Hz.
+    packet_length
+        Length of the packet added to each channel in samples.
+    window
+        Length of the detection window in seconds.
+    n_reads
+        Number of iterations to measure, after a first read.
+
+    Returns
+    -------
+    Dictionary of mean peak bytes allocated per iteration keyed by read
+    method and "released" or "held".
+    """
+    npts = int(buffer_length * sampling_rate)
+    endtime = UTCDateTime(2020, 1, 1)
+    results = dict()
+    for method in ("stream", "snapshot"):
+        for pattern in ("released", "held"):
+            traces = [Trace(data=np.random.randn(npts), header=dict(
+                station="S{0:03d}".format(i), sampling_rate=sampling_rate,
+                starttime=endtime - ((npts - 1) / sampling_rate)))
+                for i in range(n_channels)]
+            buffer = Buffer(traces, maxlen=buffer_length)
+
+            def read():
+                st = buffer.stream if method == "stream" else buffer.snapshot()
+                last_data = max(tr.stats.endtime for tr in st)
+                return st.trim(starttime=last_data - window, endtime=last_data)
+
+            # Reads in use, only the last is kept between iterations
+            reads, peaks = [read()], []
+            for _ in range(n_reads):
+                for tr in traces:
+                    tr.stats.starttime = tr.stats.endtime + tr.stats.delta
+                    tr.data = np.random.randn(packet_length)
+                buffer.add_stream(traces)
+                tracemalloc.start()
+                if pattern == "released":
+                    # As RealTimeTribe.run does before reading
+                    reads.clear()
+                reads.append(read())
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                del reads[:-1]
+            results[(method, pattern)] = sum(peaks) / n_reads
+    return results
+
+
+def bench_resize(
+    n_channels: int = 300,
+    buffer_length: float = 600.,
+    sampling_rate: float = 100.,
+) -> dict:
+    """
+    Measure the time and peak memory allocated to change Buffer.maxlen.
+
+    The buffer is shrunk by half then grown back to its original length.
+
+    Parameters
+    ----------
+    n_channels
+        Number of channels in the buffer.
+    buffer_length
+        Buffer length in seconds.
+    sampling_rate
+        Sampling-rate of all channels in Hz.
+
+    Returns
+    -------
+    Dictionary of (seconds, peak bytes allocated) keyed by "shrink" and
+    "grow".
+    """
+    npts = int(buffer_length * sampling_rate)
+    buffer = Buffer([Trace(data=np.random.randn(npts), header=dict(
+        station="S{0:03d}".format(i), sampling_rate=sampling_rate))
+        for i in range(n_channels)], maxlen=buffer_length)
+    results = dict()
+    for name, maxlen in (("shrink", buffer_length / 2),
+                         ("grow", buffer_length)):
+        tracemalloc.start()
+        tic = time.perf_counter()
+        buffer.maxlen = maxlen
+        toc = time.perf_counter()
+        results[name] = (toc - tic, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return results
+
+
+def bench_copy(
+    n_channels: int = 300,
+    buffer_length: float = 600.,
+    sampling_rate: float = 100.,
+) -> dict:
+    """
+    Measure the time and peak memory allocated to copy a Buffer, and to
+    then add a packet to every channel of the copy.
+
+    Parameters
+    ----------
+    n_channels
+        Number of channels in the buffer.
+    buffer_length
+        Buffer length in seconds.
+    sampling_rate
+        Sampling-rate of all channels in Hz.
+
+    Returns
+    -------
+    Dictionary of (seconds, peak bytes allocated by that step) keyed by
+    "copy" and "first write".
+    """
+    npts = int(buffer_length * sampling_rate)
+    traces = [Trace(data=np.random.randn(npts), header=dict(
+        station="S{0:03d}".format(i), sampling_rate=sampling_rate))
+        for i in range(n_channels)]
+    buffer = Buffer(traces, maxlen=buffer_length)
+    packets = Stream([Trace(data=np.random.randn(100), header=dict(
+        station=tr.stats.station, sampling_rate=sampling_rate,
+        starttime=tr.stats.endtime + tr.stats.delta)) for tr in traces])
+    results = dict()
+    tracemalloc.start()
+    tic = time.perf_counter()
+    buffer_copy = buffer.copy()
+    toc = time.perf_counter()
+    results["copy"] = (toc - tic, tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    tic = time.perf_counter()
+    buffer_copy.add_stream(packets)
+    toc = time.perf_counter()
+    results["first write"] = (
+        toc - tic, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return results
+
+
+def bench_read_since(
+    n_channels: int = 50,
+    buffer_length: float = 3600.,
+    sampling_rate: float = 100.,
+    packet_length: int = 512,
+    repeat: int = 20,
+) -> dict:
+    """
+    Time reading new data from a Buffer after each packet, and checking
+    for new data by comparing cursors.
+
+    Parameters
+    ----------
+    n_channels
+        Number of channels in the buffer.
+    buffer_length
+        Buffer length in seconds.
+    sampling_rate
+        Sampling-rate of all channels in Hz.
+    packet_length
+        Length of the packet added to each channel in samples.
+    repeat
+        Number of packets and reads to time.
+
+    Returns
+    -------
+    Dictionary of mean seconds per read keyed by read method.
+    """
+    npts = int(buffer_length * sampling_rate)
+    endtime = UTCDateTime(2020, 1, 1)
+    traces = [Trace(data=np.random.randn(npts), header=dict(
+        station="S{0:03d}".format(i), sampling_rate=sampling_rate,
+        starttime=endtime - ((npts - 1) / sampling_rate)))
+        for i in range(n_channels)]
+    buffer = Buffer(traces, maxlen=buffer_length)
+    _, cursor = buffer.read_since()
+    run_times = {"stream": 0., "read_since": 0., "cursor": 0.}
+    for _ in range(repeat):
+        for tr in traces:
+            tr.stats.starttime = tr.stats.endtime + tr.stats.delta
+            tr.data = np.random.randn(packet_length)
+        buffer.add_stream(traces)
+        tic = timeit.default_timer()
+        buffer.stream
+        run_times["stream"] += timeit.default_timer() - tic
+        tic = timeit.default_timer()
+        _, cursor = buffer.read_since(cursor)
+        run_times["read_since"] += timeit.default_timer() - tic
+        tic = timeit.default_timer()
+        buffer.cursor == cursor
+        run_times["cursor"] += timeit.default_timer() - tic
+    return {key: value / repeat for key, value in run_times.items()}
+
+
+def bench_coalesce(
+    coalesce_latency: float = None,
+    coalesce_samples: int = None,
+    n_channels: int = 30,
+    packet_length: int = 512,
+    sampling_rate: float = 100.,
+    n_packets: int = 2000,
+    speed_up: float = 200.,
+) -> dict:
+    """
+    Time handling packets with and without coalescing.
+
+    Packets arrive in turn for each channel, paced to arrive `speed_up`
+    times faster than real-time so that the latency budget comes into play.
+
+    Parameters
+    ----------
+    coalesce_latency
+        See `_StreamingClient`.
+    coalesce_samples
+        See `_StreamingClient`.
+    n_channels
+        Number of channels.
+    packet_length
+        Length of each packet in samples.
+    sampling_rate
+        Sampling-rate of all channels in Hz.
+    n_packets
+        Number of packets to time.
+    speed_up
+        How many times faster than real-time the packets arrive.
+
+    Returns
+    -------
+    Dictionary of mean seconds spent handling each packet, and the mean and
+    maximum seconds that packets were held for.
+    """
+    client = _BenchClient(
+        buffer_capacity=600., coalesce_latency=coalesce_latency,
+        coalesce_samples=coalesce_samples)
+    starttime = UTCDateTime(2020, 1, 1)
+    packets = []
+    for i in range(n_packets):
+        channel, packet = i % n_channels, i // n_channels
+        packets.append(Trace(data=np.random.randn(packet_length), header=dict(
+            station="S{0:03d}".format(channel), sampling_rate=sampling_rate,
+            starttime=starttime + packet * packet_length / sampling_rate)))
+    interval = packet_length / (sampling_rate * n_channels * speed_up)
+    run_time, next_arrival = 0., time.perf_counter()
+    for packet in packets:
+        while time.perf_counter() < next_arrival:
+            pass
+        next_arrival += interval
+        tic = time.perf_counter()
+        client.on_data(packet)
+        run_time += time.perf_counter() - tic
+    tic = time.perf_counter()
+    client.flush()
+    run_time += time.perf_counter() - tic
+    stats = client.coalescing_stats or dict(mean_latency=0., max_latency=0.)
+    return {"per_packet": run_time / n_packets,
+            "mean_latency": stats["mean_latency"],
+            "max_latency": stats["max_latency"]}
+
+
+def bench_processing(
+    n_channels: int = 30,
+    window: float = 300.,
+    detect_interval: float = 60.,
+    sampling_rate: float = 100.,
+    packet_length: int = 100,
+) -> dict:
+    """
+    Measure the CPU time to process data for one detection iteration.
+
+    Processing the whole window for each detection (detrend, resample to
+    half the sampling-rate and zero-phase bandpass, as EQcorrscan does) is
+    compared with processing the packets that arrived since the last
+    detection into a ProcessedBuffer and reading the window from it.
+
+    Parameters
+    ----------
+    n_channels
+        Number of channels.
+    window
+        Length of data used for detection in seconds.
+    detect_interval
+        Seconds between detections.
+    sampling_rate
+        Sampling-rate of the raw data in Hz.
+    packet_length
+        Packet length in samples.
+
+    Returns
+    -------
+    Dictionary of CPU seconds per detection keyed by "window" and
+    "incremental".
+    """
+    npts = int(window * sampling_rate)
+    traces = [Trace(data=np.random.randn(npts), header=dict(
+        station="S{0:03d}".format(i), sampling_rate=sampling_rate))
+        for i in range(n_channels)]
+    st = Stream(traces)
+    tic = time.process_time()
+    processed = st.copy().detrend("simple").resample(sampling_rate / 2)
+    processed.filter("bandpass", freqmin=2., freqmax=10., corners=4,
+                     zerophase=True)
+    window_time = time.process_time() - tic
+    buffer = ProcessedBuffer(maxlen=window, lowcut=2., highcut=10.,
+                             filt_order=4, samp_rate=sampling_rate / 2)
+    buffer.add_stream(st)
+    packets = []
+    for start in range(0, int(detect_interval * sampling_rate),
+                       packet_length):
+        for tr in traces:
+            packet = tr.copy()
+            packet.stats.starttime = tr.stats.starttime + (
+                (npts + start) / sampling_rate)
+            packet.data = np.random.randn(packet_length)
+            packets.append(packet)
+    tic = time.process_time()
+    for packet in packets:
+        buffer.add_stream(packet)
+    buffer.snapshot().merge()
+    incremental_time = time.process_time() - tic
+    return {"window": window_time, "incremental": incremental_time}
+
+
+def main():
+    unmasked = bench_insert(masked=False)
+    masked = bench_insert(masked=True)
+    print("NumpyDeque.insert throughput:")
+    print("\tUnmasked: {0:.3e} samples/s".format(unmasked))
+    print("\tMasked: {0:.3e} samples/s ({1:.1f}x slower)".format(
+        masked, unmasked / masked))
+    print("TraceBuffer.add_trace per 512 sample packet:")
+    for gaps in ("mask", "intervals"):
+        print("\tgaps={0}: {1:.1f} us".format(
+            gaps, bench_add_trace(gaps=gaps) * 1e6))
+    print("TraceBuffer.add_trace per 512 sample packet by case:")
+    for case, run_time in bench_add_trace_cases().items():
+        print("\t{0}: {1:.1f} us".format(case, run_time * 1e6))
+    print("Memory per channel for a 600 s, 100 Hz buffer:")
+    for dtype, gaps in (("float64", "mask"), ("float32", "mask"),
+                        ("float32", "intervals"), ("int32", "intervals")):
+        print("\t{0}, gaps={1}: {2:.2f} MB".format(
+            dtype, gaps, bench_memory(dtype=dtype, gaps=gaps) / 1e6))
+    churn = bench_snapshot_churn()
+    print("Peak memory allocated per detection loop read of a 300 channel, "
+          "600s buffer:")
+    for (method, pattern), peak in churn.items():
+        print("\tBuffer.{0} (previous read {1}): {2:.1f} MB".format(
+            method, pattern, peak / 1e6))
+    reads = bench_read_since()
+    print("Time to read new data from a 50 channel, 3600s buffer:")
+    for method, run_time in reads.items():
+        print("\tBuffer.{0}: {1:.2e} s".format(method, run_time))
+    print("Changing maxlen of a 300 channel, 600s buffer:")
+    for name, (run_time, peak) in bench_resize().items():
+        print("\t{0}: {1:.3f} s, {2:.1f} MB peak".format(
+            name, run_time, peak / 1e6))
+    print("Copying a 300 channel, 600s buffer:")
+    for name, (run_time, peak) in bench_copy().items():
+        print("\t{0}: {1:.3f} s, {2:.1f} MB peak".format(
+            name, run_time, peak / 1e6))
+    print("Processing CPU time per detection for 30 channels, 300s window "
+          "every 60s:")
+    for name, run_time in bench_processing().items():
+        print("\t{0}: {1:.3f} s".format(name, run_time))
+    print("Packet handling for 30 channels at 200x real-time:")
+    for latency, samples in ((None, None), (0.025, None), (0.1, None),
+                             (None, 4096)):
+        result = bench_coalesce(
+            coalesce_latency=latency, coalesce_samples=samples)
+        print("\tlatency={0}, samples={1}: {2:.1f} us per packet, "
+              "held for {3:.3f} s mean, {4:.3f} s max".format(
+                  latency, samples, result["per_packet"] * 1e6,
+                  result["mean_latency"], result["max_latency"]))
+
+
+if __name__ == "__main__":
+    main()
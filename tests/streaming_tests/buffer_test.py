@@ -2,13 +2,21 @@
 Test for RT_EQcorrscan's buffer implementation
 """
 
+import os
+import sys
+import tempfile
 import unittest
+import pickle
+import threading
 import numpy as np
 
+from multiprocessing import Process, Queue
+
 from obspy import read, UTCDateTime
 
 from rt_eqcorrscan.streaming.buffers import (
-    Buffer, BufferStats, TraceBuffer, NumpyDeque)
+    Buffer, BufferStats, TraceBuffer, NumpyDeque, AlignedBuffer,
+    SharedBuffer)
 
 
 class TestBuffer(unittest.TestCase):
@@ -89,12 +97,584 @@ class TestBuffer(unittest.TestCase):
             tr.stats.pop("processing")
         self.assertEqual(buffer_stream, self.st)
 
+    def test_select(self):
+        buffer = Buffer(self.st)
+        new_trace = self.st[0].copy()
+        new_trace.stats.network = "NZ"
+        buffer.add_stream(new_trace)
+        self.assertEqual(
+            [tr.id for tr in buffer.select(id="BW.RJOB..EHZ")],
+            ["BW.RJOB..EHZ"])
+        self.assertEqual(len(buffer.select(id="BW.RJOB..HHZ")), 0)
+        self.assertEqual(
+            [tr.id for tr in buffer.select(id="*.RJOB..EHZ")],
+            ["BW.RJOB..EHZ", "NZ.RJOB..EHZ"])
+        self.assertEqual(
+            [tr.id for tr in buffer.select(id="BW.R?OB.*.EH[NZ]")],
+            ["BW.RJOB..EHN", "BW.RJOB..EHZ"])
+        self.assertEqual(len(buffer.select(id="*.*.*.*")), 4)
+        self.assertEqual(len(buffer.select(id="*")), 4)
+        self.assertEqual(len(buffer.select(id="XX.*.*.*")), 0)
+
+    def test_select_after_maxlen_change(self):
+        buffer = Buffer(traces=self.st.traces)
+        buffer.maxlen = 20.
+        trace_buffer = buffer.select(id="BW.RJOB..EHZ")[0]
+        self.assertIs(trace_buffer, buffer.traces[0])
+        self.assertEqual(len(trace_buffer), 2000)
+
+    def test_snapshot(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        snapshot = buffer.snapshot()
+        buffer += self.st2
+        for tr in buffer.snapshot():
+            self.assertFalse(tr.data.flags.writeable)
+            self.assertTrue(np.all(
+                tr.data == self.st.select(id=tr.id)[0].data))
+        for tr in snapshot:
+            self.assertEqual(tr.data.count(), 1001)
+            self.assertTrue(np.all(
+                tr.data.compressed() == self.st1.select(id=tr.id)[0].data))
+
+    def test_read_since(self):
+        buffer = Buffer(traces=self.st2, maxlen=30.)
+        new, cursor = buffer.read_since()
+        self.assertEqual(len(new), 3)
+        for tr in new:
+            # A new cursor gets all the buffer, including the gap at the start
+            self.assertEqual(tr.stats.npts, 3000)
+            self.assertTrue(np.all(
+                tr.data.compressed() == self.st2.select(id=tr.id)[0].data))
+        new, cursor = buffer.read_since(cursor)
+        self.assertEqual(len(new), 0)
+        self.assertEqual(buffer.cursor, cursor)
+        # Back-fill
+        buffer += self.st1[0]
+        self.assertNotEqual(buffer.cursor, cursor)
+        new, cursor = buffer.read_since(cursor)
+        self.assertEqual(buffer.cursor, cursor)
+        self.assertEqual(len(new), 1)
+        self.assertEqual(new[0].stats.starttime, self.st1[0].stats.starttime)
+        self.assertTrue(np.all(new[0].data == self.st1[0].data))
+        # Padded reads include older data
+        tr = self.st2[1].slice(starttime=self.st2[1].stats.endtime - 1)
+        buffer += tr
+        new, _ = buffer.read_since(cursor, pad=1.)
+        self.assertEqual(new[0].stats.starttime, tr.stats.starttime - 1.)
+        self.assertEqual(new[0].stats.endtime, tr.stats.endtime)
+
+    def test_gap_intervals(self):
+        buffer = Buffer(traces=self.st1, maxlen=30., gaps="intervals")
+        buffer += self.st2
+        self.assertTrue(buffer.is_full(strict=True))
+        self.assertEqual(buffer.copy().traces[0].data.gaps, "intervals")
+        for tr in buffer.stream:
+            self.assertTrue(np.all(
+                tr.data == self.st.select(id=tr.id)[0].data))
+
+    def test_dtype(self):
+        buffer = Buffer(traces=self.st1, maxlen=30., dtype=np.float32)
+        tr = self.st2[0].copy()
+        tr.data = tr.data.astype(np.int32)
+        buffer += tr
+        for tr in buffer.stream:
+            self.assertEqual(tr.data.dtype, np.float32)
+        self.assertEqual(
+            buffer.bytes_per_channel(),
+            {tr.id: 3000 * 4 + 3000 for tr in self.st})
+        self.assertEqual(buffer.nbytes, 3 * (3000 * 4 + 3000))
+        buffer = Buffer(traces=self.st1, maxlen=30., gaps="intervals",
+                        dtype=np.int32)
+        self.assertEqual(buffer.copy().traces[0].data.dtype, np.int32)
+        self.assertLess(buffer.nbytes, 3 * (3000 * 4 + 3000))
+        # Changing maxlen keeps the dtype
+        buffer.maxlen = 20.
+        self.assertEqual(buffer.traces[0].data.dtype, np.int32)
+
+    def test_resize_in_place(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        buffer += self.st2
+        trace_buffers = list(buffer.traces)
+        buffer.maxlen = 10.
+        for tr, tr_buffer in zip(self.st, buffer.traces):
+            self.assertIs(tr_buffer, trace_buffers.pop(0))
+            self.assertEqual(tr_buffer.stats.npts, 1000)
+            self.assertEqual(tr_buffer.stats.endtime, tr.stats.endtime)
+            self.assertTrue(np.array_equal(
+                tr_buffer.trace.data, tr.data[-1000:]))
+        buffer.maxlen = 20.
+        for tr, tr_buffer in zip(self.st, buffer.traces):
+            self.assertEqual(tr_buffer.stats.starttime,
+                             tr.stats.endtime - 19.99)
+            self.assertEqual(tr_buffer.data.gap_count, 1000)
+
+    def test_copy_on_write(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        buffer_copy = buffer.copy()
+        for tr, tr_copy in zip(buffer, buffer_copy):
+            self.assertIs(tr.data._data, tr_copy.data._data)
+        buffer_copy += self.st2
+        # Only the copy changes
+        for tr, tr_copy, tr_1 in zip(buffer, buffer_copy, self.st1):
+            self.assertIsNot(tr.data._data, tr_copy.data._data)
+            self.assertEqual(tr.stats.endtime, tr_1.stats.endtime)
+            self.assertEqual(tr.data.gap_count, 1999)
+            self.assertEqual(tr_copy.data.gap_count, 0)
+        buffer_copy = buffer.copy()
+        buffer += self.st2
+        for tr, tr_copy, tr_1 in zip(buffer, buffer_copy, self.st1):
+            self.assertEqual(tr.data.gap_count, 0)
+            self.assertEqual(tr_copy.stats.endtime, tr_1.stats.endtime)
+            self.assertTrue(np.array_equal(
+                tr_copy.trace.data.compressed(), tr_1.data))
+
+    def test_read_since_old_cursor(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        buffer += self.st2
+        _, cursor = buffer.read_since()
+        buffer.maxlen = 10.
+        self.assertNotEqual(buffer.cursor, cursor)
+        new, _ = buffer.read_since(cursor)
+        self.assertEqual(len(new), 3)
+        self.assertEqual(new[0].stats.npts, 1000)
+
+    def test_resize_keeps_cursor(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        _, cursor = buffer.read_since()
+        # Same length, then growing: no data are dropped
+        buffer.maxlen = 30.
+        self.assertEqual(buffer.cursor, cursor)
+        buffer.maxlen = 40.
+        self.assertEqual(buffer.cursor, cursor)
+        new, cursor = buffer.read_since(cursor)
+        self.assertEqual(len(new), 0)
+        # Shrinking only drops empty samples
+        buffer.maxlen = 30.
+        self.assertEqual(buffer.cursor, cursor)
+        buffer += self.st2
+        new, _ = buffer.read_since(cursor)
+        self.assertEqual(len(new), 3)
+        self.assertEqual(new[0].stats.starttime, self.st2[0].stats.starttime)
+
     def test_full(self):
         buffer = Buffer(traces=self.st1, maxlen=30.)
         self.assertFalse(buffer.is_full())
         buffer += self.st2
         self.assertTrue(buffer.is_full())
 
+    def test_checkpoint(self):
+        buffer = Buffer(traces=self.st1, maxlen=40., gaps="intervals",
+                        dtype=np.float32)
+        buffer += self.st2.slice(self.st2[0].stats.starttime + 5)
+        with tempfile.TemporaryDirectory() as path:
+            buffer.checkpoint(path)
+            reloaded = Buffer.from_checkpoint(path)
+            self.assertEqual(reloaded.maxlen, 40.)
+            self.assertEqual(reloaded.gaps, "intervals")
+            self.assertEqual(reloaded.dtype, np.float32)
+            for tr in buffer.stream:
+                tr_reloaded = reloaded.select(tr.id)[0].trace
+                self.assertEqual(tr.stats.starttime,
+                                 tr_reloaded.stats.starttime)
+                self.assertEqual(tr.stats.endtime, tr_reloaded.stats.endtime)
+                self.assertTrue(np.array_equal(
+                    tr.data.mask, tr_reloaded.data.mask))
+                self.assertTrue(np.array_equal(
+                    tr.data.compressed(), tr_reloaded.data.compressed()))
+            shorter = Buffer.from_checkpoint(path, maxlen=20.)
+            self.assertEqual(shorter.maxlen, 20.)
+            self.assertEqual(shorter.traces[0].stats.endtime,
+                             buffer.traces[0].stats.endtime)
+
+    def test_checkpoint_replaces_previous(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        with tempfile.TemporaryDirectory() as path:
+            buffer.checkpoint(path)
+            buffer += self.st2
+            buffer.checkpoint(path)
+            # Only the data for the latest checkpoint are kept
+            self.assertEqual(
+                len([f for f in os.listdir(path) if f.endswith(".npy")]), 3)
+            # An interrupted checkpoint does not replace the header
+            with open(os.path.join(path, "buffer.json.tmp"), "w") as f:
+                f.write("{")
+            reloaded = Buffer.from_checkpoint(path)
+            self.assertTrue(reloaded.is_full())
+
+    def test_checkpoint_memory_mapped(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        buffer += self.st2.slice(self.st2[0].stats.starttime + 5)
+        with tempfile.TemporaryDirectory() as path:
+            buffer.checkpoint(path)
+            reloaded = Buffer.from_checkpoint(path)
+            deques = [tr.data for tr in reloaded.traces]
+            for np_deque in deques:
+                # Read from the file until written to
+                self.assertIsInstance(np_deque._data.base, np.memmap)
+                self.assertFalse(np_deque._data.flags.writeable)
+            for tr, tr_reloaded in zip(buffer.stream, reloaded.stream):
+                self.assertTrue(np.array_equal(
+                    tr.data.mask, tr_reloaded.data.mask))
+                self.assertTrue(np.array_equal(
+                    tr.data.compressed(), tr_reloaded.data.compressed()))
+            reloaded += self.st2
+            for np_deque in deques:
+                self.assertNotIsInstance(np_deque._data.base, np.memmap)
+            self.assertTrue(reloaded.is_full(strict=True))
+            # The checkpoint is not changed by writes to the buffer
+            self.assertFalse(Buffer.from_checkpoint(path).is_full(
+                strict=True))
+
+    def test_checkpoint_keeps_other_files(self):
+        buffer = Buffer(traces=self.st1, maxlen=30.)
+        with tempfile.TemporaryDirectory() as path:
+            for file_name in ("users.npy", "1.0.npy"):
+                np.save(os.path.join(path, file_name), np.arange(10))
+            buffer.checkpoint(path)
+            buffer.checkpoint(path)
+            for file_name in ("users.npy", "1.0.npy"):
+                self.assertTrue(np.array_equal(
+                    np.load(os.path.join(path, file_name)), np.arange(10)))
+            self.assertEqual(
+                len([f for f in os.listdir(path)
+                     if f.startswith("buffer.") and f.endswith(".npy")]), 3)
+
+
+class TestAlignedBuffer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.st = read()
+        cls.st1 = cls.st.slice(
+            cls.st[0].stats.starttime, cls.st[0].stats.starttime + 10)
+        cls.st2 = cls.st.slice(
+            cls.st[0].stats.starttime + 10, cls.st[0].stats.endtime)
+
+    def test_init_with_stream(self):
+        buffer = AlignedBuffer(traces=self.st)
+        self.assertEqual(buffer.maxlen, 30.)
+        self.assertEqual(buffer.seed_ids, [tr.id for tr in self.st])
+        self.assertTrue(buffer.is_full(strict=True))
+        data, mask = buffer.matrix()
+        self.assertEqual(data.shape, (3, 3000))
+        self.assertFalse(mask.any())
+        for row, tr in enumerate(self.st):
+            self.assertTrue(np.all(data[row] == tr.data))
+
+    def test_add_stream_in_pieces(self):
+        buffer = AlignedBuffer(maxlen=30., sampling_rate=100.)
+        buffer.add_stream(self.st2)
+        self.assertFalse(buffer.is_full())
+        buffer.add_stream(self.st1)
+        self.assertTrue(buffer.is_full(strict=True))
+        for tr, tr_in in zip(buffer.stream, self.st):
+            self.assertEqual(tr.id, tr_in.id)
+            self.assertEqual(tr.stats.starttime, tr_in.stats.starttime)
+            self.assertTrue(np.all(tr.data == tr_in.data))
+
+    def test_window_is_aligned(self):
+        buffer = AlignedBuffer(traces=self.st1, maxlen=30.)
+        buffer.add_stream(self.st2[0:2])
+        window = buffer.window(length=20.)
+        self.assertEqual(len(window), 3)
+        for tr in window:
+            self.assertEqual(tr.stats.npts, 2000)
+            self.assertEqual(tr.stats.starttime, window[0].stats.starttime)
+            self.assertEqual(tr.stats.endtime, self.st[0].stats.endtime)
+        self.assertFalse(np.ma.is_masked(window[0].data))
+        self.assertEqual(window[2].data.count(), 1)
+
+    def test_old_data_dropped(self):
+        buffer = AlignedBuffer(traces=self.st2, maxlen=10.)
+        buffer.add_stream(self.st1)
+        data, mask = buffer.matrix()
+        self.assertFalse(mask.any())
+        self.assertEqual(buffer.endtime, self.st[0].stats.endtime)
+
+    def test_select(self):
+        buffer = AlignedBuffer(traces=self.st)
+        self.assertEqual(buffer.select("BW.RJOB..EHZ")[0].id, "BW.RJOB..EHZ")
+        self.assertEqual(len(buffer.select("BW.RJOB..EH?")), 3)
+        self.assertEqual(len(buffer.select("BW.RJOB..HHZ")), 0)
+        channel = buffer.select("BW.RJOB..EHN")[0]
+        self.assertEqual(channel.stats.endtime, self.st[0].stats.endtime)
+        self.assertEqual(channel.data_len, 30.)
+        self.assertTrue(channel.is_full())
+
+    def test_read_since(self):
+        buffer = AlignedBuffer(traces=self.st2, maxlen=30.)
+        new, cursor = buffer.read_since()
+        self.assertEqual(len(new), 3)
+        self.assertEqual(new[0].data.count(), 2000)
+        self.assertEqual(buffer.cursor, cursor)
+        buffer += self.st1[0]
+        self.assertNotEqual(buffer.cursor, cursor)
+        new, cursor = buffer.read_since(cursor)
+        self.assertEqual(len(new), 1)
+        self.assertEqual(new[0].stats.starttime, self.st1[0].stats.starttime)
+        self.assertTrue(np.all(new[0].data == self.st1[0].data))
+        new, cursor = buffer.read_since(cursor)
+        self.assertEqual(len(new), 0)
+        self.assertEqual(buffer.cursor, cursor)
+
+    def test_masked_data_not_used(self):
+        buffer = AlignedBuffer(traces=self.st.copy())
+        tr = self.st[0].copy()
+        tr.data = np.ma.masked_array(
+            np.zeros(tr.stats.npts), mask=np.zeros(tr.stats.npts, bool))
+        tr.data.mask[100:200] = True
+        buffer.add_trace(tr)
+        data, mask = buffer.matrix()
+        self.assertFalse(mask.any())
+        self.assertTrue(np.all(data[0, 100:200] == self.st[0].data[100:200]))
+        self.assertTrue(np.all(data[0, 200:] == 0))
+
+
+def _read_shared(buffer, ready, queue):
+    ready.get(timeout=60)
+    queue.put(buffer.stream)
+
+
+class TestSharedBuffer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.st = read()
+        cls.seed_ids = [tr.id for tr in cls.st]
+
+    def setUp(self) -> None:
+        self.buffer = SharedBuffer(
+            self.seed_ids, maxlen=30., sampling_rate=100.)
+
+    def tearDown(self) -> None:
+        self.buffer.close()
+        self.buffer.unlink()
+
+    def test_attach_and_read(self):
+        self.buffer.add_stream(self.st)
+        reader = SharedBuffer.attach(self.buffer.name)
+        self.assertTrue(reader.read_only)
+        self.assertTrue(reader.is_full(strict=True))
+        for tr, tr_in in zip(reader.stream, self.st):
+            self.assertEqual(tr.id, tr_in.id)
+            self.assertEqual(tr.stats.starttime, tr_in.stats.starttime)
+            self.assertTrue(np.all(tr.data == tr_in.data))
+        reader.close()
+
+    def test_reader_sees_new_data(self):
+        reader = SharedBuffer.attach(self.buffer.name)
+        self.assertEqual(len(reader), 0)
+        sequence = reader.sequence(self.seed_ids[0])
+        self.buffer.add_stream(self.st[0])
+        self.assertEqual(len(reader), 1)
+        self.assertEqual(reader.sequence(self.seed_ids[0]), sequence + 2)
+        self.assertEqual(reader.select(self.seed_ids[0])[0].data_len, 30.)
+        reader.close()
+
+    def test_reader_cannot_write(self):
+        reader = SharedBuffer.attach(self.buffer.name)
+        with self.assertRaises(AssertionError):
+            reader.add_stream(self.st)
+        reader.close()
+
+    def test_failed_write_releases_readers(self):
+        tr = self.st[0].copy()
+        tr.data = np.array(["a"] * tr.stats.npts)
+        with self.assertRaises(ValueError):
+            self.buffer.add_trace(tr)
+        self.assertEqual(self.buffer.sequence(tr.id) % 2, 0)
+        self.buffer.add_stream(self.st[0])
+        self.assertTrue(np.all(self.buffer.stream[0].data == self.st[0].data))
+
+    def test_pickle_attaches_read_only(self):
+        self.buffer.add_stream(self.st)
+        reader = pickle.loads(pickle.dumps(self.buffer))
+        self.assertTrue(reader.read_only)
+        self.assertEqual(reader.name, self.buffer.name)
+        reader.close()
+
+    def test_read_from_process(self):
+        ready, queue = Queue(), Queue()
+        process = Process(
+            target=_read_shared, args=(self.buffer, ready, queue))
+        process.start()
+        # Data written after the process started are seen by the process
+        self.buffer.add_stream(self.st)
+        ready.put(True)
+        st = queue.get(timeout=60)
+        process.join()
+        self.assertEqual(len(st), 3)
+        for tr, tr_in in zip(st, self.st):
+            self.assertTrue(np.all(tr.data == tr_in.data))
+
+    def test_old_data_dropped(self):
+        buffer = SharedBuffer(self.seed_ids, maxlen=10., sampling_rate=100.)
+        buffer.add_stream(self.st)
+        buffer.add_stream(self.st.slice(
+            self.st[0].stats.starttime, self.st[0].stats.starttime + 5))
+        tr = buffer.stream[0]
+        self.assertEqual(tr.stats.endtime, self.st[0].stats.endtime)
+        self.assertTrue(np.all(tr.data == self.st[0].data[-1000:]))
+        buffer.close()
+        buffer.unlink()
+
+    def test_unknown_channel_ignored(self):
+        tr = self.st[0].copy()
+        tr.stats.station = "BOB"
+        self.buffer.add_trace(tr)
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_read_since(self):
+        self.buffer.add_stream(self.st)
+        reader = SharedBuffer.attach(self.buffer.name)
+        new, cursor = reader.read_since()
+        self.assertEqual(len(new), 3)
+        self.assertEqual(reader.cursor, cursor)
+        self.buffer.add_stream(self.st[0])
+        self.assertNotEqual(reader.cursor, cursor)
+        new, cursor = reader.read_since(cursor)
+        self.assertEqual([tr.id for tr in new], [self.st[0].id])
+        new, cursor = reader.read_since(cursor)
+        self.assertEqual(len(new), 0)
+        self.assertEqual(reader.cursor, cursor)
+        reader.close()
+
+    def test_clear(self):
+        self.buffer.add_stream(self.st)
+        self.buffer.clear()
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(len(self.buffer.stream), 0)
+
+    def test_concurrent_reads_are_consistent(self):
+        seed_id = self.seed_ids[0]
+        tr = self.st[0].copy()
+        tr.data = np.zeros(100)
+        failures = []
+
+        def read_buffer():
+            for _ in range(200):
+                channel = self.buffer.select(seed_id)
+                if not channel:
+                    continue
+                data = channel[0].trace.data.compressed()
+                # Every packet is constant and one greater than the last
+                if np.any(np.diff(data) < 0) or np.any(np.diff(data) > 1):
+                    failures.append(data)
+
+        reader = threading.Thread(target=read_buffer)
+        reader.start()
+        for i in range(2000):
+            tr.data = np.ones(100) * i
+            self.buffer.add_trace(tr)
+            tr.stats.starttime += 1.0
+        reader.join()
+        self.assertEqual(failures, [])
+
+
+class TestConcurrentIngest(unittest.TestCase):
+    """ Readers in other threads must never see a partly written packet. """
+    sampling_rate = 100.
+    packet_length = 37
+    n_packets = 3000
+
+    def setUp(self):
+        # Switch threads as often as possible to provoke torn reads
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def packets(self):
+        """ Packets with data equal to the sample index since 1970. """
+        tr = read()[0]
+        tr.stats.sampling_rate = self.sampling_rate
+        for i in range(self.n_packets):
+            start = i * self.packet_length
+            tr.stats.starttime = UTCDateTime(start / self.sampling_rate)
+            tr.data = np.arange(start, start + self.packet_length,
+                                dtype=np.float64)
+            yield tr
+
+    def check_trace(self, tr, failures):
+        data = np.ma.getdata(tr.data)
+        keep = ~np.ma.getmaskarray(tr.data)
+        start = int(round(tr.stats.starttime.timestamp * self.sampling_rate))
+        expected = np.arange(start, start + len(data))
+        if not np.array_equal(data[keep], expected[keep]):
+            failures.append(tr)
+        # Samples must be in time order, not just the right samples
+        elif np.any(np.diff(data[keep]) <= 0):
+            failures.append(tr)
+
+    def stress(self, buffer, readers):
+        done = threading.Event()
+        failures = []
+
+        def read_buffer(reader):
+            while not done.is_set() and len(failures) < 10:
+                for tr in reader(buffer):
+                    self.check_trace(tr, failures)
+
+        threads = [threading.Thread(target=read_buffer, args=(reader, ))
+                   for reader in readers]
+        add = getattr(buffer, "add_trace", None) or buffer.add_stream
+        add(next(self.packets()))
+        for thread in threads:
+            thread.start()
+        for tr in self.packets():
+            add(tr)
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+    def test_trace_buffer(self):
+        tr = next(self.packets())
+        buffer = TraceBuffer(
+            data=tr.data, header=tr.stats, maxlen=1000, gaps="intervals")
+        self.stress(buffer, readers=[
+            lambda b: [b.trace], lambda b: [b.snapshot()],
+            lambda b: b.read_since(pad=1.)[0]])
+
+    def test_buffer(self):
+        buffer = Buffer(traces=[], maxlen=10.)
+        self.stress(buffer, readers=[
+            lambda b: b.stream, lambda b: b.snapshot(),
+            lambda b: b.read_since()[0]])
+
+    def test_concurrent_snapshots(self):
+        buffer = Buffer(traces=[], maxlen=10.)
+        self.stress(buffer, readers=[lambda b: b.snapshot()] * 4)
+
+    def test_resize_during_ingest(self):
+        buffer = Buffer(traces=[], maxlen=10.)
+        done = threading.Event()
+
+        def resize():
+            maxlens = [5., 20., 10.]
+            while not done.is_set():
+                maxlens.append(maxlens.pop(0))
+                buffer.maxlen = maxlens[0]
+
+        thread = threading.Thread(target=resize)
+        thread.start()
+        try:
+            self.stress(buffer, readers=[
+                lambda b: b.stream, lambda b: b.read_since()[0]])
+        finally:
+            done.set()
+            thread.join()
+
+    def test_copy_during_ingest(self):
+        buffer = Buffer(traces=[], maxlen=10., gaps="intervals")
+        self.stress(buffer, readers=[
+            lambda b: b.copy().stream, lambda b: b.copy().snapshot()])
+
+    def test_aligned_buffer(self):
+        buffer = AlignedBuffer(maxlen=10., sampling_rate=self.sampling_rate)
+        self.stress(buffer, readers=[
+            lambda b: b.window(), lambda b: b.window(length=1.),
+            lambda b: b.read_since()[0]])
+
 
 class TestBufferStats(unittest.TestCase):
     def base_stats(self):
@@ -131,6 +711,29 @@ class TestBufferStats(unittest.TestCase):
         stats = self.base_stats()
         stats.misc = dict(albert="walrous")
 
+    def test_starttime_read_only(self):
+        stats = self.base_stats()
+        with self.assertRaises(AttributeError):
+            stats.starttime = UTCDateTime(2015, 9, 25)
+
+    def test_integer_clock(self):
+        stats = self.base_stats()
+        self.assertEqual(stats.endtime_ns, UTCDateTime(2015, 9, 26).ns)
+        self.assertEqual(stats.endtime_ns - stats.starttime_ns, 10 ** 9)
+        stats.endtime_ns += stats.samples_to_ns(50)
+        self.assertEqual(
+            stats.endtime, UTCDateTime(2015, 9, 26, 0, 0, 0, 500000))
+
+    def test_copy(self):
+        stats = self.base_stats()
+        stats.misc = dict(albert="walrous")
+        stats_copy = pickle.loads(pickle.dumps(stats))
+        self.assertEqual(stats, stats_copy)
+        self.assertEqual(stats_copy.misc.albert, "walrous")
+        stats_copy.npts = 11
+        self.assertNotEqual(stats, stats_copy)
+        self.assertEqual(stats.copy(), stats)
+
 
 class TestTraceBuffer(unittest.TestCase):
     @classmethod
@@ -165,6 +768,55 @@ class TestTraceBuffer(unittest.TestCase):
         with self.assertRaises(ValueError):
             trace_buffer.id = "alf.bob"
 
+    def test_gap_fraction(self):
+        trace_buffer = TraceBuffer(
+            data=self.st[0].data, header=self.st[0].stats,
+            maxlen=2 * self.st[0].stats.npts)
+        self.assertEqual(trace_buffer.gap_fraction, 0.5)
+        self.assertEqual(trace_buffer.data_len, 30.)
+
+    def test_gap_keeps_sample_times(self):
+        trace_buffer = TraceBuffer(
+            data=self.st[0].data, header=self.st[0].stats,
+            maxlen=2 * self.st[0].stats.npts)
+        tr = self.st[0].copy()
+        tr.stats.starttime = tr.stats.endtime + 1.0
+        trace_buffer.add_trace(tr)
+        # One second of gap between the old and new data
+        self.assertEqual(trace_buffer.data.gap_count, 99)
+        old = trace_buffer.trace.slice(
+            self.st[0].stats.starttime, self.st[0].stats.endtime)
+        self.assertTrue(np.array_equal(
+            old.data.compressed(),
+            self.st[0].data[-len(old.data.compressed()):]))
+
+    def test_overlapping_packet_with_gaps(self):
+        trace_buffer = self.trace_buffer()
+        tr = self.st[0].copy()
+        tr.data = np.ma.masked_array(
+            np.ones(tr.stats.npts), mask=np.zeros(tr.stats.npts, dtype=bool))
+        tr.data.mask[0:100] = True
+        tr.stats.starttime += 10.0
+        trace_buffer.add_trace(tr)
+        self.assertEqual(trace_buffer.stats.endtime, tr.stats.endtime)
+        data = trace_buffer.trace.data
+        # Masked samples in the overlap keep the old data
+        self.assertTrue(np.array_equal(
+            data[0:100], self.st[0].data[1000:1100]))
+        self.assertTrue(np.all(data[100:] == 1))
+
+    def test_snapshot(self):
+        trace_buffer = self.trace_buffer()
+        snapshot = trace_buffer.snapshot()
+        self.assertEqual(snapshot, trace_buffer.trace)
+        with self.assertRaises(ValueError):
+            snapshot.data[0] = 0
+        new_data = self.st[0].copy()
+        new_data.stats.starttime = trace_buffer.stats.endtime + 1
+        trace_buffer.add_trace(new_data)
+        self.assertNotEqual(snapshot, trace_buffer.trace)
+        self.assertEqual(trace_buffer.snapshot(), trace_buffer.trace)
+
     def test_add_lots_of_old_data(self):
         trace_buffer = self.trace_buffer()
         maxlen = trace_buffer.data.maxlen
@@ -242,6 +894,202 @@ class TestNumpyDeque(unittest.TestCase):
         deque_1.insert(99, 10)
         self.assertEqual(deque_1[10], 99)
 
+    def test_extend_wraps_storage(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        for i in range(7):
+            deque_1.extend(np.arange(3) + 20 + (3 * i))
+        self.assertTrue(np.all(deque_1.data == np.arange(21, 41)))
+        self.assertEqual(len(deque_1), 20)
+
+    def test_extend_left_wraps_storage(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        deque_1.extend(np.arange(20, 27))
+        deque_1.extendleft(np.arange(-3, 0))
+        self.assertTrue(np.all(
+            deque_1.data == np.concatenate([np.arange(-3, 0),
+                                            np.arange(7, 24)])))
+
+    def test_insert_across_wrap(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        deque_1.extend(np.arange(20, 27))
+        deque_1.insert(np.array([99, 99, 99, 99]), 11)
+        expected = np.arange(7, 27)
+        expected[11:15] = 99
+        self.assertTrue(np.all(deque_1.data == expected))
+        deque_1.insert(np.array([-1, -1]), -2)
+        self.assertTrue(np.all(deque_1[-2:] == -1))
+
+    def test_valid_count(self):
+        deque_1 = NumpyDeque(np.arange(10), maxlen=20)
+        self.assertEqual(len(deque_1), 10)
+        self.assertEqual(deque_1.gap_count, 10)
+        self.assertEqual(deque_1.gap_fraction, 0.5)
+        deque_1.extend(np.ma.masked_array(
+            np.arange(8), mask=[True, True] + [False] * 6))
+        self.assertEqual(len(deque_1), 16)
+        deque_1.insert(np.arange(3), 0)
+        self.assertEqual(len(deque_1), 18)
+        deque_1.extendleft(np.arange(25))
+        self.assertEqual(len(deque_1), 20)
+        self.assertEqual(deque_1.gap_fraction, 0.0)
+        self.assertTrue(deque_1.is_full(strict=True))
+
+    def test_insert_masked_across_wrap(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        deque_1.extend(np.ma.masked_array(np.arange(20, 26), mask=True))
+        self.assertEqual(len(deque_1), 14)
+        other = np.ma.masked_array(
+            np.arange(100, 110), mask=[False, True] * 5)
+        deque_1.insert(other, 10)
+        expected = np.ma.masked_array(
+            np.concatenate([np.arange(6, 20), np.arange(20, 26)]),
+            mask=[False] * 14 + [True] * 6)
+        expected[10:20:2] = np.arange(100, 110, 2)
+        self.assertTrue(np.all(deque_1.data.mask == expected.mask))
+        self.assertTrue(np.all(
+            deque_1.data.compressed() == expected.compressed()))
+        self.assertEqual(len(deque_1), 17)
+
+    def test_snapshot_shares_unchanged_data(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        deque_1.extend(np.arange(5))
+        snapshot_1 = deque_1.snapshot()
+        snapshot_2 = deque_1.snapshot()
+        self.assertTrue(np.shares_memory(snapshot_1, snapshot_2))
+        self.assertFalse(snapshot_1.flags.writeable)
+
+    def test_snapshot_held_is_not_overwritten(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        snapshot_1 = deque_1.snapshot()[5:]
+        deque_1.extend(np.arange(5))
+        snapshot_2 = deque_1.snapshot()
+        self.assertFalse(np.shares_memory(snapshot_1, snapshot_2))
+        self.assertTrue(np.all(snapshot_1 == np.arange(5, 20)))
+
+    def test_snapshot_memory_reused(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        address = deque_1.snapshot().__array_interface__["data"][0]
+        deque_1.extend(np.ma.masked_array(np.arange(5), mask=True))
+        snapshot = deque_1.snapshot()
+        self.assertEqual(snapshot.data.__array_interface__["data"][0],
+                         address)
+        self.assertEqual(snapshot.count(), 15)
+
+    def test_snapshot_during_write_not_reused(self):
+        deque_1 = NumpyDeque(np.arange(5.), maxlen=5)
+        write = deque_1._write
+
+        def write_and_snapshot(*args, **kwargs):
+            write(*args, **kwargs)
+            deque_1.snapshot()
+
+        deque_1._write = write_and_snapshot
+        deque_1.extend([10., 11.])
+        del deque_1._write
+        self.assertTrue(np.all(deque_1.data == [2., 3., 4., 10., 11.]))
+        self.assertTrue(np.all(deque_1.snapshot() == deque_1.data))
+
+    def test_gap_intervals(self):
+        deque_1 = NumpyDeque(np.arange(10), maxlen=20, gaps="intervals")
+        self.assertEqual(deque_1.gaps, "intervals")
+        # One gap interval, in storage coordinates
+        self.assertEqual(len(deque_1._gaps._starts), 1)
+        self.assertTrue(np.all(deque_1.mask == [True] * 10 + [False] * 10))
+        deque_1.extend(np.ma.masked_array(
+            np.arange(15), mask=[False] * 5 + [True] * 5 + [False] * 5))
+        self.assertEqual(len(deque_1), 15)
+        self.assertTrue(np.all(deque_1.mask == (
+            [False] * 10 + [True] * 5 + [False] * 5)))
+        self.assertTrue(deque_1.is_full())
+        self.assertFalse(deque_1.is_full(strict=True))
+        deque_1.insert(np.ones(3), 11)
+        self.assertEqual(len(deque_1), 18)
+        self.assertTrue(np.all(deque_1.filled(-1)[10:15] == [-1, 1, 1, 1, -1]))
+
+    def test_gap_intervals_match_mask(self):
+        deque_1 = NumpyDeque(np.arange(5), maxlen=20)
+        deque_2 = NumpyDeque(np.arange(5), maxlen=20, gaps="intervals")
+        other = np.ma.masked_array(np.arange(12), mask=np.arange(12) % 3 == 0)
+        for deque in (deque_1, deque_2):
+            deque.extend(other)
+            deque.insert(other, 8)
+            deque.extendleft(other[0:4])
+        self.assertTrue(np.all(deque_1.mask == deque_2.mask))
+        self.assertTrue(np.all(deque_1.filled() == deque_2.filled()))
+        self.assertEqual(len(deque_1), len(deque_2))
+
+    def test_insert_out_of_range(self):
+        deque_1 = NumpyDeque(np.arange(20), maxlen=20)
+        with self.assertRaises(AssertionError):
+            deque_1.insert(np.arange(5), 18)
+
+    def test_resize(self):
+        for gaps in ("mask", "intervals"):
+            deque_1 = NumpyDeque(np.arange(10), maxlen=20, gaps=gaps)
+            deque_1.extend(np.ma.masked_array(
+                np.arange(10, 15), mask=[False, True, False, False, False]))
+            # Move the head away from the start of storage
+            self.assertNotEqual(deque_1._head, 0)
+            expected = deque_1.data[-12:]
+            storage = deque_1._storage
+            deque_1.resize(12)
+            self.assertEqual(deque_1.maxlen, 12)
+            self.assertEqual(len(deque_1), 11)
+            self.assertTrue(np.array_equal(deque_1.mask, expected.mask))
+            self.assertTrue(
+                np.array_equal(deque_1.filled(), expected.filled(0)))
+            # Growing back uses the same memory
+            deque_1.resize(20)
+            self.assertIs(deque_1._storage, storage)
+            self.assertTrue(np.all(deque_1.mask[0:8]))
+            self.assertTrue(np.array_equal(deque_1.filled()[8:],
+                                           expected.filled(0)))
+            deque_1.extend(np.arange(3))
+            self.assertEqual(len(deque_1), 14)
+            self.assertTrue(np.array_equal(deque_1.data[-3:], np.arange(3)))
+            # Growing beyond the storage allocates
+            deque_1.resize(30)
+            self.assertIsNot(deque_1._storage, storage)
+            self.assertEqual(len(deque_1), 14)
+            self.assertTrue(np.array_equal(deque_1.data[-3:], np.arange(3)))
+
+    def test_copy_on_write(self):
+        for gaps in ("mask", "intervals"):
+            deque_1 = NumpyDeque(np.arange(10), maxlen=20, gaps=gaps)
+            deque_2 = deque_1.copy()
+            deque_3 = deque_2.copy()
+            storage = deque_1._data
+            self.assertIs(deque_3._data, storage)
+            deque_2.extend(np.arange(5))
+            deque_1.insert(np.ma.masked_array([99, 99], mask=[True, False]),
+                           0)
+            self.assertIsNot(deque_1._data, storage)
+            self.assertIsNot(deque_2._data, storage)
+            # The last deque sharing the storage writes to it in place
+            deque_3.extend_masked(2)
+            self.assertIs(deque_3._data, storage)
+            self.assertEqual(deque_1.data[1], 99)
+            self.assertEqual(deque_1.gap_count, 9)
+            self.assertTrue(np.array_equal(deque_2.data[-15:], np.concatenate(
+                (np.arange(10), np.arange(5)))))
+            self.assertEqual(deque_2.gap_count, 5)
+            self.assertTrue(np.array_equal(deque_3.data[8:18], np.arange(10)))
+            self.assertEqual(deque_3.gap_count, 10)
+            # Copies can be pickled and resized
+            deque_4 = pickle.loads(pickle.dumps(deque_3.copy()))
+            deque_3.resize(10)
+            self.assertTrue(np.array_equal(deque_4.data[8:18], np.arange(10)))
+
+    def test_resize_pickle(self):
+        deque_1 = NumpyDeque(np.arange(10.), maxlen=20)
+        deque_1.resize(5)
+        self.assertEqual(deque_1.nbytes, 20 * 8 + 20)
+        deque_2 = pickle.loads(pickle.dumps(deque_1))
+        self.assertEqual(deque_2.nbytes, 5 * 8 + 5)
+        self.assertTrue(np.array_equal(deque_1.data, deque_2.data))
+        deque_2.resize(10)
+        self.assertEqual(deque_2.data.mask.sum(), 5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for the wall and virtual clocks.
+"""
+
+import pickle
+import threading
+import time
+import unittest
+
+from obspy import UTCDateTime
+
+from rt_eqcorrscan.streaming.clock import WallClock, VirtualClock
+
+
+class WallClockTest(unittest.TestCase):
+    def test_sleep(self):
+        clock = WallClock()
+        tic = time.perf_counter()
+        clock.sleep(0.1)
+        clock.sleep(-1)
+        self.assertGreater(time.perf_counter() - tic, 0.09)
+        self.assertFalse(clock.virtual)
+
+
+class VirtualClockTest(unittest.TestCase):
+    starttime = UTCDateTime(2020, 1, 1)
+
+    def test_sleep_alone(self):
+        clock = VirtualClock(starttime=self.starttime)
+        tic = time.perf_counter()
+        for _ in range(1000):
+            clock.sleep(3600)
+        self.assertLess(time.perf_counter() - tic, 5.)
+        self.assertEqual(clock.now(), self.starttime + 3600000)
+
+    def test_deterministic_order(self):
+        def tick(clock, name, interval, ticks):
+            for _ in range(20):
+                clock.sleep(interval)
+                ticks.append((name, clock.now()))
+
+        runs = []
+        for _ in range(3):
+            clock, ticks = VirtualClock(starttime=self.starttime), []
+            threads = [threading.Thread(target=tick, args=(
+                clock, name, interval, ticks))
+                for name, interval in (("a", 1.), ("b", 1.), ("c", 0.7))]
+            for thread in threads:
+                clock.attach(thread)
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            runs.append(ticks)
+        self.assertEqual(runs[0], runs[1])
+        self.assertEqual(runs[0], runs[2])
+        self.assertEqual([t for _, t in runs[0]],
+                         sorted(t for _, t in runs[0]))
+        # Ties are woken in the order they went to sleep
+        seventh = self.starttime + 7
+        self.assertEqual([name for name, t in runs[0] if t == seventh],
+                         ["a", "b", "c"])
+
+    def test_attached_thread_holds_time(self):
+        clock = VirtualClock(starttime=self.starttime)
+        clock.attach()
+        sleeper = threading.Thread(target=clock.sleep, args=(10.,))
+        sleeper.start()
+        time.sleep(0.2)
+        # Still waiting for this thread
+        self.assertTrue(sleeper.is_alive())
+        self.assertEqual(clock.now(), self.starttime)
+        clock.detach()
+        sleeper.join(timeout=5)
+        self.assertFalse(sleeper.is_alive())
+        self.assertEqual(clock.now(), self.starttime + 10)
+
+    def test_finished_threads_detach(self):
+        clock = VirtualClock(starttime=self.starttime)
+        worker = threading.Thread(target=time.sleep, args=(0.1,))
+        clock.attach(worker)
+        worker.start()
+        clock.sleep(5.)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(clock.now(), self.starttime + 5)
+
+    def test_pickle(self):
+        clock = VirtualClock(starttime=self.starttime)
+        clock.attach()
+        clock_copy = pickle.loads(pickle.dumps(clock))
+        # The copy does not wait for threads attached to the original
+        clock_copy.sleep(5.)
+        self.assertEqual(clock_copy.now(), self.starttime + 5)
+        self.assertEqual(clock.now(), self.starttime)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+Tests for ingest metrics of streaming clients.
+"""
+
+import os
+import tempfile
+import unittest
+
+from obspy import read
+
+from rt_eqcorrscan.streaming.metrics import IngestMetrics, _ChannelMetrics
+
+
+class TestIngestMetrics(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def packets(self, length=1.):
+        tr = self.st[0]
+        starttime = tr.stats.starttime
+        packets = []
+        while starttime < tr.stats.endtime:
+            packets.append(tr.slice(starttime, starttime + length -
+                                    tr.stats.delta))
+            starttime += length
+        return packets
+
+    def test_contiguous(self):
+        metrics = IngestMetrics()
+        packets = self.packets()
+        for i, packet in enumerate(packets):
+            metrics.record(
+                packet, arrival=packet.stats.endtime.timestamp + 0.3 + i)
+        channel = metrics.to_dict()[self.st[0].id]
+        self.assertEqual(channel["packets"], 30)
+        self.assertEqual(channel["samples"], self.st[0].stats.npts)
+        self.assertEqual(channel["gaps"], 0)
+        self.assertEqual(channel["out_of_order"], 0)
+        # Arrivals are two seconds apart
+        self.assertAlmostEqual(channel["packets_per_second"], 0.5)
+        self.assertAlmostEqual(channel["mean_latency"], 14.8, places=5)
+        buckets = channel["latency_buckets"]
+        self.assertEqual(buckets[0.25], 0)
+        self.assertEqual(buckets[0.5], 1)
+        self.assertEqual(buckets[10.], 10)
+        self.assertEqual(buckets[float("inf")], 30)
+
+    def test_gaps_and_out_of_order(self):
+        metrics = IngestMetrics()
+        packets = self.packets()
+        for i in (0, 1, 4, 5, 2, 6):
+            metrics.record(packets[i])
+        channel = metrics.to_dict()[self.st[0].id]
+        self.assertEqual(channel["gaps"], 1)
+        self.assertAlmostEqual(channel["gap_seconds"], 2.)
+        self.assertEqual(channel["out_of_order"], 1)
+        # Data after the out-of-order packet are contiguous
+        metrics.record(packets[7])
+        self.assertEqual(metrics.to_dict()[self.st[0].id]["gaps"], 1)
+
+    def test_jitter_is_not_a_gap(self):
+        metrics = IngestMetrics()
+        packets = self.packets()
+        metrics.record(packets[0])
+        packets[1].stats.starttime += 0.4 * packets[1].stats.delta
+        metrics.record(packets[1])
+        channel = metrics.to_dict()[self.st[0].id]
+        self.assertEqual(channel["gaps"], 0)
+        self.assertEqual(channel["out_of_order"], 0)
+
+    def test_prometheus(self):
+        metrics = IngestMetrics(latency_buckets=(1., 5.))
+        for tr in self.st:
+            metrics.record(tr, arrival=tr.stats.endtime.timestamp + 2)
+        text = metrics.to_prometheus()
+        for tr in self.st:
+            self.assertIn(
+                'rt_eqcorrscan_packets_total{{channel="{0}"}} 1'.format(
+                    tr.id), text)
+            self.assertIn(
+                'rt_eqcorrscan_packet_latency_seconds_bucket{{channel="{0}",'
+                'le="5.0"}} 1'.format(tr.id), text)
+            self.assertIn(
+                'rt_eqcorrscan_packet_latency_seconds_bucket{{channel="{0}",'
+                'le="+Inf"}} 1'.format(tr.id), text)
+        self.assertEqual(text.count("# TYPE"), 8)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "rt_eqcorrscan.prom")
+            metrics.write_prometheus(filename)
+            self.assertEqual(os.listdir(path), ["rt_eqcorrscan.prom"])
+            with open(filename) as f:
+                self.assertEqual(f.read(), text)
+
+    def test_read_while_channel_added(self):
+        metrics = IngestMetrics()
+        reads = []
+
+        class _ReadingDict(dict):
+            """ Read the metrics as each channel is added. """
+            def __setitem__(self, key, value):
+                reads.append(metrics.to_prometheus())
+                reads.append(metrics.to_dict())
+                super().__setitem__(key, value)
+
+        metrics._channels = _ReadingDict()
+        metrics.record(self.st[0])
+        self.assertEqual(reads[1], dict())
+        # A channel that has not been counted yet is not reported
+        metrics._channels[self.st[1].id] = _ChannelMetrics(
+            len(metrics.latency_buckets))
+        self.assertEqual(list(metrics.to_dict().keys()), [self.st[0].id])
+        self.assertNotIn(self.st[1].id, metrics.to_prometheus())
+
+    def test_reset(self):
+        metrics = IngestMetrics()
+        metrics.record(self.st[0])
+        self.assertEqual(len(metrics), 1)
+        metrics.reset()
+        self.assertEqual(metrics.to_dict(), dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
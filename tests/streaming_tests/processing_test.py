@@ -0,0 +1,259 @@
+"""
+Tests for incremental processing of streaming data.
+"""
+
+import unittest
+import numpy as np
+
+from unittest import mock
+from scipy.signal import iirfilter, sosfilt
+from obspy import read, Stream
+
+from rt_eqcorrscan.streaming.processing import (
+    ProcessedBuffer, _ChannelProcessor, _ANTI_ALIAS_CORNER, _ANTI_ALIAS_ORDER)
+from rt_eqcorrscan.streaming.buffers import Buffer
+
+from streaming_test import _LocalClient
+
+
+class TestChannelProcessor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tr = read()[0]
+        cls.tr.data = cls.tr.data.astype(np.float64)
+
+    def reference(self, lowcut=2., highcut=10., samp_rate=50.):
+        tr = self.tr.copy()
+        decimation = int(tr.stats.sampling_rate / samp_rate)
+        if decimation > 1 and highcut is None:
+            # Highpass and anti-alias lowpass as one zero-phase filter
+            nyquist = .5 * tr.stats.sampling_rate
+            sos = np.vstack([
+                iirfilter(4, lowcut / nyquist, btype="highpass",
+                          ftype="butter", output="sos"),
+                iirfilter(_ANTI_ALIAS_ORDER,
+                          _ANTI_ALIAS_CORNER * .5 * samp_rate / nyquist,
+                          btype="lowpass", ftype="butter", output="sos")])
+            tr.data = sosfilt(sos, sosfilt(sos, tr.data)[::-1])[::-1]
+        elif lowcut and highcut:
+            tr.filter("bandpass", freqmin=lowcut, freqmax=highcut, corners=4,
+                      zerophase=True)
+        elif lowcut:
+            tr.filter("highpass", freq=lowcut, corners=4, zerophase=True)
+        tr.data = tr.data[::decimation]
+        tr.stats.sampling_rate = samp_rate
+        return tr
+
+    def process(self, processor, packet_length):
+        traces = []
+        for i in range(0, self.tr.stats.npts, packet_length):
+            traces.extend(processor.add(
+                self.tr.data[i:i + packet_length],
+                self.tr.stats.starttime.ns + i * 10 ** 7))
+        traces.extend(processor.flush())
+        return Stream(traces).merge()[0]
+
+    def test_matches_whole_trace(self):
+        for lowcut, highcut, samp_rate in (
+                (2., 10., 50.), (2., 10., 100.), (1., None, 20.)):
+            reference = self.reference(lowcut, highcut, samp_rate)
+            for packet_length, batch in (
+                    (1, 0), (37, 0), (512, 0), (5000, 0), (37, 1000)):
+                processor = _ChannelProcessor(
+                    sampling_rate=100., lowcut=lowcut, highcut=highcut,
+                    filt_order=4, samp_rate=samp_rate, batch=batch)
+                processed = self.process(processor, packet_length)
+                self.assertEqual(processed.stats.starttime,
+                                 reference.stats.starttime)
+                self.assertEqual(processed.stats.sampling_rate, samp_rate)
+                self.assertEqual(processed.stats.npts, reference.stats.npts)
+                error = np.abs(processed.data - reference.data).max()
+                self.assertLess(error, 1e-5 * np.abs(reference.data).max())
+
+    def test_latency(self):
+        processor = _ChannelProcessor(
+            sampling_rate=100., lowcut=2., highcut=10., samp_rate=50.)
+        self.assertGreater(processor.latency, 0)
+        released = processor.add(
+            self.tr.data[0:1000], self.tr.stats.starttime.ns)
+        self.assertEqual(len(processor._tail), processor._settle)
+        self.assertEqual(released[0].stats.npts,
+                         np.ceil((1000 - processor._settle) / 2))
+
+    def test_gap_restarts(self):
+        processor = _ChannelProcessor(
+            sampling_rate=100., lowcut=2., highcut=10., samp_rate=50.)
+        start = self.tr.stats.starttime.ns
+        released = processor.add(self.tr.data[0:1000], start)
+        released.extend(processor.add(
+            self.tr.data[1500:], start + 1500 * 10 ** 7))
+        released.extend(processor.flush())
+        st = Stream(released).merge()
+        self.assertEqual(st[0].data.mask.sum(), 250)
+
+    def test_odd_gap_on_grid(self):
+        """ Data after a gap are decimated onto the same grid. """
+        processor = _ChannelProcessor(
+            sampling_rate=100., lowcut=2., highcut=10., samp_rate=50.)
+        start = self.tr.stats.starttime.ns
+        released = processor.add(self.tr.data[0:1000], start)
+        released.extend(processor.add(
+            self.tr.data[1501:], start + 1501 * 10 ** 7))
+        released.extend(processor.flush())
+        for tr in released:
+            self.assertEqual(tr.stats.starttime.ns % (10 ** 9 // 50), 0)
+        st = Stream(released).merge()
+        self.assertEqual(st[0].stats.starttime, self.tr.stats.starttime)
+
+    def test_anti_alias(self):
+        """ Energy above the processed Nyquist is not aliased. """
+        times = np.arange(10000) / 100.
+        # Aliases to 5 Hz at 20 Hz
+        data = np.sin(2 * np.pi * 35. * times)
+        for highcut in (None, 15.):
+            processor = _ChannelProcessor(
+                sampling_rate=100., lowcut=1., highcut=highcut,
+                filt_order=4, samp_rate=20.)
+            released = processor.add(data, self.tr.stats.starttime.ns)
+            released.extend(processor.flush())
+            processed = Stream(released).merge()[0].data
+            self.assertLess(np.abs(processed[200:-200]).max(), 1e-2)
+
+    def test_not_multiple(self):
+        with self.assertRaises(AssertionError):
+            _ChannelProcessor(sampling_rate=100., samp_rate=40.)
+
+
+class TestProcessedBuffer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def packets(self, length=1.):
+        starttime = self.st[0].stats.starttime
+        endtime = self.st[0].stats.endtime
+        packets = []
+        while starttime < endtime:
+            packets.extend(self.st.slice(
+                starttime, starttime + length - self.st[0].stats.delta))
+            starttime += length
+        return packets
+
+    def test_late_packet(self):
+        processed = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., samp_rate=50.)
+        reference = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., samp_rate=50.)
+        packets = [tr for tr in self.packets() if tr.id == self.st[0].id]
+        for i, packet in enumerate(packets):
+            if i == 10:
+                continue
+            processed.add_stream(packet)
+            reference.add_stream(packet)
+            if i == 20:
+                # Late data are processed on their own
+                processed.add_stream(packets[10])
+        processed.flush()
+        reference.flush()
+        tr = processed.stream[0]
+        tr_reference = reference.stream[0]
+        self.assertFalse(np.ma.is_masked(tr.data[500:550]))
+        # Data after the late packet are not changed by it
+        self.assertTrue(np.allclose(tr.data[1200:], tr_reference.data[1200:]))
+
+    def test_late_packet_odd_start(self):
+        """ Back-filled data are decimated onto the live grid. """
+        processed = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., samp_rate=50.)
+        tr = self.st[0]
+        processed.add_stream(tr.slice(tr.stats.starttime + 10))
+        late = tr.slice(tr.stats.starttime + 2.01, tr.stats.starttime + 5)
+        with mock.patch.object(processed.buffer, "add_stream",
+                               wraps=processed.buffer.add_stream) as added:
+            processed.add_stream(late)
+        released = added.call_args[0][0]
+        self.assertEqual(len(released), 1)
+        self.assertEqual(released[0].stats.starttime,
+                         late.stats.starttime + 0.01)
+        self.assertEqual(
+            released[0].stats.starttime.ns % (10 ** 9 // 50), 0)
+
+    def test_masked_data(self):
+        processed = ProcessedBuffer(maxlen=30., lowcut=2., highcut=10.)
+        st = self.st.copy()
+        for tr in st:
+            tr.data = np.ma.masked_array(tr.data, mask=False)
+            tr.data.mask[1000:1200] = True
+        processed.add_stream(st)
+        processed.flush()
+        for tr in processed.stream:
+            self.assertEqual(tr.data.mask.sum(), 200)
+
+    def test_unsupported_rate(self):
+        processed = ProcessedBuffer(maxlen=30., lowcut=2., samp_rate=40.)
+        with self.assertLogs("rt_eqcorrscan.streaming.processing",
+                             level="WARNING") as logs:
+            for packet in self.packets()[0:6]:
+                processed.add_stream(packet)
+        # One warning per channel
+        self.assertEqual(len(logs.output), 3)
+        self.assertEqual(len(processed), 0)
+        self.assertEqual(processed.unprocessed,
+                         sorted(tr.id for tr in self.st))
+        # Other channels are still processed
+        tr = self.st[0].copy()
+        tr.stats.station, tr.stats.sampling_rate = "OTHER", 200.
+        processed.add_stream(tr)
+        self.assertEqual([tr.id for tr in processed.stream], [tr.id])
+        self.assertNotIn(tr.id, processed.unprocessed)
+
+    def test_client(self):
+        client = _LocalClient(buffer=Buffer(traces=[], maxlen=30.))
+        client.processed_buffer = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., samp_rate=50.)
+        for packet in self.packets():
+            client.on_data(packet)
+        client.processed_buffer.flush()
+        st = client.processed_buffer.stream
+        self.assertEqual(len(st), 3)
+        for tr in st:
+            self.assertEqual(tr.stats.sampling_rate, 50.)
+            self.assertFalse(np.ma.is_masked(tr.data))
+
+    def test_int_raw_buffer(self):
+        client = _LocalClient(buffer=Buffer(
+            traces=[], maxlen=30., dtype=np.int32))
+        client.processed_buffer = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., samp_rate=50.)
+        for packet in self.packets():
+            client.on_data(packet)
+        client.processed_buffer.flush()
+        self.assertEqual(client.get_stream()[0].data.dtype, np.int32)
+        for tr in client.processed_buffer.stream:
+            self.assertEqual(tr.data.dtype, np.float64)
+            # Not rounded to integers
+            self.assertFalse(np.allclose(tr.data, np.round(tr.data)))
+        with self.assertRaises(AssertionError):
+            ProcessedBuffer(maxlen=30., dtype=np.int32)
+
+    def test_batch(self):
+        processed = ProcessedBuffer(
+            maxlen=30., lowcut=2., highcut=10., batch_length=20.)
+        for packet in self.packets()[0:30]:
+            processed.add_stream(packet)
+        # Ten seconds of data are held until they are read
+        self.assertEqual(len(processed.buffer), 0)
+        self.assertEqual(len(processed.stream), 3)
+        for packet in self.packets()[30:]:
+            processed.add_stream(packet)
+        self.assertEqual(len(processed.buffer), 3)
+
+    def test_maxlen(self):
+        processed = ProcessedBuffer(maxlen=30., lowcut=2., samp_rate=50.)
+        processed.add_stream(self.st)
+        processed.maxlen = 10.
+        self.assertEqual(processed.select(self.st[0].id)[0].stats.npts, 500)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+End-to-end benchmarks of ingesting data from a SeedLink server, using a
+local replay server.
+
+These are not run as part of the test-suite, run them directly with:
+    python tests/streaming_tests/seedlink_benchmarks.py
+"""
+
+import time
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+
+from rt_eqcorrscan.streaming.seedlink import RealTimeClient
+from rt_eqcorrscan.streaming.seedlink_server import SeedLinkReplayServer
+
+
+def _synthetic_station(duration: float, sampling_rate: float = 100.):
+    rng = np.random.default_rng(42)
+    npts = int(duration * sampling_rate)
+    return Stream([Trace(
+        data=rng.integers(-2000, 2000, npts).astype(np.int32), header=dict(
+            network="XX", station="BENCH", channel="HH" + component,
+            sampling_rate=sampling_rate,
+            starttime=UTCDateTime(2020, 1, 1)))
+        for component in "ZNE"])
+
+
+def bench_ingest(
+    n_channels: int = 300,
+    duration: float = 30.,
+    speed_up: float = 1.,
+    **kwargs
+) -> dict:
+    """
+    Stream n_channels from a local server to a RealTimeClient.
+
+    Returns
+    -------
+    Samples and packets per second received from starting the client to
+    the last packet, the mean latency and the fraction of packets arriving
+    within one second.
+    """
+    with SeedLinkReplayServer(
+            _synthetic_station(duration), n_channels=n_channels,
+            speed_up=speed_up, **kwargs) as server:
+        rt_client = RealTimeClient(
+            server_url=server.url, buffer_capacity=duration * 2)
+        for network, station in sorted(server.stations):
+            rt_client.select_stream(net=network, station=station,
+                                    selector="HH?")
+        rt_client.background_run()
+        n_samples = sum(tr.stats.npts for tr in server.st)
+        tic = time.time()
+        timeout = 2 * duration / speed_up + 30
+        while time.time() - tic < timeout:
+            metrics = rt_client.metrics.to_dict()
+            if sum(channel["samples"]
+                   for channel in metrics.values()) >= n_samples:
+                break
+            time.sleep(0.01)
+        rt_client.background_stop()
+    metrics = rt_client.metrics.to_dict().values()
+    run_time = max(channel["last_arrival"] for channel in metrics) - tic
+    packets = sum(channel["packets"] for channel in metrics)
+    return dict(
+        samples_per_second=sum(
+            channel["samples"] for channel in metrics) / run_time,
+        packets_per_second=packets / run_time,
+        mean_latency=sum(
+            channel["latency_sum"] for channel in metrics) / packets,
+        within_one_second=sum(
+            channel["latency_buckets"][1.0] for channel in metrics) / packets)
+
+
+def main():
+    print("Ingest of 300 channels at real-time, 1 s packets:")
+    result = bench_ingest(packet_length=1.)
+    print("\t{0:.0f} packets/s, mean latency {1:.3f} s, {2:.1%} within "
+          "1 s".format(result["packets_per_second"], result["mean_latency"],
+                       result["within_one_second"]))
+    print("Ingest of 300 channels as fast as possible (full records):")
+    result = bench_ingest(duration=300., speed_up=1000.)
+    print("\t{0:.3e} samples/s, {1:.0f} packets/s".format(
+        result["samples_per_second"], result["packets_per_second"]))
+
+
+if __name__ == "__main__":
+    main()
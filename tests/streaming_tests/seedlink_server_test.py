@@ -0,0 +1,124 @@
+"""
+Tests for the local SeedLink replay server.
+"""
+
+import tempfile
+import time
+import unittest
+import numpy as np
+
+from obspy import read
+from obsplus import WaveBank
+
+from rt_eqcorrscan.streaming.seedlink import RealTimeClient
+from rt_eqcorrscan.streaming.seedlink_server import SeedLinkReplayServer
+
+
+class SeedLinkReplayServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def stream(self, server, timeout=20., **kwargs):
+        """ Stream everything from the server with a RealTimeClient. """
+        rt_client = RealTimeClient(
+            server_url=server.url, buffer_capacity=60., **kwargs)
+        # Notice disconnects and reconnect quickly
+        rt_client.conn.set_net_timeout(1)
+        rt_client.conn.set_net_delay(1)
+        for network, station in sorted(server.stations):
+            rt_client.select_stream(
+                net=network, station=station, selector="EH?")
+        rt_client.background_run()
+        n_samples = sum(tr.stats.npts for tr in server.st)
+        tic = time.time()
+        while time.time() - tic < timeout:
+            received = sum(channel["samples"] for channel in
+                           rt_client.metrics.to_dict().values())
+            if received >= n_samples:
+                break
+            time.sleep(0.1)
+        rt_client.background_stop()
+        return rt_client
+
+    def assertComplete(self, rt_client):
+        st = rt_client.get_stream().split()
+        self.assertEqual(len(st), 3)
+        for tr, tr_original in zip(st.sort(), self.st.copy().sort()):
+            self.assertEqual(tr.id, tr_original.id)
+            self.assertTrue(np.array_equal(tr.data, tr_original.data))
+
+    def test_replay(self):
+        with SeedLinkReplayServer(self.st, packet_length=0.5, speed_up=20.,
+                                  jitter=0.1) as server:
+            rt_client = self.stream(server)
+        self.assertComplete(rt_client)
+        metrics = rt_client.metrics.to_dict()
+        for channel in metrics.values():
+            self.assertEqual(channel["packets"], 60)
+            self.assertEqual(channel["gaps"], 0)
+        stats = server.stats()
+        self.assertEqual(stats["released"], 180)
+        self.assertEqual(stats["sent"], 180)
+        self.assertEqual(stats["connections"], 1)
+
+    def test_out_of_order(self):
+        with SeedLinkReplayServer(self.st, packet_length=0.5, speed_up=20.,
+                                  out_of_order=0.3, seed=42) as server:
+            rt_client = self.stream(server)
+        self.assertComplete(rt_client)
+        for channel in rt_client.metrics.to_dict().values():
+            self.assertGreater(channel["out_of_order"], 0)
+
+    def test_disconnect_resumes(self):
+        with SeedLinkReplayServer(self.st, packet_length=0.5, speed_up=10.,
+                                  disconnect_interval=0.5) as server:
+            rt_client = self.stream(server)
+        self.assertComplete(rt_client)
+        stats = server.stats()
+        self.assertGreater(stats["disconnects"], 0)
+        self.assertEqual(stats["connections"], stats["disconnects"] + 1)
+        # Resumed from the last packet: nothing sent twice
+        self.assertEqual(stats["sent"], stats["released"])
+
+    def test_timeshift(self):
+        with SeedLinkReplayServer(self.st, speed_up=1., latency=0.2,
+                                  packet_length=0.5,
+                                  endtime=self.st[0].stats.starttime + 2,
+                                  ) as server:
+            rt_client = self.stream(server, timeout=10.)
+        for channel in rt_client.metrics.to_dict().values():
+            self.assertGreater(channel["mean_latency"], 0.2)
+            self.assertLess(channel["mean_latency"], 1.)
+
+    def test_n_channels(self):
+        with SeedLinkReplayServer(self.st, n_channels=7) as server:
+            self.assertEqual(len(server.st), 7)
+            self.assertEqual(server.stations, {
+                ("BW", "RJOB"), ("BW", "R0000"), ("BW", "R0001")})
+            rt_client = RealTimeClient(server_url=server.url)
+            rt_client.connect()
+            info = rt_client.get_info("STATIONS")
+            rt_client.close()
+        for station in ("RJOB", "R0000", "R0001"):
+            self.assertIn('name="{0}"'.format(station), info)
+
+    def test_wavebank(self):
+        with tempfile.TemporaryDirectory() as path:
+            bank = WaveBank(path)
+            bank.put_waveforms(self.st)
+            bank.update_index()
+            server = SeedLinkReplayServer(
+                bank, starttime=self.st[0].stats.starttime + 10)
+        self.assertEqual(len(server.st), 3)
+        for tr in server.st:
+            self.assertEqual(tr.stats.starttime,
+                             self.st[0].stats.starttime + 10)
+
+    def test_client_copy_keeps_port(self):
+        rt_client = RealTimeClient(server_url="localhost:18123")
+        self.assertEqual(rt_client.copy().server_port, 18123)
+
+
+if __name__ == "__main__":
+    unittest.main()
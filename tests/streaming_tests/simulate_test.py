@@ -2,13 +2,17 @@
 Tests for simulating a real-time client.
 """
 
+import asyncio
 import unittest
 import time
+import numpy as np
 
-from obspy import Stream, UTCDateTime
+from obspy import Stream, UTCDateTime, read
 from obspy.clients.fdsn import Client
 
-from rt_eqcorrscan.streaming.simulate import SimulateRealTimeClient
+from rt_eqcorrscan.streaming.clock import VirtualClock
+from rt_eqcorrscan.streaming.simulate import (
+    SimulateRealTimeClient, AsyncSimulateRealTimeClient)
 
 SLEEP_STEP = 40
 
@@ -72,5 +76,154 @@ class FDSNTest(unittest.TestCase):
                                     "maxlen=10)")
 
 
+class _LocalWaveformClient(object):
+    """ Client serving the obspy example data. """
+    base_url = "local"
+
+    def __init__(self):
+        self.st = read()
+
+    def get_waveforms(self, network, station, location, channel, starttime,
+                      endtime):
+        return self.st.select(
+            network=network, station=station, location=location,
+            channel=channel).slice(starttime, endtime).copy()
+
+
+class _BulkWaveformClient(_LocalWaveformClient):
+    """ Client serving the obspy example data that counts queries. """
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def get_waveforms(self, *args, **kwargs):
+        self.queries.append("get_waveforms")
+        return super().get_waveforms(*args, **kwargs)
+
+    def get_waveforms_bulk(self, bulk):
+        self.queries.append("get_waveforms_bulk")
+        st = Stream()
+        for network, station, location, channel, starttime, endtime in bulk:
+            st += super().get_waveforms(
+                network, station, location, channel, starttime, endtime)
+        return st
+
+
+class LocalSimulateTest(unittest.TestCase):
+    def test_bulk_queries(self):
+        client = _BulkWaveformClient()
+        rt_client = SimulateRealTimeClient(
+            client=client, starttime=client.st[0].stats.starttime + 10,
+            query_interval=2., speed_up=20., buffer_capacity=10.)
+        for channel in ("EHZ", "EHN", "EHE"):
+            rt_client.select_stream(net="BW", station="RJOB", selector=channel)
+        self.assertIsNone(rt_client.speed_up_stats)
+        rt_client.background_run()
+        time.sleep(1.)
+        rt_client.background_stop()
+        self.assertEqual(len(rt_client.buffer), 3)
+        # One query per tick for all streams
+        self.assertEqual(set(client.queries), {"get_waveforms_bulk"})
+        stats = rt_client.speed_up_stats
+        self.assertEqual(stats["queries"], len(client.queries))
+        self.assertEqual(stats["requested"], 20.)
+        self.assertGreater(stats["achieved"], 15.)
+        self.assertLess(stats["achieved"], 25.)
+
+    def test_prefetch(self):
+        client = _BulkWaveformClient()
+        clock = VirtualClock(starttime=UTCDateTime(2020, 1, 1))
+        rt_client = SimulateRealTimeClient(
+            client=client, starttime=client.st[0].stats.starttime + 2,
+            query_interval=1., buffer_capacity=30., prefetch=5, clock=clock)
+        rt_client.select_stream(net="BW", station="RJOB", selector="EH?")
+        self.assertIsNone(rt_client.prefetch_stats)
+        # Run for a fixed number of queries, however fast the machine is
+        clock.attach()
+        rt_client.background_run()
+        clock.sleep(20.5)
+        rt_client.stop()
+        clock.detach()
+        rt_client.background_stop()
+        # Data are read five query intervals at a time
+        ticks = rt_client.speed_up_stats["queries"]
+        self.assertEqual(ticks, 21)
+        self.assertLessEqual(len(client.queries), ticks // 5 + 2)
+        self.assertEqual(rt_client.prefetch_stats["chunks"],
+                         len(client.queries))
+        st = rt_client.get_stream().split()
+        self.assertEqual(len(st), 3)
+        for tr in st:
+            tr_original = client.st.select(id=tr.id)[0].slice(
+                tr.stats.starttime, tr.stats.endtime)
+            self.assertEqual(tr.stats.starttime, tr_original.stats.starttime)
+            self.assertTrue(np.array_equal(tr.data, tr_original.data))
+
+    def test_virtual_clock(self):
+        client = _BulkWaveformClient()
+        starttime = client.st[0].stats.starttime
+        clock = VirtualClock(starttime=UTCDateTime(2020, 1, 1))
+        rt_client = SimulateRealTimeClient(
+            client=client, starttime=starttime + 2, query_interval=1.,
+            buffer_capacity=30., clock=clock)
+        rt_client.select_stream(net="BW", station="RJOB", selector="EH?")
+        tic = time.perf_counter()
+        # Keep time with the client for 20.5 simulated seconds at real-time
+        clock.attach()
+        rt_client.background_run()
+        clock.sleep(20.5)
+        self.assertEqual(clock.now(), UTCDateTime(2020, 1, 1) + 20.5)
+        rt_client.stop()
+        clock.detach()
+        rt_client.background_stop()
+        self.assertLess(time.perf_counter() - tic, 10.)
+        self.assertEqual(len(client.queries), 21)
+        self.assertEqual(rt_client.speed_up_stats["simulated_seconds"], 20.)
+        # Latency is measured in simulated time, not from the wall-clock
+        for channel in rt_client.metrics.to_dict().values():
+            self.assertGreaterEqual(channel["mean_latency"], 0.)
+            self.assertLess(channel["mean_latency"], 2.)
+        st = rt_client.get_stream().split()
+        self.assertEqual(len(st), 3)
+        for tr in st:
+            # Queries start one query interval before starttime
+            self.assertEqual(tr.stats.starttime, starttime + 1)
+            self.assertTrue(np.array_equal(
+                tr.data, client.st.select(id=tr.id)[0].slice(
+                    tr.stats.starttime, tr.stats.endtime).data))
+
+
+class AsyncSimulateTest(unittest.TestCase):
+    def test_shared_loop(self):
+        client = _LocalWaveformClient()
+        starttime = client.st[0].stats.starttime
+        rt_clients = []
+        for channel in ("EHZ", "EHN", "EHE"):
+            rt_client = AsyncSimulateRealTimeClient(
+                client=client, starttime=starttime + 10, query_interval=2.,
+                speed_up=20., buffer_capacity=10.)
+            rt_client.select_stream(net="BW", station="RJOB", selector=channel)
+            rt_clients.append(rt_client)
+
+        async def stream():
+            for rt_client in rt_clients:
+                rt_client.background_run()
+            await asyncio.sleep(1.)
+            await asyncio.gather(*[rt_client.stop()
+                                   for rt_client in rt_clients])
+
+        asyncio.run(stream())
+        for rt_client in rt_clients:
+            self.assertFalse(rt_client.streaming)
+            self.assertEqual(len(rt_client.buffer), 1)
+            self.assertEqual(rt_client.buffer_length,
+                             rt_client.buffer_capacity)
+
+    def test_copy(self):
+        rt_client = AsyncSimulateRealTimeClient(
+            client=_LocalWaveformClient(), starttime=UTCDateTime(0))
+        self.assertIsInstance(rt_client.copy(), AsyncSimulateRealTimeClient)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,363 @@
+"""
+Tests for the streaming client base class.
+"""
+
+import asyncio
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+
+from unittest import mock
+from obspy import read, Trace
+from obsplus import WaveBank
+
+from rt_eqcorrscan.streaming.archiver import WaveBankArchiver
+from rt_eqcorrscan.streaming.buffers import Buffer
+from rt_eqcorrscan.streaming.clock import VirtualClock
+from rt_eqcorrscan.streaming.streaming import (
+    _StreamingClient, _PacketCoalescer, AsyncStreamingClient)
+
+
+class _LocalClient(_StreamingClient):
+    """ Client that is fed packets directly. """
+    def start(self) -> None:
+        self.started = True
+
+    def stop(self) -> None:
+        self.busy = False
+        self.started = False
+
+    @property
+    def can_add_streams(self) -> bool:
+        return True
+
+    def copy(self, empty_buffer: bool = True):
+        return _LocalClient(
+            buffer=self._empty_buffer(), buffer_capacity=self.buffer_capacity,
+            coalesce_latency=self.coalesce_latency,
+            coalesce_samples=self.coalesce_samples)
+
+    def run(self) -> None:
+        self.stop()
+
+
+class _AsyncLocalClient(AsyncStreamingClient):
+    """ Asynchronous client that feeds packets at a fixed interval. """
+    def __init__(self, packets=None, interval=0.01, **kwargs):
+        super().__init__(**kwargs)
+        self.packets = packets or []
+        self.interval = interval
+
+    def start(self) -> None:
+        self.started = True
+
+    @property
+    def can_add_streams(self) -> bool:
+        return False
+
+    def copy(self, empty_buffer: bool = True):
+        return _AsyncLocalClient(
+            packets=self.packets, interval=self.interval,
+            buffer=self._empty_buffer(), buffer_capacity=self.buffer_capacity)
+
+    async def run(self) -> None:
+        for packet in self.packets:
+            self.on_data(packet)
+            if await self.sleep(self.interval):
+                return
+        await self.stop()
+
+
+class TestStreamingClient(unittest.TestCase):
+    def test_clear_buffer_keeps_storage(self):
+        client = _LocalClient(buffer=Buffer(
+            traces=[], maxlen=30., gaps="intervals", dtype=np.float32))
+        client.on_data(read()[0])
+        client.clear_buffer()
+        self.assertEqual(len(client.buffer), 0)
+        self.assertEqual(client.buffer.gaps, "intervals")
+        self.assertEqual(client.buffer.dtype, np.float32)
+
+    def test_set_capacity(self):
+        client = _LocalClient(buffer_capacity=30.)
+        client.on_data(read()[0])
+        trace_buffer = client.buffer.traces[0]
+        client.buffer_capacity = 10.
+        self.assertEqual(client.buffer.maxlen, 10.)
+        self.assertIs(client.buffer.traces[0], trace_buffer)
+        self.assertEqual(client.get_stream()[0].stats.npts, 1000)
+        self.assertEqual(client.copy().buffer.maxlen, 10.)
+
+    def test_metrics(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=60.)
+        for tr in read():
+            client.on_data(tr)
+        # Packets are counted as they arrive, not when they are buffered
+        self.assertEqual(len(client.buffer), 0)
+        metrics = client.metrics.to_dict()
+        self.assertEqual(len(metrics), 3)
+        for channel in metrics.values():
+            self.assertEqual(channel["packets"], 1)
+            self.assertEqual(channel["samples"], 3000)
+
+    def test_metrics_use_client_clock(self):
+        client = _LocalClient(buffer_capacity=30.)
+        tr = read()[0]
+        client.clock = VirtualClock(starttime=tr.stats.endtime + 2.)
+        client.on_data(tr)
+        channel = client.metrics.to_dict()[tr.id]
+        self.assertAlmostEqual(channel["mean_latency"], 2., places=5)
+        self.assertEqual(channel["last_arrival"],
+                         (tr.stats.endtime + 2.).timestamp)
+
+    def test_no_record(self):
+        client = _LocalClient(buffer_capacity=30.)
+        st = read()
+        client.on_data(st[0].slice(starttime=st[0].stats.starttime + 20))
+        before = client.metrics.to_dict()
+        client.on_data(st[0].slice(endtime=st[0].stats.starttime + 10),
+                       record=False)
+        self.assertEqual(client.metrics.to_dict(), before)
+        # Data are still buffered
+        self.assertEqual(client.buffer.traces[0].data_len, 20.01)
+
+    def test_checkpoint_round_trip(self):
+        st = read()
+        client = _LocalClient(buffer_capacity=60.)
+        client.on_data(st.slice(endtime=st[0].stats.starttime + 10)[0])
+        with tempfile.TemporaryDirectory() as path:
+            client.checkpoint(path)
+            restarted = _LocalClient(buffer_capacity=60.)
+            restarted.load_checkpoint(path)
+            # The empty buffer is replaced, reading from the checkpoint
+            self.assertIsInstance(
+                restarted.buffer.traces[0].data._data.base, np.memmap)
+        self.assertEqual(len(restarted.buffer), 1)
+        # New data after the restart are added to the checkpointed data
+        restarted.on_data(st.slice(starttime=st[0].stats.starttime + 20)[0])
+        tr = restarted.get_stream()[0].trim(
+            st[0].stats.starttime, st[0].stats.endtime)
+        self.assertEqual(tr.data.mask.sum(), 999)
+        self.assertTrue(np.array_equal(tr.data[0:1000], st[0].data[0:1000]))
+
+    def test_background_archiving(self):
+        st = read()
+        with tempfile.TemporaryDirectory() as path:
+            client = _LocalClient(buffer_capacity=60., wavebank=WaveBank(path))
+            self.assertIsNone(client.archiving_stats)
+            client.archiver = WaveBankArchiver(client.wavebank)
+            for second in range(30):
+                for tr in st.slice(st[0].stats.starttime + second,
+                                   st[0].stats.starttime + second + 0.99):
+                    client.on_data(tr.copy())
+            client.background_stop()
+            self.assertFalse(client.archiver.running)
+            archived = client.wavebank.get_waveforms().merge()
+        self.assertEqual(client.archiving_stats["written"], 90)
+        self.assertEqual(client.archiving_stats["flushes"], 1)
+        for tr, tr_original in zip(archived.sort(), st.sort()):
+            self.assertEqual(tr.stats.starttime, tr_original.stats.starttime)
+            self.assertTrue(np.array_equal(tr.data, tr_original.data))
+
+
+class TestCoalescing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def packets(self, length=2.0):
+        """ Split the stream into packets, interleaving the channels. """
+        starttime = self.st[0].stats.starttime
+        endtime = self.st[0].stats.endtime
+        packets = []
+        while starttime < endtime:
+            packets.extend(self.st.slice(
+                starttime, starttime + length - self.st[0].stats.delta))
+            starttime += length
+        return packets
+
+    def test_no_coalescing_by_default(self):
+        client = _LocalClient(buffer_capacity=30.)
+        self.assertIsNone(client.coalescing_stats)
+        packet = self.packets()[0]
+        client.on_data(packet)
+        self.assertEqual(len(client.buffer), 1)
+
+    def test_coalesced_matches_uncoalesced(self):
+        direct = _LocalClient(buffer_capacity=30.)
+        coalesced = _LocalClient(buffer_capacity=30., coalesce_samples=1000)
+        for packet in self.packets():
+            direct.on_data(packet)
+            coalesced.on_data(packet)
+        # 3000 samples per channel, released every 1000
+        stats = coalesced.coalescing_stats
+        self.assertEqual(stats["packets"], 45)
+        self.assertEqual(stats["flushes"], 9)
+        self.assertEqual(stats["held"], 0)
+        for tr_direct, tr_coalesced in zip(
+                direct.get_stream(), coalesced.get_stream()):
+            self.assertEqual(tr_direct.stats.starttime,
+                             tr_coalesced.stats.starttime)
+            self.assertTrue(np.array_equal(tr_direct.data, tr_coalesced.data))
+
+    def test_held_until_flushed(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=60.)
+        for packet in self.packets():
+            client.on_data(packet)
+        self.assertEqual(len(client.buffer), 0)
+        self.assertEqual(client.coalescing_stats["held"], 45)
+        client.background_stop()
+        self.assertEqual(len(client.buffer), 3)
+        self.assertTrue(client.buffer_full)
+        self.assertEqual(client.coalescing_stats["held"], 0)
+
+    def test_released_without_new_packets(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=0.2)
+        for packet in self.packets()[0:3]:
+            client.on_data(packet)
+        self.assertEqual(len(client.buffer), 0)
+        # No more packets arrive: held packets are released on a timer
+        tic = time.monotonic()
+        while len(client.buffer) < 3 and time.monotonic() - tic < 10.:
+            time.sleep(0.05)
+        self.assertEqual(len(client.buffer), 3)
+        stats = client.coalescing_stats
+        self.assertEqual(stats["held"], 0)
+        self.assertGreaterEqual(stats["max_latency"], 0.2)
+
+    def test_zero_latency(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=0.)
+        for packet in self.packets()[0:3]:
+            client.on_data(packet)
+        self.assertEqual(len(client.buffer), 3)
+
+    def test_latency_per_packet(self):
+        """ Each packet is charged the time it was held for. """
+        coalescer = _PacketCoalescer(max_latency=60.)
+        packets = [packet for packet in self.packets()
+                   if packet.id == self.st[0].id]
+        # Packets arrive one second apart and are flushed with the last
+        with mock.patch("rt_eqcorrscan.streaming.streaming.time.monotonic",
+                        side_effect=[0., 1., 2., 3., 4., 4.]):
+            for packet in packets[0:5]:
+                coalescer.add(packet)
+            coalescer.flush()
+        stats = coalescer.stats()
+        self.assertEqual(stats["flushes"], 1)
+        self.assertEqual(stats["mean_latency"], 2.)
+        self.assertEqual(stats["max_latency"], 4.)
+
+    def test_gap_releases_channel(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=60.)
+        packets = [packet for packet in self.packets()
+                   if packet.id == self.st[0].id]
+        client.on_data(packets[0])
+        client.on_data(packets[2])
+        self.assertEqual(len(client.buffer), 1)
+        self.assertEqual(client.buffer.traces[0].stats.endtime,
+                         packets[0].stats.endtime)
+        client.flush()
+        self.assertEqual(client.buffer.traces[0].stats.endtime,
+                         packets[2].stats.endtime)
+
+    def test_masked_packets(self):
+        client = _LocalClient(buffer_capacity=30., coalesce_latency=60.)
+        packets = [packet for packet in self.packets()
+                   if packet.id == self.st[0].id]
+        packets[1].data = np.ma.masked_array(
+            packets[1].data, mask=np.zeros(packets[1].stats.npts, dtype=bool))
+        packets[1].data.mask[10:20] = True
+        for packet in packets[0:3]:
+            client.on_data(packet)
+        client.flush()
+        tr = client.get_stream()[0].trim(
+            packets[0].stats.starttime, packets[2].stats.endtime)
+        self.assertEqual(tr.data.mask.sum(), 10)
+        self.assertTrue(tr.data.mask[
+            packets[0].stats.npts + 10:packets[0].stats.npts + 20].all())
+
+    def test_copy_keeps_settings(self):
+        client = _LocalClient(
+            buffer_capacity=30., coalesce_latency=0.25, coalesce_samples=512)
+        client_copy = client.copy()
+        self.assertEqual(client_copy.coalesce_latency, 0.25)
+        self.assertEqual(client_copy.coalesce_samples, 512)
+
+
+class TestAsyncStreamingClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.st = read()
+
+    def packets(self):
+        """ One second packets - new for each call. """
+        packets = []
+        for i in range(30):
+            for tr in self.st:
+                packets.append(Trace(
+                    data=tr.data[i * 100:(i + 1) * 100], header=dict(
+                        network=tr.stats.network, station=tr.stats.station,
+                        channel=tr.stats.channel,
+                        sampling_rate=tr.stats.sampling_rate,
+                        starttime=tr.stats.starttime + i)))
+        return packets
+
+    def test_shared_loop(self):
+        clients = [_AsyncLocalClient(packets=self.packets(), interval=0.001,
+                                     buffer_capacity=30.)
+                   for _ in range(10)]
+        threads = []
+
+        async def stream():
+            for client in clients:
+                client.background_run()
+            await asyncio.sleep(0.01)
+            threads.append(threading.active_count())
+            await asyncio.gather(*[client.wait() for client in clients])
+
+        n_threads = threading.active_count()
+        asyncio.run(stream())
+        # Clients do not start threads
+        self.assertEqual(threads, [n_threads])
+        for client in clients:
+            self.assertEqual(len(client.buffer), 3)
+            self.assertTrue(client.buffer_full)
+            self.assertFalse(client.busy)
+
+    def test_stop_wakes_client(self):
+        client = _AsyncLocalClient(packets=self.packets(), interval=60.)
+
+        async def stream():
+            client.background_run()
+            await asyncio.sleep(0.01)
+            tic = time.perf_counter()
+            await client.stop()
+            return time.perf_counter() - tic
+
+        self.assertLess(asyncio.run(stream()), 1.)
+        self.assertEqual(len(client.buffer), 1)
+        self.assertEqual(len(client._tasks), 0)
+
+    def test_wavebank(self):
+        with tempfile.TemporaryDirectory() as path:
+            client = _AsyncLocalClient(
+                packets=self.packets(), interval=0., wavebank=WaveBank(path),
+                coalesce_samples=500)
+
+            async def stream():
+                client.background_run()
+                await client.wait()
+
+            asyncio.run(stream())
+            archived = client.wavebank.get_waveforms().merge()
+            self.assertEqual(len(archived), 3)
+            for tr, tr_buffer in zip(archived.sort(),
+                                     client.get_stream().sort()):
+                tr_buffer.trim(tr.stats.starttime, tr.stats.endtime)
+                self.assertTrue(np.array_equal(tr.data, tr_buffer.data))
+
+
+if __name__ == "__main__":
+    unittest.main()